@@ -7,4 +7,4 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 
-version = '0.9.0.dev1'
+version = '0.9.0.dev2'
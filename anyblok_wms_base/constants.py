@@ -21,6 +21,7 @@ as keys for a display system (with i18n in mind), such as
 ``wms_op_type_pack``.
 
 """
+from datetime import datetime, timezone
 
 AVATAR_STATES = dict(past="wms_avatar_states_past",
                      present="wms_avatar_states_present",
@@ -80,6 +81,13 @@ they are prefixed with ``wms_``.
 
 SPLIT_AGGREGATE_PHYSICAL_BEHAVIOUR = 'split_aggregate_physical'
 
+COMPACT_FORMAL_SPLIT_BEHAVIOUR = 'compact_formal_split'
+"""Behaviour of PhysObj Types to record formal Splits compactly.
+
+See :meth:`Wms.PhysObj.Type.are_formal_splits_compact()
+<anyblok_wms_base.quantity.physobj.Type.are_formal_splits_compact>`.
+"""
+
 DATE_TIME_INFINITY = object()
 """A marker used to represent +infinity date/time.
 
@@ -88,6 +96,26 @@ this marker in the interface is more explicit than using None (which could
 also mean one does not care about dates).
 """
 
+DATE_TIME_INDETERMINATE = datetime(9999, 1, 1, tzinfo=timezone.utc)
+"""Date/time of execution of planned Operations that are not known at all.
+
+This is a real value, to be stored in the :attr:`dt_execution
+<anyblok_wms_base.core.operation.base.Operation.dt_execution>` of
+``planned`` Operations, and consequently in the :attr:`dt_from
+<anyblok_wms_base.core.physobj.main.Avatar.dt_from>` and :attr:`dt_until
+<anyblok_wms_base.core.physobj.main.Avatar.dt_until>` of the affected
+Avatars, that can't be reached by actual executions.
+
+Quantity queries at any actual date and time therefore don't take
+the consequences of indeterminate Operations into account, whereas those
+at :data:`DATE_TIME_INFINITY` do.
+
+Operations following indeterminate ones are themselves indeterminate,
+hence executing the first Operation of such a chain doesn't
+have to shift the following ones.
+See :ref:`improvement_indeterminate_avatars`.
+"""
+
 
 DEFAULT_ASSEMBLY_NAME = 'default'
 """The default name to use for assemblies.
@@ -19,8 +19,10 @@ logger = logging.getLogger(__name__)
 
 def import_declarations(reload=None):
     from . import wms
+    from . import archive
     if reload is not None:
         reload(wms)
+        reload(archive)
     operation.import_declarations(reload=reload)
     physobj.import_declarations(reload=reload)
 
@@ -94,6 +96,23 @@ class WmsCore(Blok):
 
         if latest_version < '0.9.0.dev1':
             self.update_contents_property_local_goods_id()
+        if latest_version < '0.9.0.dev2':
+            self.update_avatar_type_code()
+        self.registry.Wms.PhysObj.Avatar.ensure_partial_indexes()
+
+    def update_avatar_type_code(self):  # pragma: no cover
+        """Fill the denormalized ``type_id`` and ``code`` of Avatars.
+
+        Only Avatars without a ``type_id`` are concerned: these are the
+        ones created before the columns existed.
+        """
+        PhysObj = self.registry.Wms.PhysObj
+        Avatar = PhysObj.Avatar
+        (Avatar.query()
+         .filter(Avatar.type_id.is_(None),
+                 Avatar.obj_id == PhysObj.id)
+         .update(dict(type_id=PhysObj.type_id, code=PhysObj.code),
+                 synchronize_session=False))
 
     def update_contents_property_local_goods_id(self):
         """Replace existing occurrences of ``local_goods_ids``.
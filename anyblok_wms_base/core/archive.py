@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# This file is a part of the AnyBlok / WMS Base project
+#
+#    Copyright (C) 2018 Georges Racinet <gracinet@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import not_
+from sqlalchemy import orm
+from sqlalchemy import select
+
+from anyblok import Declarations
+from anyblok.column import DateTime
+from anyblok.column import Integer
+from anyblok.column import String
+from anyblok.column import Text
+
+register = Declarations.register
+Model = Declarations.Model
+
+
+@register(Model.Wms)
+class Archive:
+    """Namespace for archived history, and archival logic.
+
+    History older than an audit window can be moved from the
+    :class:`Operation <anyblok_wms_base.core.operation.base.Operation>`,
+    :class:`HistoryInput <anyblok_wms_base.core.operation.base.HistoryInput>`
+    and :class:`Avatar <anyblok_wms_base.core.physobj.main.Avatar>` Models
+    to the simpler Models of this namespace, that have no foreign keys and
+    are not involved in any query of the stock. See :meth:`archive_history`.
+
+    For Operations, only the columns of the base Model are archived.
+    """
+
+    @classmethod
+    def protected_avatars_query(cls):
+        """Query for ids of Avatars that must not be archived.
+
+        These are the Avatars that are reachable from Operations that are not
+        ``done``, going upwards in history: the inputs of these Operations,
+        then the inputs of the Operations that produced them, and so on.
+        """
+        Wms = cls.registry.Wms
+        Avatar = Wms.PhysObj.Avatar
+        Operation = Wms.Operation
+        HI = Operation.HistoryInput
+        query = cls.registry.query
+
+        protected = (query(Avatar.id.label('avatar_id'),
+                           Avatar.outcome_of_id.label('op_id'))
+                     .join(HI, HI.avatar_id == Avatar.id)
+                     .join(Operation, Operation.id == HI.operation_id)
+                     .filter(Operation.state != 'done')
+                     .cte('protected', recursive=True))
+        parent = orm.aliased(protected, name='parent')
+        tail = (query(Avatar.id, Avatar.outcome_of_id)
+                .join(HI, HI.avatar_id == Avatar.id)
+                .join(parent, parent.c.op_id == HI.operation_id))
+        protected = protected.union(tail)
+        return query(protected.c.avatar_id)
+
+    @classmethod
+    def archive_history(cls, cutoff, batch_size=None):
+        """Move the history older than ``cutoff`` to the archive Models.
+
+        :param datetime cutoff: Avatars in the ``past`` state whose
+                                ``dt_until`` is not later than this are
+                                archived, together with the Operations that
+                                end up having neither inputs nor outcomes.
+        :param int batch_size:
+           if ``None``, everything is done in one shot. Otherwise, Avatars
+           and Operations are archived by batches of that size, and the
+           transaction is committed after each batch.
+        :return: the numbers of archived Avatars and Operations.
+
+        Quantity queries at any date and time not earlier than ``cutoff`` are
+        not affected, since they can't involve the archived Avatars.
+
+        Nothing that is reachable from Operations that are not ``done``
+        is archived (see :meth:`protected_avatars_query`).
+
+        Once the inputs of an Operation are archived, it can't be
+        :ref:`cancelled, reverted or obliviated <op_cancel_revert_obliviate>`
+        any more.
+        """
+        Avatar = cls.registry.Wms.PhysObj.Avatar
+        candidates = (Avatar.query(Avatar.id)
+                      .filter(Avatar.state == 'past',
+                              Avatar.dt_until <= cutoff,
+                              not_(Avatar.id.in_(
+                                  cls.protected_avatars_query())))
+                      .order_by(Avatar.id))
+        nb_avatars = nb_ops = 0
+        while True:
+            cls.registry.flush()
+            query = candidates
+            if batch_size is not None:
+                query = query.limit(batch_size)
+            av_ids = [row[0] for row in query.all()]
+            archived_avatars = cls.archive_avatars(av_ids)
+            archived_ops = cls.archive_operations(cutoff,
+                                                  batch_size=batch_size)
+            nb_avatars += archived_avatars
+            nb_ops += archived_ops
+            cls.registry.expire_all()
+            if batch_size is None or not (archived_avatars or archived_ops):
+                break
+            cls.registry.commit()
+        return nb_avatars, nb_ops
+
+    @classmethod
+    def archive_avatars(cls, av_ids):
+        """Archive the given Avatars and their links to Operations.
+
+        :param av_ids: ids of the Avatars to archive
+        :return: the number of archived Avatars
+
+        No checks are performed, this is an internal method
+        of :meth:`archive_history`.
+        """
+        if not av_ids:
+            return 0
+        Wms = cls.registry.Wms
+        HI = Wms.Operation.HistoryInput
+        execute = cls.registry.execute
+        hi_cols = ('operation_id', 'avatar_id', 'orig_dt_until')
+        execute(cls.HistoryInput.__table__.insert().from_select(
+            hi_cols,
+            select([getattr(HI, col) for col in hi_cols])
+            .where(HI.avatar_id.in_(av_ids))))
+
+        Avatar = Wms.PhysObj.Avatar
+        av_cols = cls.Avatar.ARCHIVED_COLUMNS
+        execute(cls.Avatar.__table__.insert().from_select(
+            av_cols,
+            select([getattr(Avatar, col) for col in av_cols])
+            .where(Avatar.id.in_(av_ids))))
+        # HistoryInput rows follow by cascade
+        return execute(Avatar.__table__.delete()
+                       .where(Avatar.__table__.c.id.in_(av_ids))).rowcount
+
+    @classmethod
+    def archive_operations(cls, cutoff, batch_size=None):
+        """Archive ``done`` Operations that have no inputs nor outcomes left.
+
+        :return: the number of archived Operations
+
+        This is an internal method of :meth:`archive_history`.
+        """
+        Wms = cls.registry.Wms
+        Operation = Wms.Operation
+        HI = Operation.HistoryInput
+        Avatar = Wms.PhysObj.Avatar
+        execute = cls.registry.execute
+        query = (Operation.query(Operation.id)
+                 .filter(Operation.state == 'done',
+                         Operation.dt_execution <= cutoff,
+                         not_(Avatar.query()
+                              .filter(Avatar.outcome_of_id == Operation.id)
+                              .exists()),
+                         not_(HI.query()
+                              .filter(HI.operation_id == Operation.id)
+                              .exists()))
+                 .order_by(Operation.id))
+        if batch_size is not None:
+            query = query.limit(batch_size)
+        op_ids = [row[0] for row in query.all()]
+        if not op_ids:
+            return 0
+
+        op_cols = cls.Operation.ARCHIVED_COLUMNS
+        execute(cls.Operation.__table__.insert().from_select(
+            op_cols,
+            select([getattr(Operation, col) for col in op_cols])
+            .where(Operation.id.in_(op_ids))))
+        # specific tables follow by cascade
+        return execute(Operation.__table__.delete()
+                       .where(Operation.__table__.c.id.in_(op_ids))).rowcount
+
+
+@register(Model.Wms.Archive)
+class Operation:
+    """Archived :class:`Operation
+    <anyblok_wms_base.core.operation.base.Operation>`.
+    """
+    ARCHIVED_COLUMNS = ('id', 'type', 'state', 'comment',
+                        'dt_execution', 'dt_start')
+    """Columns that are copied from the Operation Model."""
+
+    id = Integer(label="Identifier of the Operation", primary_key=True,
+                 autoincrement=False)
+    type = String(label="Operation Type", nullable=False)
+    state = String(label="State of operation", nullable=False)
+    comment = String(label="Comment")
+    dt_execution = DateTime(label="date and time of execution",
+                            nullable=False)
+    dt_start = DateTime(label="date and time of start")
+
+
+@register(Model.Wms.Archive)
+class HistoryInput:
+    """Archived :class:`HistoryInput
+    <anyblok_wms_base.core.operation.base.HistoryInput>`.
+    """
+    operation_id = Integer(primary_key=True, autoincrement=False)
+    avatar_id = Integer(primary_key=True, autoincrement=False, index=True)
+    orig_dt_until = DateTime(label="Original dt_until of avatars")
+
+
+@register(Model.Wms.Archive)
+class Avatar:
+    """Archived :class:`Avatar <anyblok_wms_base.core.physobj.main.Avatar>`.
+    """
+    ARCHIVED_COLUMNS = ('id', 'obj_id', 'state', 'location_id',
+                        'dt_from', 'dt_until', 'outcome_of_id',
+                        'type_id', 'code')
+    """Columns that are copied from the Avatar Model."""
+
+    id = Integer(label="Identifier of the Avatar", primary_key=True,
+                 autoincrement=False)
+    obj_id = Integer(nullable=False, index=True)
+    state = String(label="State of existence", nullable=False)
+    location_id = Integer(nullable=False)
+    dt_from = DateTime(label="Existed from this date & time",
+                       nullable=False)
+    dt_until = DateTime(label="Existed until this date & time")
+    outcome_of_id = Integer(nullable=False, index=True)
+    type_id = Integer()
+    code = Text(label="Copy of the PhysObj code")
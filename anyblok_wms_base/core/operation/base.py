@@ -9,6 +9,14 @@
 
 import logging
 from datetime import datetime, timezone
+from itertools import groupby
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import not_
+from sqlalchemy import orm
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import array
 
 from anyblok import Declarations
 from anyblok.column import String
@@ -18,12 +26,17 @@ from anyblok.column import DateTime
 from anyblok.relationship import Many2One
 
 from anyblok_wms_base.utils import NonZero
-from anyblok_wms_base.constants import OPERATION_STATES, OPERATION_TYPES
+from anyblok_wms_base.constants import (
+    DATE_TIME_INDETERMINATE,
+    OPERATION_STATES,
+    OPERATION_TYPES,
+    )
 from anyblok_wms_base.exceptions import (
     OperationMissingInputsError,
     OperationInputsError,
     OperationInputWrongState,
     OperationError,
+    OperationForbiddenState,
     OperationIrreversibleError,
     )
 
@@ -224,6 +237,12 @@ class Operation:
     occur later at any time, be it sooner or later, as :meth:`execute`
     will in particular correct the value of this field, and its
     consequences on the affected :ref:`Avatars <physobj_avatar>`.
+
+    For ``planned`` Operations, this can also be :data:`DATE_TIME_INDETERMINATE
+    <anyblok_wms_base.constants.DATE_TIME_INDETERMINATE>`, meaning that
+    nothing is known about it. The same goes then for all the
+    Operations that follow, so that executing the first of them doesn't
+    have to shift the others (see :meth:`alter_dt_execution`).
     """
 
     dt_start = DateTime(label="date and time of start")
@@ -364,6 +383,107 @@ class Operation:
         op.after_insert()
         return op
 
+    @classmethod
+    def create_batch(cls, items, state='planned', dt_execution=None):
+        """Create many Operations of the present class at once.
+
+        :param items: iterable of pairs ``(inputs, fields)``, each giving
+                      rise to an Operation, as ``create(inputs=inputs,
+                      **fields)`` would.
+        :param state: common to all created Operations, same as in
+                      :meth:`create`.
+        :param dt_execution: common to all created Operations. Defaults
+                             are as in :meth:`create`, taking all inputs into
+                             account.
+        :return: the list of created Operations, in the order of ``items``.
+
+        The same checks are performed as in :meth:`create`, and an Avatar
+        can't be the input of several items (see :meth:`check_batch_inputs`).
+
+        The Operations and their links to inputs are inserted in one single
+        flush,
+        with primary keys reserved beforehand (see
+        :meth:`Wms.reserve_ids() <anyblok_wms_base.core.wms.Wms.reserve_ids>`),
+        so that SQLAlchemy can group the ``INSERT`` statements.
+
+        The specific logic performed by :meth:`after_insert` is done by
+        :meth:`after_insert_batch`, that subclasses can override
+        for better performance.
+        """
+        items = [(inputs, fields) for inputs, fields in items]
+        if not items:
+            return []
+        cls.check_batch_inputs(items)
+        if dt_execution is None:
+            dt_execution = cls.default_dt_execution(
+                state, [av for inputs, _ in items for av in inputs or ()])
+
+        HI = cls.registry.Wms.Operation.HistoryInput
+        ids = cls.registry.Wms.reserve_ids(cls.registry.Wms.Operation,
+                                           len(items))
+        created = []
+        for op_id, (inputs, fields) in zip(ids, items):
+            cls.check_create_conditions(
+                state, dt_execution, inputs=inputs, **fields)
+            inputs, fields_upd = cls.before_insert(state=state,
+                                                   inputs=inputs,
+                                                   dt_execution=dt_execution,
+                                                   dt_start=None,
+                                                   **fields)
+            if fields_upd is not None:
+                fields = dict(fields, **fields_upd)
+            op = cls(id=op_id, state=state, dt_execution=dt_execution,
+                     **fields)
+            cls.registry.add(op)
+            for avatar in inputs or ():
+                cls.registry.add(HI(avatar=avatar,
+                                    operation=op,
+                                    orig_dt_until=avatar.dt_until))
+            created.append((op, inputs))
+
+        cls.after_insert_batch(created)
+        cls.registry.flush()
+        return [op for op, _ in created]
+
+    @classmethod
+    def check_batch_inputs(cls, items):
+        """Check that no Avatar is the input of several items of a batch.
+
+        :param items: same as in :meth:`create_batch`
+        :raises: OperationInputsError
+
+        This can't be caught by :meth:`check_create_conditions`, which
+        sees the items one at a time.
+        """
+        seen = set()
+        duplicates = []
+        for inputs, _ in items:
+            for avatar in inputs or ():
+                if avatar.id in seen:
+                    duplicates.append(avatar)
+                seen.add(avatar.id)
+        if duplicates:
+            raise OperationInputsError(
+                cls,
+                "Some inputs are used by several items of the batch: "
+                "{inputs}", inputs=duplicates)
+
+    @classmethod
+    def after_insert_batch(cls, created):
+        """Perform specific logic after insertion in :meth:`create_batch`.
+
+        :param created: list of pairs ``(operation, inputs)``, where
+                        ``inputs`` is as passed to :meth:`create_batch`.
+                        The Operations and their links to inputs may not be
+                        flushed yet.
+
+        This default implementation flushes and calls :meth:`after_insert`
+        on each Operation.
+        """
+        cls.registry.flush()
+        for op, _ in created:
+            op.after_insert()
+
     @classmethod
     def default_dt_execution(cls, state, inputs):
         """Compute a default date and time of execution.
@@ -469,7 +589,8 @@ class Operation:
     def plan_revert(self, dt_execution=None):
         """Plan operations to revert the present one and its consequences.
 
-        Like :meth:`cancel`, this method is recursive, but it applies only
+        Like :meth:`cancel`, this method applies to all the followers of
+        the present Operation, transitively, but it applies only
         to operations that are in the 'done' state.
 
         It is expected that some operations can't be reverted, because they
@@ -487,39 +608,93 @@ class Operation:
         :return: the operation reverting the present one, and
                  the list of initial operations to be executed to actually
                  start reversing the whole.
+
+        See :meth:`plan_revert_map` for the underlying implementation.
+        """
+        reversals, exec_leafs = self.plan_revert_map(
+            dt_execution=dt_execution)
+        this_reversal = reversals[self]
+        logger.info("Planned reversal of operation %r. "
+                    "Execution starts with %r", self, exec_leafs)
+        return this_reversal, exec_leafs
+
+    def plan_revert_map(self, dt_execution=None):
+        """Plan reversals of the present Operation and all its followers.
+
+        :param datetime dt_execution:
+           the time at which to plan the reversal operations.
+           If not supplied, the current date and time will be used.
+        :return: a :class:`dict` whose keys are the present Operation and
+                 its transitive followers, and values their reversals,
+                 together with the list of initial reversals to be
+                 executed, i.e., those of the followers that don't have
+                 followers themselves.
+
+        The followers are fetched, together with their depths, in one single
+        query (see :meth:`transitive_followers_query`), and they are all
+        checked before anything gets planned. Then reversals are planned
+        from the deepest followers up to the present Operation, with one
+        flush per level of depth. This is done without recursion, and
+        therefore doesn't fear :class:`RecursionError` on huge histories.
         """
         if dt_execution is None:
             dt_execution = datetime.now(tz=UTC)
-        if self.state != 'done':
-            # TODO actually it'd be nice to cancel or update
-            # planned operations (think of reverting a Move meant for
-            # organisation, but keeping an Unpack that was scheduled
-            # afterwards)
-            raise OperationError(
-                self,
-                "Can't plan reversal of {op} because "
-                "its state {op.state!r} is not 'done'", op=self)
-        if not self.is_reversible():
-            raise OperationIrreversibleError(self)
-
-        logger.debug("Planning reversal of operation %r", self)
+        Wms = self.registry.Wms
+        Operation = Wms.Operation
+        HI = Operation.HistoryInput
+        Avatar = Wms.PhysObj.Avatar
+        query = self.registry.query
+        self.registry.flush()
 
+        followers = self.transitive_followers_query().subquery()
+        levels = {op_id: depth
+                  for op_id, depth in (query(followers.c.op_id,
+                                             func.max(followers.c.depth))
+                                       .group_by(followers.c.op_id)
+                                       .all())}
+        # ordering by id for reproducibility
+        ops = sorted(Operation.query()
+                     .filter(Operation.id.in_(levels.keys())).all(),
+                     key=lambda op: (levels[op.id], op.id))
+        for op in ops:
+            if op.state != 'done':
+                # TODO actually it'd be nice to cancel or update
+                # planned operations (think of reverting a Move meant for
+                # organisation, but keeping an Unpack that was scheduled
+                # afterwards)
+                raise OperationError(
+                    op,
+                    "Can't plan reversal of {op} because "
+                    "its state {op.state!r} is not 'done'", op=op)
+            if not op.is_reversible():
+                raise OperationIrreversibleError(op)
+
+        direct_followers = {}
+        for op_id, fol_id in (query(Avatar.outcome_of_id, HI.operation_id)
+                              .select_from(HI)
+                              .join(Avatar, Avatar.id == HI.avatar_id)
+                              .filter(Avatar.outcome_of_id.in_(levels.keys()))
+                              .distinct()
+                              .order_by(HI.operation_id)):
+            direct_followers.setdefault(op_id, []).append(fol_id)
+
+        logger.debug("Planning reversal of operation %r and its %d followers",
+                     self, len(ops) - 1)
+        reversals = {}
+        by_id = {}
         exec_leafs = []
-        followers_reverts = []
-        for follower in self.followers:
-            follower_revert, follower_exec_leafs = follower.plan_revert(
-                dt_execution=dt_execution)
+        for level, level_ops in groupby(reversed(ops),
+                                        key=lambda op: levels[op.id]):
+            for op in level_ops:
+                follows = [by_id[fol_id]
+                           for fol_id in direct_followers.get(op.id, ())]
+                reversal = op.plan_revert_single(dt_execution,
+                                                 follows=follows)
+                by_id[op.id] = reversals[op] = reversal
+                if not follows:
+                    exec_leafs.append(reversal)
             self.registry.flush()
-            followers_reverts.append(follower_revert)
-            exec_leafs.extend(follower_exec_leafs)
-        this_reversal = self.plan_revert_single(dt_execution,
-                                                follows=followers_reverts)
-        self.registry.flush()
-        if not exec_leafs:
-            exec_leafs.append(this_reversal)
-        logger.info("Planned reversal of operation %r. "
-                    "Execution starts with %r", self, exec_leafs)
-        return this_reversal, exec_leafs
+        return reversals, exec_leafs
 
     def obliviate(self):
         """Totally forget about an executed Operation and all its consequences.
@@ -617,10 +792,28 @@ class Operation:
           with :attr:`inputs_number`, and
         - that they are all in the proper
           state for the wished :attr:`Operation state <state>`.
+        - that an :data:`indeterminate
+          <anyblok_wms_base.constants.DATE_TIME_INDETERMINATE>`
+          ``dt_execution`` is used only in the ``planned`` state, and
+          only if all inputs are determinate.
 
         Subclasses are welcome to override this, and will probably want to
         call it back, using ``super``.
         """
+        if dt_execution == DATE_TIME_INDETERMINATE:
+            if state != 'planned':
+                raise OperationForbiddenState(
+                    cls, "Can't create in state {forbidden!r} with an "
+                    "indeterminate date and time of execution",
+                    forbidden=state)
+        elif inputs and any(av.dt_from == DATE_TIME_INDETERMINATE
+                            for av in inputs):
+            raise OperationInputsError(
+                cls,
+                "Some of the inputs {inputs} are indeterminate, hence the "
+                "date and time of execution {dt_execution} must be, too",
+                inputs=inputs, dt_execution=dt_execution)
+
         expected = cls.inputs_number
         if not inputs:  # to include None
             if expected:
@@ -824,17 +1017,75 @@ class Operation:
 
         The followers' :meth:`input_location_altered` will be
         called (will potentially recurse)
+
+        This is a special case of :meth:`alter_destination_batch`.
         """
-        self.check_alterable()
-        dest_field = self.destination_field
-        if dest_field is None:
-            raise OperationError(
-                self, "Operations of this type don't have responsibility "
-                "over their outcomes locations. Fields: {op}", op=self)
-        setattr(self, dest_field, destination)
-        for outcome in self.outcomes:
-            outcome.location = destination
-        for follower in self.followers:
+        self.alter_destination_batch({self: destination})
+
+    @classmethod
+    def alter_destination_batch(cls, destinations):
+        """Change the destinations of many planned Operations at once.
+
+        :param dict destinations: new destinations, keyed by the Operations
+                                  to alter. These can be of different
+                                  classes.
+
+        The outcomes of all Operations are updated with a single UPDATE
+        statement, then the :meth:`input_location_altered` method of
+        each of their distinct followers is called once, in topological
+        order (followers of in-place followers will still be notified
+        by them, though).
+
+        This is meant for mass replanifications, such as sending a
+        whole wave of planned Operations to another dock.
+        """
+        if not destinations:
+            return
+        # validate everything before altering anything
+        for op in destinations:
+            op.check_alterable()
+            if op.destination_field is None:
+                raise OperationError(
+                    op, "Operations of this type don't have responsibility "
+                    "over their outcomes locations. Fields: {op}", op=op)
+        for op, destination in destinations.items():
+            setattr(op, op.destination_field, destination)
+        Wms = cls.registry.Wms
+        Operation = Wms.Operation
+        HI = Operation.HistoryInput
+        Avatar = Wms.PhysObj.Avatar
+        cls.registry.flush()
+
+        op_ids = [op.id for op in destinations]
+        new_locations = select([
+            func.unnest(array(op_ids)).label('op_id'),
+            func.unnest(array([loc.id for loc in destinations.values()]))
+            .label('location_id')]).alias('new_locations')
+        av_table = Avatar.__table__
+        cls.registry.execute(
+            av_table.update()
+            .where(av_table.c.outcome_of_id == new_locations.c.op_id)
+            .values(location_id=new_locations.c.location_id))
+        altered = set(op_ids)
+        for obj in list(cls.registry.session.identity_map.values()):
+            if isinstance(obj, Avatar) and obj.outcome_of_id in altered:
+                obj.expire('location_id', 'location')
+
+        fol_ids = (cls.registry.query(HI.operation_id)
+                   .join(Avatar, Avatar.id == HI.avatar_id)
+                   .filter(Avatar.outcome_of_id.in_(op_ids))
+                   .distinct())
+        followers = cls.query_transitive_followers(op_ids).subquery()
+        levels = (cls.registry.query(followers.c.op_id,
+                                     func.max(followers.c.depth)
+                                     .label('level'))
+                  .group_by(followers.c.op_id)
+                  .subquery())
+        topological = (Operation.query()
+                       .join(levels, levels.c.op_id == Operation.id)
+                       .filter(Operation.id.in_(fol_ids))
+                       .order_by(levels.c.level, Operation.id))
+        for follower in topological.all():
             follower.input_location_altered()
 
     def alter_dt_execution(self, new_dt):
@@ -843,7 +1094,7 @@ class Operation:
         :param datetime new_dt: new value for the :attr:`dt_execution` field.
 
         This method takes care to maintain consistency by changing the
-        outcomes date/time fields and recurse to the followers if
+        outcomes date/time fields and propagating to the followers if
         needed.
 
         This basic implementation is minimal in that all it cares about
@@ -853,45 +1104,140 @@ class Operation:
         won't hesitate to produce Avatars with a zero time span (which will be
         rewritten later anyway). This has the advantage of not being too slow.
 
+        Since the new value is propagated unchanged, the affected followers
+        are fetched in one query (see :meth:`transitive_followers_query`) and
+        all Avatars and Operations are updated in bulk, whatever the length of
+        the chains of planned Operations. In the common case where no
+        follower is affected, only the inputs and outcomes are updated
+        (see :meth:`alter_dt_execution_single`).
+
         This is typically called by :meth:`execute` and :meth:`start`
         but applications really caring about planned execution times can also
         make use of this (they may also want a true propagation to occur,
         which is not supported yet, but that's a different story)
         """
         self.check_alterable()
-        self.dt_execution = new_dt
-        for av in self.inputs:
+        Wms = self.registry.Wms
+        Operation = Wms.Operation
+        HI = Operation.HistoryInput
+        Avatar = Wms.PhysObj.Avatar
+        self.registry.flush()
+
+        # followers planned before new_dt have to be altered, and so on
+        affected = self.transitive_followers_query(
+            Operation.dt_execution < new_dt).subquery()
+        followers = (Operation.query()
+                     .filter(Operation.id.in_(
+                         self.registry.query(affected.c.op_id)))
+                     .filter(Operation.id != self.id)
+                     .all())
+        if not followers:
+            self.alter_dt_execution_single(new_dt)
+            return
+        for follower in followers:
+            follower.check_alterable()
+        op_ids = [self.id] + [follower.id for follower in followers]
+
+        # inputs coming from outside of the affected Operations are
+        # the only ones whose dt_from is not about to change
+        too_late = (HI.query(HI.operation_id)
+                    .join(Avatar, HI.avatar_id == Avatar.id)
+                    .filter(HI.operation_id.in_(op_ids),
+                            not_(Avatar.outcome_of_id.in_(op_ids)),
+                            Avatar.dt_from > new_dt)
+                    .first())
+        if too_late is not None:
+            # TODO more precise exc
+            raise OperationError(Operation.query().get(too_late[0]),
+                                 "Can't alter dt_execution to "
+                                 "before input presence time")
+
+        (Operation.query().filter(Operation.id.in_(op_ids))
+         .update({Operation.dt_execution: new_dt},
+                 synchronize_session='fetch'))
+        # minimal consistent change for outcomes whose follower is not
+        # affected, a NULL dt_until staying as it is
+        (Avatar.query().filter(Avatar.outcome_of_id.in_(op_ids))
+         .update({Avatar.dt_from: new_dt,
+                  Avatar.dt_until: case([(Avatar.dt_until < new_dt, new_dt)],
+                                        else_=Avatar.dt_until)},
+                 synchronize_session='fetch'))
+        (Avatar.query()
+         .filter(Avatar.id.in_(self.registry.query(HI.avatar_id)
+                               .filter(HI.operation_id.in_(op_ids))))
+         .update({Avatar.dt_until: new_dt},
+                 synchronize_session='fetch'))
+
+    def alter_dt_execution_single(self, new_dt):
+        """Change :attr:`dt_execution`, assuming no follower is affected.
+
+        This is the cheap path of :meth:`alter_dt_execution`, for the
+        common case where the followers are already planned at or after
+        ``new_dt``: only the inputs and outcomes of ``self`` are updated,
+        with the minimal consistent change.
+        """
+        Avatar = self.registry.Wms.PhysObj.Avatar
+        HI = self.registry.Wms.Operation.HistoryInput
+        inputs = (Avatar.query()
+                  .join(HI, HI.avatar_id == Avatar.id)
+                  .filter(HI.operation_id == self.id)
+                  .all())
+        for av in inputs:
             if av.dt_from > new_dt:
                 # TODO more precise exc
                 raise OperationError(self,
                                      "Can't alter dt_execution to "
                                      "before input presence time")
+        self.dt_execution = new_dt
+        for av in inputs:
             av.dt_until = new_dt
-        Wms = self.registry.Wms
+        for av in self.outcomes:
+            av.dt_from = new_dt
+            if av.dt_until is not None:
+                av.dt_until = max(av.dt_until, new_dt)
+
+    def transitive_followers_query(self, *criteria):
+        """Query for the ids of self and its transitive followers.
+
+        :param criteria: SQL conditions on the ``Operation`` Model that the
+                         followers must fulfill to be included and recursed
+                         into.
+        :return: a query whose results have an ``op_id`` and a ``depth``
+                 columns, the latter being the length of a path from ``self``
+                 (``0`` for ``self``). An Operation that can be reached in
+                 several ways appears several times.
+
+        This is done in one single recursive SQL query, hence without
+        fear of recursion limits.
+        """
+        return self.query_transitive_followers((self.id, ), *criteria)
+
+    @classmethod
+    def query_transitive_followers(cls, op_ids, *criteria):
+        """Query for the ids of some Operations and their transitive followers.
+
+        :param op_ids: ids of the starting Operations, whose depth is ``0``.
+
+        Otherwise, this is the same as :meth:`transitive_followers_query`.
+        """
+        Wms = cls.registry.Wms
         Operation = Wms.Operation
         HI = Operation.HistoryInput
         Avatar = Wms.PhysObj.Avatar
-        res = (self.registry.query(Avatar)
-               .filter_by(outcome_of=self)
-               .outerjoin(HI, HI.avatar_id == Avatar.id)
-               .outerjoin(Operation, HI.operation_id == Operation.id)
-               .add_entity(Operation)
-               .all()
-               )
-        followers = {}  # op -> input avatars
-        for av, op in res:  # TODO better use an array_agg or something
-            followers.setdefault(op, []).append(av)
-
-        for follower, avs in followers.items():
-            for av in avs:
-                av.dt_from = new_dt
-                dt_until = av.dt_until
-                if dt_until is not None:
-                    # minimal consistent change (follower's alteration
-                    # could change it further)
-                    av.dt_until = max(dt_until, new_dt)
-            if follower is not None and new_dt > follower.dt_execution:
-                follower.alter_dt_execution(new_dt)
+        query = cls.registry.query
+
+        followers = (query(Operation.id.label('op_id'),
+                           literal(0).label('depth'))
+                     .filter(Operation.id.in_(op_ids))
+                     .cte('followers', recursive=True))
+        parent = orm.aliased(followers, name='parent')
+        tail = (query(HI.operation_id, parent.c.depth + 1)
+                .join(Avatar, Avatar.id == HI.avatar_id)
+                .join(parent, parent.c.op_id == Avatar.outcome_of_id)
+                .join(Operation, Operation.id == HI.operation_id)
+                .filter(*criteria))
+        followers = followers.union(tail)
+        return query(followers.c.op_id, followers.c.depth)
 
     def transitive_followers(self, seen=None):
         """Return a list of transitive followers, in execution order
@@ -37,6 +37,12 @@ class Disparition(Mixin.WmsSingleInputOperation,
         self.input.update(dt_until=self.dt_execution,
                           state='past')
 
+    @classmethod
+    def after_insert_batch(cls, created):
+        """Same as :meth:`after_insert`, without any query nor flush."""
+        for op, inputs in created:
+            inputs[0].update(dt_until=op.dt_execution, state='past')
+
     def obliviate_single(self):
         self.reset_inputs_original_values(state='present')
         self.registry.flush()
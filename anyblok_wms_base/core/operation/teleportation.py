@@ -62,15 +62,34 @@ class Teleportation(Mixin.WmsSingleInputOperation,
         - a new ``present`` Avatar gets created at :attr:`new_location`,
         - care is taken of date & time fields.
         """
-        to_move, dt_exec = self.input, self.dt_execution
+        self.registry.add(self.teleport(self.input))
+        self.registry.flush()
 
+    def teleport(self, to_move, **fields):
+        """Update the given input Avatar and return the new one (not added).
+
+        :param fields: additional fields for the new Avatar, such as its id.
+        """
+        dt_exec = self.dt_execution
         orig_dt_until = to_move.dt_until
         to_move.update(dt_until=dt_exec, state='past')
-        self.registry.Wms.PhysObj.Avatar.insert(
+        return self.registry.Wms.PhysObj.Avatar(
             location=self.new_location,
             outcome_of=self,
             state='present',
             dt_from=dt_exec,
             # copied fields:
             dt_until=orig_dt_until,
-            obj=to_move.obj)
+            obj=to_move.obj,
+            **fields)
+
+    @classmethod
+    def after_insert_batch(cls, created):
+        """Same as :meth:`after_insert`, without any query nor flush.
+
+        The ids of the new Avatars are reserved in one query.
+        """
+        Wms = cls.registry.Wms
+        ids = Wms.reserve_ids(Wms.PhysObj.Avatar, len(created))
+        for av_id, (op, inputs) in zip(ids, created):
+            cls.registry.add(op.teleport(inputs[0], id=av_id))
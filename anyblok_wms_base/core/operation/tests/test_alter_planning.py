@@ -9,8 +9,13 @@
 from datetime import timedelta
 from sqlalchemy import func
 from anyblok_wms_base.testing import WmsTestCaseWithPhysObj
+from anyblok_wms_base.constants import (
+    DATE_TIME_INDETERMINATE,
+    DATE_TIME_INFINITY,
+    )
 from anyblok_wms_base.exceptions import (
     OperationError,
+    OperationForbiddenState,
     OperationInputsError,
     )
 
@@ -87,6 +92,132 @@ class TestAlterPlanning(WmsTestCaseWithPhysObj):
         self.assertEqual(dep_input.dt_until, new_dt)
         self.assertEqual(dep.dt_execution, new_dt)
 
+    def test_alter_dt_execution_long_chain(self):
+        moves = []
+        avatar = self.avatar
+        for i in range(30):
+            # the last ones are planned after the new date of execution
+            dt_exec = self.dt_test2 if i < 20 else self.dt_test3
+            move = self.Move.create(destination=self.stock,
+                                    dt_execution=dt_exec,
+                                    state='planned',
+                                    input=avatar)
+            moves.append(move)
+            avatar = move.outcome
+
+        head = moves[0]
+        self.assertEqual(
+            set(op_id for op_id, depth in head.transitive_followers_query()),
+            set(move.id for move in moves))
+        self.assertEqual(
+            max(depth for op_id, depth in head.transitive_followers_query()),
+            29)
+
+        new_dt = self.dt_test2 + timedelta(hours=1)
+        head.alter_dt_execution(new_dt)
+
+        for i, move in enumerate(moves):
+            outcome = move.outcome
+            if i < 20:
+                self.assertEqual(move.dt_execution, new_dt)
+                self.assertEqual(move.input.dt_until, new_dt)
+                self.assertEqual(outcome.dt_from, new_dt)
+            else:
+                self.assertEqual(move.dt_execution, self.dt_test3)
+                self.assertEqual(outcome.dt_from, self.dt_test3)
+        self.assertEqual(moves[19].outcome.dt_until, self.dt_test3)
+        self.assertIsNone(moves[-1].outcome.dt_until)
+
+        # followers planned later aren't affected: cheap path
+        moves[20].alter_dt_execution(self.dt_test3 - timedelta(hours=1))
+        self.assertEqual(moves[20].dt_execution,
+                         self.dt_test3 - timedelta(hours=1))
+        self.assertEqual(moves[20].outcome.dt_from, moves[20].dt_execution)
+        self.assertEqual(moves[20].input.dt_until, moves[20].dt_execution)
+        self.assertEqual(moves[21].dt_execution, self.dt_test3)
+
+    def test_alter_dt_execution_check_followers(self):
+        """All affected followers are asked if they can be altered."""
+        first = self.Move.create(destination=self.stock,
+                                 dt_execution=self.dt_test2,
+                                 state='planned',
+                                 input=self.avatar)
+        second = self.Move.create(destination=self.stock,
+                                  dt_execution=self.dt_test2,
+                                  state='planned',
+                                  input=first.outcome)
+
+        def check_alterable():
+            raise OperationError(second, "Not alterable")
+        second.check_alterable = check_alterable
+
+        with self.assertRaises(OperationError):
+            first.alter_dt_execution(self.dt_test3)
+
+    def test_indeterminate_chain(self):
+        outgoing = self.insert_location('OUTGOING')
+        incoming = self.incoming_loc
+        stock = self.stock
+        indet_type = self.PhysObj.Type.insert(code='INDET')
+        arrival = self.Operation.Arrival.create(
+            physobj_type=indet_type,
+            location=incoming,
+            state='planned',
+            dt_execution=DATE_TIME_INDETERMINATE)
+        move1 = self.Move.create(input=arrival.outcome,
+                                 destination=stock,
+                                 state='planned')
+        move2 = self.Move.create(input=move1.outcome,
+                                 destination=outgoing,
+                                 state='planned')
+        # indeterminacy propagates by default
+        for op in (move1, move2):
+            self.assertEqual(op.dt_execution, DATE_TIME_INDETERMINATE)
+
+        def assert_quantities(at_datetime, *expected):
+            for loc, qty in zip((incoming, stock, outgoing), expected):
+                self.assert_quantity(qty, location=loc,
+                                     physobj_type=indet_type,
+                                     additional_states=['past', 'future'],
+                                     at_datetime=at_datetime)
+
+        assert_quantities(self.dt_test3, 0, 0, 0)
+        assert_quantities(DATE_TIME_INFINITY, 0, 0, 1)
+
+        arrival.execute(dt_execution=self.dt_test1)
+        arrived = arrival.outcome
+        self.assertEqual(arrived.dt_from, self.dt_test1)
+        self.assertEqual(arrived.dt_until, DATE_TIME_INDETERMINATE)
+        # no shift of the followers
+        self.assertEqual(move1.dt_execution, DATE_TIME_INDETERMINATE)
+        self.assertEqual(move2.dt_execution, DATE_TIME_INDETERMINATE)
+        assert_quantities(self.dt_test3, 1, 0, 0)
+        assert_quantities(DATE_TIME_INFINITY, 0, 0, 1)
+
+        move1.execute(dt_execution=self.dt_test2)
+        self.assertEqual(move1.outcome.dt_until, DATE_TIME_INDETERMINATE)
+        self.assertEqual(move2.dt_execution, DATE_TIME_INDETERMINATE)
+        assert_quantities(self.dt_test1, 1, 0, 0)
+        assert_quantities(self.dt_test3, 0, 1, 0)
+        assert_quantities(DATE_TIME_INFINITY, 0, 0, 1)
+
+    def test_indeterminate_errors(self):
+        arrival_kw = dict(physobj_type=self.physobj_type,
+                          location=self.incoming_loc,
+                          dt_execution=DATE_TIME_INDETERMINATE)
+        with self.assertRaises(OperationForbiddenState) as arc:
+            self.Operation.Arrival.create(state='done', **arrival_kw)
+        self.assertEqual(arc.exception.kwargs['forbidden'], 'done')
+
+        arrival = self.Operation.Arrival.create(state='planned',
+                                                **arrival_kw)
+        with self.assertRaises(OperationInputsError) as arc:
+            self.Move.create(input=arrival.outcome,
+                             destination=self.stock,
+                             dt_execution=self.dt_test3,
+                             state='planned')
+        self.assertEqual(arc.exception.kwargs['dt_execution'], self.dt_test3)
+
     def test_alter_destination_before_unpack(self):
         incoming = self.incoming_loc
         stock = self.stock
@@ -222,6 +353,68 @@ class TestAlterPlanning(WmsTestCaseWithPhysObj):
         # but its location now has changed
         self.assertEqual(ass_out.location, stock)
 
+    def test_alter_destination_batch(self):
+        Arrival = self.Operation.Arrival
+        incoming = self.incoming_loc
+        stock = self.stock
+        dock = self.insert_location('DOCK')
+        arrivals = [self.arrival] + [
+            Arrival.create(physobj_type=self.physobj_type,
+                           location=incoming,
+                           state='planned',
+                           dt_execution=self.dt_test1)
+            for _ in range(2)]
+        moves = [self.Move.create(input=arrival.outcome,
+                                  destination=stock,
+                                  dt_execution=self.dt_test2,
+                                  state='planned')
+                 for arrival in arrivals]
+        assembled_type = self.PhysObj.Type.insert(
+            code="ASSEMBLED",
+            behaviours=dict(assembly=dict(default=dict(inputs=[
+                dict(type=self.physobj_type.code, quantity=2)]))))
+        ass = self.Operation.Assembly.create(
+            inputs=[moves[0].outcome, moves[1].outcome],
+            name='default',
+            dt_execution=self.dt_test3,
+            outcome_type=assembled_type)
+        dep = self.Operation.Departure.create(input=moves[2].outcome,
+                                              dt_execution=self.dt_test3)
+
+        record_callbacks = []
+
+        def recording(op):
+            orig = op.input_location_altered
+
+            def input_location_altered():
+                record_callbacks.append(op)
+                orig()
+            op.input_location_altered = input_location_altered
+
+        recording(ass)
+        recording(dep)
+
+        # nothing is altered if one of the entries is invalid
+        with self.assertRaises(OperationError):
+            self.Move.alter_destination_batch({moves[0]: dock, dep: dock})
+        self.assertEqual(moves[0].destination, stock)
+
+        # separate alterations would be inconsistent for the Assembly
+        self.Move.alter_destination_batch({move: dock for move in moves})
+
+        for move in moves:
+            self.assertEqual(move.destination, dock)
+            self.assertEqual(move.outcome.location, dock)
+        self.assertEqual(ass.outcome.location, dock)
+        # each follower notified once, in topological order
+        self.assertEqual(record_callbacks, [ass, dep])
+
+        arrivals[0].execute(self.dt_test1)
+        with self.assertRaises(OperationError) as arc:
+            Arrival.alter_destination_batch({arrivals[0]: stock,
+                                             arrivals[1]: stock})
+        self.assertEqual(arc.exception.operation, arrivals[0])
+
     def test_refine_with_trailing_move_inapplicable(self):
         op = self.Operation.Observation.create(input=self.avatar)
         with self.assertRaises(OperationError) as arc:
@@ -10,6 +10,7 @@ from anyblok_wms_base.testing import WmsTestCaseWithPhysObj
 from anyblok_wms_base.exceptions import (
     OperationIrreversibleError,
     OperationForbiddenState,
+    OperationInputsError,
 )
 
 
@@ -47,6 +48,31 @@ class TestDisparition(WmsTestCaseWithPhysObj):
         self.assertEqual(avatar.state, 'present')
         self.assertIsNone(avatar.dt_until)
 
+    def test_create_batch(self):
+        self.avatar.state = 'present'
+        other = self.Operation.Arrival.create(
+            state='done', location=self.incoming_loc,
+            dt_execution=self.dt_test1,
+            physobj_type=self.physobj_type).outcome
+        inputs = (self.avatar, other)
+        disps = self.Disparition.create_batch(
+            [((av, ), {}) for av in inputs],
+            state='done', dt_execution=self.dt_test2)
+        self.assertEqual([disp.input for disp in disps], list(inputs))
+        for avatar in inputs:
+            self.assertEqual(avatar.state, 'past')
+            self.assertEqual(avatar.dt_until, self.dt_test2)
+        self.assertEqual(self.Disparition.create_batch(()), [])
+
+    def test_create_batch_duplicate_inputs(self):
+        self.avatar.state = 'present'
+        with self.assertRaises(OperationInputsError) as arc:
+            self.Disparition.create_batch(
+                [((self.avatar, ), {}), ((self.avatar, ), {})],
+                state='done', dt_execution=self.dt_test2)
+        self.assertEqual(arc.exception.kwargs['inputs'], [self.avatar])
+        self.assertEqual(self.Disparition.query().count(), 0)
+
     def test_no_planned_state(self):
         avatar = self.avatar
         avatar.state = 'present'
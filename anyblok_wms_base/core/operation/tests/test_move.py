@@ -50,6 +50,15 @@ class TestMove(WmsTestCaseWithPhysObj):
                          .count(),
                          0)
 
+    def test_create_batch_planned(self):
+        """create_batch() plans by default, as create() does."""
+        move = self.assert_singleton(self.Move.create_batch(
+            [((self.avatar, ), dict(destination=self.stock))],
+            dt_execution=self.dt_test2))
+        self.assertEqual(move.state, 'planned')
+        self.assertEqual(move.outcome.state, 'future')
+        self.assertEqual(self.avatar.state, 'future')
+
     def test_done(self):
         self.avatar.update(state='present')
         move = self.Move.create(destination=self.stock,
@@ -235,6 +235,36 @@ class TestOperation(WmsTestCase):
         self.assertIsNone(avatar.dt_until)
         self.assertEqual(avatar.location, self.incoming_loc)
 
+    def test_plan_revert_map_long_chain(self):
+        arrival = self.Operation.Arrival.create(physobj_type=self.physobj_type,
+                                                location=self.incoming_loc,
+                                                dt_execution=self.dt_test1,
+                                                state='done')
+        Move = self.Operation.Move
+        moves = []
+        avatar = arrival.outcome
+        for i in range(40):
+            move = Move.create(input=avatar,
+                               dt_execution=self.dt_test2,
+                               destination=(self.stock if i % 2
+                                            else self.incoming_loc),
+                               state='done')
+            moves.append(move)
+            avatar = move.outcome
+
+        rev_dt = self.dt_test3 + timedelta(seconds=10)
+        reversals, exec_leafs = moves[0].plan_revert_map(dt_execution=rev_dt)
+        self.assertEqual(set(reversals), set(moves))
+        # reversals of the deepest followers come first
+        self.assertEqual(list(reversals), list(reversed(moves)))
+        self.assertEqual(exec_leafs, [reversals[moves[-1]]])
+        for move, next_move in zip(moves, moves[1:]):
+            rev = reversals[move]
+            self.assertEqual(rev.state, 'planned')
+            self.assertEqual(rev.dt_execution, rev_dt)
+            self.assertEqual(rev.destination, move.input.location)
+            self.assert_singleton(rev.follows, value=reversals[next_move])
+
     def test_plan_revert_recurse_wrong_state(self):
         arrival = self.Operation.Arrival.create(physobj_type=self.physobj_type,
                                                 location=self.incoming_loc,
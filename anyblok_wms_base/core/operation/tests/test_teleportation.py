@@ -53,6 +53,38 @@ class TestTeleportation(WmsTestCaseWithPhysObj):
         self.assertEqual(
             self.Avatar.query().filter_by(obj=avatar.obj).count(), 1)
 
+    def test_create_batch(self):
+        other = self.Operation.Arrival.create(
+            state='done', location=self.incoming_loc,
+            dt_execution=self.dt_test1,
+            physobj_type=self.physobj_type).outcome
+        inputs = (self.avatar, other)
+        teleps = self.Teleportation.create_batch(
+            [((av, ), dict(new_location=self.stock)) for av in inputs],
+            state='done', dt_execution=self.dt_test2)
+        self.assertEqual(len(teleps), 2)
+        for telep, avatar in zip(teleps, inputs):
+            self.assertEqual(telep.state, 'done')
+            self.assertEqual(telep.input, avatar)
+            self.assertEqual(avatar.state, 'past')
+            self.assertEqual(avatar.dt_until, self.dt_test2)
+            outcome = self.assert_singleton(telep.outcomes)
+            self.assertEqual(outcome.state, 'present')
+            self.assertEqual(outcome.location, self.stock)
+            self.assertEqual(outcome.obj, avatar.obj)
+            self.assertEqual(outcome.dt_from, self.dt_test2)
+
+        # history is as with create()
+        teleps[0].obliviate()
+        self.assertEqual(self.avatar.state, 'present')
+
+    def test_create_batch_not_a_container(self):
+        wrong_loc = self.PhysObj.insert(type=self.physobj_type)
+        with self.assertRaises(OperationContainerExpected):
+            self.Teleportation.create_batch(
+                [((self.avatar, ), dict(new_location=wrong_loc))],
+                state='done')
+
     def test_no_planned_state(self):
         avatar = self.avatar
         avatar.state = 'present'
@@ -11,6 +11,8 @@ import warnings
 
 from sqlalchemy import CheckConstraint
 from sqlalchemy import Index
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex, DropIndex
 from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy import orm
 from sqlalchemy import or_
@@ -664,6 +666,9 @@ class Avatar:
       <anyblok_wms_base.core.location.Location.quantity>`.
       If the end application does serious time prediction, it can use it
       freely.
+      It is :data:`DATE_TIME_INDETERMINATE
+      <anyblok_wms_base.constants.DATE_TIME_INDETERMINATE>` for the
+      outcomes of Operations whose execution time is not known at all.
 
     In all cases, this doesn't mean that the very same PhysObj aren't present
     at an earlier time with the same state, location, etc. That earlier time
@@ -695,6 +700,23 @@ class Avatar:
     """The Operation that created this Avatar.
     """
 
+    type = Many2One(model='Model.Wms.PhysObj.Type')
+    """Copy of the :attr:`type <PhysObj.type>` of :attr:`obj`.
+
+    This is filled automatically at insertion time (see
+    :meth:`before_insert_orm_event`), so that quantity queries, which
+    group or filter on the Type, can be done on the Avatars table
+    only. As the Type of a PhysObj never changes, there's no need to
+    maintain it further.
+    """
+
+    code = Text(label="Copy of the PhysObj code")
+    """Copy of the :attr:`code <PhysObj.code>` of :attr:`obj`.
+
+    Same as :attr:`type`, this is filled at insertion time. Codes of
+    PhysObj are not supposed to change once they have Avatars.
+    """
+
     goods = Function(fget='_goods_get',
                      fset='_goods_set',
                      fexpr='_goods_expr')
@@ -714,9 +736,46 @@ class Avatar:
                                 name='dt_range_valid'),
                 Index("idx_avatar_present_unique",
                       cls.obj_id, unique=True,
-                      postgresql_where=(cls.state == 'present'))
+                      postgresql_where=(cls.state == 'present')),
+                # 'past' Avatars are the vast majority on the long run, but
+                # they are seldom queried. See also the "Partitioning of
+                # Avatars" section of the improvements page.
+                Index("idx_avatar_stock",
+                      cls.location_id, cls.type_id, cls.state,
+                      postgresql_where=cls.state.in_(('present', 'future'))),
             )
 
+    @classmethod
+    def ensure_partial_indexes(cls):
+        """Create again the partial indexes that lack their predicate.
+
+        AnyBlok migrations create the indexes added to existing tables
+        without their ``WHERE`` clause, which is harmless for correctness,
+        but defeats their purpose. The predicates are looked up in
+        ``pg_indexes``, and indexes that already have one are kept as is.
+        """
+        execute = cls.registry.execute
+        for index in cls.__table__.indexes:
+            if index.dialect_options['postgresql']['where'] is None:
+                continue
+            indexdef = execute(
+                text("SELECT indexdef FROM pg_indexes "
+                     "WHERE tablename = :table AND indexname = :index"),
+                dict(table=cls.__tablename__, index=index.name)).scalar()
+            if indexdef is not None:
+                if ' WHERE ' in indexdef:
+                    continue
+                execute(DropIndex(index))
+            execute(CreateIndex(index))
+
+    @classmethod
+    def before_insert_orm_event(cls, mapper, connection, target):
+        """Fill :attr:`type` and :attr:`code` from :attr:`obj`."""
+        if target.type_id is None:
+            obj = target.obj
+            target.type_id = obj.type_id
+            target.code = obj.code
+
     def _goods_get(self):
         deprecation_warn_goods()
         return self.obj
@@ -39,6 +39,37 @@ class TestAvatar(WmsTestCaseWithPhysObj):
             "dt_range=[%s, None])" % (
                 avatar.id, goods, self.incoming_loc, avatar.dt_from))
 
+    def test_denormalized_type_code(self):
+        self.assertEqual(self.avatar.type, self.physobj_type)
+        self.assertIsNone(self.avatar.code)
+
+        physobj = self.PhysObj.insert(type=self.physobj_type, code='ABC')
+        avatar = self.Avatar.insert(obj=physobj,
+                                    location=self.stock,
+                                    state='future',
+                                    dt_from=self.dt_test1,
+                                    outcome_of=self.arrival)
+        self.assertEqual(avatar.type, self.physobj_type)
+        self.assertEqual(avatar.code, 'ABC')
+
+    def test_ensure_partial_indexes(self):
+        execute = self.registry.execute
+        execute("DROP INDEX idx_avatar_stock")
+        execute("CREATE INDEX idx_avatar_stock "
+                "ON wms_physobj_avatar (location_id, type_id, state)")
+
+        def indexdef():
+            return execute("SELECT indexdef FROM pg_indexes "
+                           "WHERE indexname='idx_avatar_stock'"
+                           ).scalar()
+
+        self.assertNotIn(' WHERE ', indexdef())
+        self.Avatar.ensure_partial_indexes()
+        self.assertIn(' WHERE ', indexdef())
+        # idempotency
+        self.Avatar.ensure_partial_indexes()
+        self.assertIn(' WHERE ', indexdef())
+
     def test_get_property(self):
         avatar = self.avatar
         self.assertIsNone(avatar.get_property('foo'))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# This file is a part of the AnyBlok / WMS Base project
+#
+#    Copyright (C) 2018 Georges Racinet <gracinet@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_wms_base.testing import WmsTestCase
+
+
+class TestArchive(WmsTestCase):
+
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        Wms = self.registry.Wms
+        self.Archive = Wms.Archive
+        self.Avatar = self.PhysObj.Avatar
+        self.physobj_type = self.PhysObj.Type.insert(code='MyGT')
+        # archive_history() expires everything, don't keep the class
+        # level location type of another test
+        self.create_location_type()
+        self.incoming = self.insert_location('INCOMING')
+        self.stock = self.insert_location('STOCK')
+        self.default_quantity_location = self.stock
+
+    def arrive_move(self):
+        """Return Arrival and Move, done at dt_test1 and dt_test2."""
+        arrival = self.Operation.Arrival.create(physobj_type=self.physobj_type,
+                                                location=self.incoming,
+                                                state='done',
+                                                dt_execution=self.dt_test1)
+        move = self.Operation.Move.create(input=arrival.outcome,
+                                          destination=self.stock,
+                                          state='done',
+                                          dt_execution=self.dt_test2)
+        return arrival, move
+
+    def test_archive_history(self):
+        arrival, move = self.arrive_move()
+        archived_av = arrival.outcome
+        av_id, arrival_id, move_id = archived_av.id, arrival.id, move.id
+        # this one is protected by a planned Move
+        protected_arrival, protected_move = self.arrive_move()
+        self.Operation.Move.create(input=protected_move.outcome,
+                                   destination=self.incoming,
+                                   state='planned',
+                                   dt_execution=self.dt_test3)
+        self.assert_quantity(2, at_datetime=self.dt_test2,
+                             additional_states=['past'])
+
+        self.assertEqual(
+            self.Archive.archive_history(self.dt_test2), (1, 1))
+
+        self.assert_quantity(2, at_datetime=self.dt_test2,
+                             additional_states=['past'])
+        self.assertEqual(self.Avatar.query().filter_by(id=av_id).count(), 0)
+        self.assertEqual(
+            self.Operation.query().filter_by(id=arrival_id).count(), 0)
+        self.assertEqual(
+            self.Operation.Arrival.query().filter_by(id=arrival_id).count(),
+            0)
+        self.assertEqual(protected_arrival.outcome.state, 'past')
+
+        move = self.Operation.query().filter_by(id=move_id).one()
+        self.assertEqual(move.inputs, [])
+
+        archived = self.single_result(self.Archive.Avatar.query())
+        self.assertEqual(archived.id, av_id)
+        self.assertEqual(archived.outcome_of_id, arrival_id)
+        self.assertEqual(archived.location_id, self.incoming.id)
+        self.assertEqual(archived.type_id, self.physobj_type.id)
+        self.assertEqual(archived.dt_until, self.dt_test2)
+
+        archived = self.single_result(self.Archive.Operation.query())
+        self.assertEqual(archived.id, arrival_id)
+        self.assertEqual(archived.type, 'wms_arrival')
+        self.assertEqual(archived.dt_execution, self.dt_test1)
+
+        archived = self.single_result(self.Archive.HistoryInput.query())
+        self.assertEqual((archived.operation_id, archived.avatar_id),
+                         (move_id, av_id))
+
+        # nothing left to do
+        self.assertEqual(
+            self.Archive.archive_history(self.dt_test2), (0, 0))
+
+    def test_archive_history_batches(self):
+        for _ in range(3):
+            arrival, move = self.arrive_move()
+            self.Operation.Departure.create(input=move.outcome,
+                                            state='done',
+                                            dt_execution=self.dt_test3)
+
+        saved_commit = self.registry.commit
+        self.registry.commit = lambda: None
+        try:
+            self.assertEqual(
+                self.Archive.archive_history(self.dt_test3, batch_size=2),
+                (6, 9))
+        finally:
+            self.registry.commit = saved_commit
+        self.assertEqual(self.Operation.query()
+                         .filter(self.Operation.type.in_(
+                             ('wms_move', 'wms_departure')))
+                         .count(), 0)
+        self.assertEqual(self.Archive.HistoryInput.query().count(), 6)
@@ -10,6 +10,7 @@ from sqlalchemy import or_
 from sqlalchemy import not_
 from sqlalchemy import func
 from sqlalchemy import orm
+from sqlalchemy import select
 from anyblok import Declarations
 from anyblok_wms_base.constants import DATE_TIME_INFINITY
 
@@ -94,13 +95,20 @@ class Wms:
             can in particular be used to consider only those
             Avatars whose ``dt_until`` is ``None``.
 
+            The consequences of ``planned`` Operations whose time of
+            execution is :data:`indeterminate
+            <anyblok_wms_base.constants.DATE_TIME_INDETERMINATE>` are taken
+            into account at ``DATE_TIME_INFINITY`` only: at any other
+            date and time, their inputs are counted, not their outcomes.
+
             This parameter is mandatory if ``additional_states`` is specified.
 
         TODO: provide filtering according to PhysObj properties (should become
         special PostgreSQL JSON clauses)
 
-        TODO: provide a way to add more criteria from optional Bloks, e.g,
-        ``wms-reservation`` could add a way to filter only unreserved PhysObj.
+        Optional Bloks can add more criteria, e.g., ``wms-reservation``
+        adds a way to filter only unreserved PhysObj (see :meth:`its override
+        <anyblok_wms_base.reservation.wms.Wms.quantity_query>`).
 
         TODO PERF: for timestamp ranges, use GiST indexes and the @> operator.
         See the comprehensive answer to `that question
@@ -111,7 +119,7 @@ class Wms:
         Avatar = PhysObj.Avatar
         query = cls.base_quantity_query()
         if goods_type is not None:
-            query = query.filter(PhysObj.type == goods_type)
+            query = query.filter(Avatar.type_id == goods_type.id)
 
         if location is not None:
             if location_recurse:
@@ -186,11 +194,11 @@ class Wms:
             if by_location:
                 cols.append(Avatar.location_id)
             if by_type:
-                cols.append(PhysObj.type_id)
+                cols.append(Avatar.type_id)
             return query.add_columns(*cols).group_by(*cols)
 
         # as of now, base_quantity_query() does not produce joins
-        # onto Location nor Type, only WHERE closes on ids of these (the CTE
+        # onto PhysObj nor Type, only WHERE closes on ids of these (the CTE
         # does not count, as it produces ids only)
         # TODO try and detect and use JOINs introduced by additional filters ?
         if by_location:
@@ -199,7 +207,9 @@ class Wms:
                 Location, Avatar.location_id == Location.id).group_by(Location)
         if by_type:
             PT = PhysObj.Type
-            query = query.add_entity(PT).join(PhysObj.type).group_by(PT)
+            query = (query.add_entity(PT)
+                     .join(PT, Avatar.type_id == PT.id)
+                     .group_by(PT))
 
         return query
 
@@ -218,10 +228,26 @@ class Wms:
                  wished quantity result (possibly ``None`` for 0)
                  TODO change that using COALESCE where needed (less special
                  cases to define and test in Python code)
+
+        This query is on the Avatars table only, thanks to the
+        :attr:`type <anyblok_wms_base.core.physobj.Avatar.type>` field of
+        Avatars. Callers needing more about the PhysObj must join
+        on them explicitely.
         """
         Avatar = cls.PhysObj.Avatar
-        return (Avatar.query(func.count(Avatar.id).label('qty'))
-                .join(Avatar.obj))
+        return Avatar.query(cls.quantity_measure().label('qty'))
+
+    @classmethod
+    def quantity_measure(cls):
+        """Return the SQL aggregate expression used in quantity queries.
+
+        This is what :meth:`base_quantity_query` selects. It is singled out
+        so that callers can reuse it, e.g., with a ``FILTER`` clause to
+        compute several quantities in one pass.
+
+        In this default implementation, Avatars are simply counted.
+        """
+        return func.count(cls.PhysObj.Avatar.id)
 
     @classmethod
     def filter_container_types(cls, types):
@@ -284,3 +310,21 @@ class Wms:
                 "Not a proper container type: %r " % container_type)
         return cls.registry.Wms.PhysObj.insert(type=container_type,
                                                **fields)
+
+    @classmethod
+    def reserve_ids(cls, model, nb):
+        """Reserve ``nb`` values of the serial primary key of ``model``.
+
+        This is meant for bulk creations: with primary keys being set
+        beforehand, SQLAlchemy can group the ``INSERT`` statements of a flush
+        instead of issuing one of them per record to fetch its id.
+
+        :param model: a Model whose primary key is a serial ``id`` column.
+        :return: list of ids, in one single query.
+        """
+        if nb <= 0:
+            return []
+        sequence = func.pg_get_serial_sequence(model.__table__.name, 'id')
+        query = select([func.nextval(sequence)]).select_from(
+            func.generate_series(1, nb))
+        return [row[0] for row in cls.registry.execute(query).fetchall()]
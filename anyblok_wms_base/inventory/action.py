@@ -6,12 +6,19 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from sqlalchemy import orm
-from sqlalchemy import or_
+import time
+
 from sqlalchemy import and_
+from sqlalchemy import false
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import union_all
+from sqlalchemy import Index
 
 from anyblok import Declarations
 from anyblok.column import Integer
+from anyblok.column import Boolean
 from anyblok.column import Text
 from anyblok.column import Selection
 from anyblok.relationship import Many2One
@@ -52,6 +59,23 @@ class Action:
     physobj_properties = Jsonb()
     quantity = Integer(nullable=False)
 
+    applied = Boolean(nullable=False, default=False)
+    """Indicates that :meth:`apply` has been called.
+
+    This allows to apply the Actions of a Node by batches, in several
+    transactions, and to resume after interruption, see
+    :meth:`Node.reconcile_actions()
+    <anyblok_wms_base.inventory.node.Node.reconcile_actions>`.
+    """
+
+    @classmethod
+    def define_table_args(cls):
+        return super(Action, cls).define_table_args() + (
+            Index("idx_inventory_action_unapplied",
+                  cls.node_id, cls.id,
+                  postgresql_where=cls.applied.is_(False)),
+        )
+
     def __repr__(self):
         fmt = ("Wms.Inventory.Action(type={self.type!r}, "
                "node={self.node!r}, location_code={self.location.code!r}, ")
@@ -67,37 +91,142 @@ class Action:
 
     @classmethod
     def simplify(cls, node):
-        App = orm.aliased(cls, name='app')
-        Disp = orm.aliased(cls, name='disp')
-        # TODO, compare properties
-        matching = (cls.registry.query(App, Disp)
-                    .filter(App.node == node,
-                            App.type == 'app',
-                            Disp.node == node,
-                            Disp.type == 'disp',
-                            Disp.physobj_type_id == App.physobj_type_id,
-                            or_(Disp.physobj_code == App.physobj_code,
-                                and_(Disp.physobj_code.is_(None),
-                                     App.physobj_code.is_(None))))
-                    .all())
-
-        for app, disp in matching:
-            if app.type == 'telep' or disp.type == 'telep':
-                # one is already rewritten
-                continue
-            diff_qty = app.quantity - disp.quantity
-            dest = app.location
-            if diff_qty >= 0:
-                disp.update(type='telep', destination=dest)
-                if diff_qty:
-                    app.quantity = diff_qty
-                else:
-                    app.delete()
-            else:
-                app.update(type='telep',
-                           location=disp.location,
-                           destination=dest)
-                disp.quantity = -diff_qty
+        """Match apparitions with disparitions to issue teleportations.
+
+        Apparitions and disparitions of the given Node are matched if they
+        have the same PhysObj Type, code and properties (``NULL`` values
+        matching each other).
+
+        For each such group, apparitions and disparitions are ordered by
+        location, then id, and their quantities laid out one after the other
+        on two lines. Each overlapping (apparition, disparition) pair gives
+        rise to a teleportation of the overlapping quantity, and the
+        quantities of the apparitions and disparitions are reduced
+        accordingly. Those that become zero are deleted.
+
+        This is fully deterministic and maximal: for each group, the total
+        teleported quantity is the smallest of the total apparition and
+        disparition quantities.
+
+        *Implementation*: the overlaps are computed in SQL, using window
+        functions for the cumulative quantities, and the whole
+        simplification is performed with three statements (``INSERT``,
+        ``UPDATE`` and ``DELETE``), whatever the number of Actions.
+
+        :return: the number of created teleportations
+        """
+        start = time.time()
+        table = cls.__table__
+        group_cols = (cls.physobj_type_id, cls.physobj_code,
+                      cls.physobj_properties)
+
+        def cumulated(action_type):
+            return (cls.query(cls.id, cls.location_id, cls.quantity,
+                              *group_cols)
+                    .add_columns(func.sum(cls.quantity).over(
+                        partition_by=group_cols,
+                        order_by=(cls.location_id, cls.id)).label('cumul'))
+                    .filter(cls.node == node, cls.type == action_type)
+                    .cte(name=action_type))
+
+        app = cumulated('app')
+        disp = cumulated('disp')
+        app_start = app.c.cumul - app.c.quantity
+        disp_start = disp.c.cumul - disp.c.quantity
+        pairs = (
+            cls.registry.query(
+                app.c.id.label('app_id'),
+                disp.c.id.label('disp_id'),
+                disp.c.location_id.label('location_id'),
+                app.c.location_id.label('destination_id'),
+                app.c.physobj_type_id.label('physobj_type_id'),
+                app.c.physobj_code.label('physobj_code'),
+                app.c.physobj_properties.label('physobj_properties'),
+                (func.least(app.c.cumul, disp.c.cumul) -
+                 func.greatest(app_start, disp_start)).label('quantity'))
+            .select_from(app)
+            .join(disp, and_(
+                disp.c.physobj_type_id == app.c.physobj_type_id,
+                disp.c.physobj_code.isnot_distinct_from(app.c.physobj_code),
+                disp.c.physobj_properties.isnot_distinct_from(
+                    app.c.physobj_properties)))
+            .filter(app_start < disp.c.cumul,
+                    disp_start < app.c.cumul)
+            .subquery('pairs'))
+
+        # pending changes must be taken into account
+        cls.registry.flush()
+        execute = cls.registry.execute
+        teleps = execute(table.insert().from_select(
+            ('node_id', 'type', 'location_id', 'destination_id',
+             'physobj_type_id', 'physobj_code', 'physobj_properties',
+             'quantity', 'applied'),
+            select([literal(node.id), literal('telep'),
+                    pairs.c.location_id, pairs.c.destination_id,
+                    pairs.c.physobj_type_id, pairs.c.physobj_code,
+                    pairs.c.physobj_properties, pairs.c.quantity,
+                    false()]))).rowcount
+
+        # the new teleportations aren't taken into account in pairs
+        matched = union_all(
+            select([pairs.c.app_id.label('id'), pairs.c.quantity]),
+            select([pairs.c.disp_id.label('id'), pairs.c.quantity]),
+        ).alias('matched')
+        matched = (select([matched.c.id,
+                           func.sum(matched.c.quantity).label('quantity')])
+                   .group_by(matched.c.id)
+                   .alias('matched_sum'))
+        execute(table.update()
+                .where(table.c.id == matched.c.id)
+                .values(quantity=table.c.quantity - matched.c.quantity))
+        execute(table.delete()
+                .where(and_(table.c.node_id == node.id,
+                            table.c.type.in_(('app', 'disp')),
+                            table.c.quantity <= 0)))
+        cls.registry.expire_all()
+        node.record_stats('simplify', time.time() - start, teleps)
+        return teleps
+
+    @classmethod
+    def unwind_teleportations(cls, node_ids, type_ids):
+        """Turn teleportations back into apparitions and disparitions.
+
+        This is the reverse of :meth:`simplify`, for the teleportations
+        of the given Nodes and PhysObj Types only. Each of them is replaced
+        by a disparition at its location and an apparition at its
+        destination, attached to the same Node.
+
+        :param node_ids: ids of Nodes (iterable or subquery)
+        :param type_ids: ids of PhysObj Types (iterable or subquery)
+        :return: the number of unwound teleportations
+        """
+        table = cls.__table__
+        teleps = (cls.query(cls.node_id, cls.location_id, cls.destination_id,
+                            cls.physobj_type_id, cls.physobj_code,
+                            cls.physobj_properties, cls.quantity)
+                  .filter(cls.type == 'telep',
+                          cls.node_id.in_(node_ids),
+                          cls.physobj_type_id.in_(type_ids))
+                  .subquery('teleps'))
+        cols = ('node_id', 'type', 'location_id',
+                'physobj_type_id', 'physobj_code', 'physobj_properties',
+                'quantity', 'applied')
+        cls.registry.flush()
+        execute = cls.registry.execute
+        for action_type, location_col in (('disp', teleps.c.location_id),
+                                          ('app', teleps.c.destination_id)):
+            execute(table.insert().from_select(
+                cols,
+                select([teleps.c.node_id, literal(action_type),
+                        location_col, teleps.c.physobj_type_id,
+                        teleps.c.physobj_code, teleps.c.physobj_properties,
+                        teleps.c.quantity, false()])))
+        unwound = execute(table.delete().where(and_(
+            table.c.type == 'telep',
+            table.c.node_id.in_(node_ids),
+            table.c.physobj_type_id.in_(type_ids)))).rowcount
+        cls.registry.expire_all()
+        return unwound
 
     def customize_operation_fields(self, operation_fields):
         """Hook to modify fields of Operations spawned by :meth:`apply`
@@ -115,12 +244,12 @@ class Action:
         """
         return
 
-    def apply(self):
-        """Perform Inventory Operations for the current Action.
-
-        :return: tuple of the newly created Operations
+    def operation_fields(self):
+        """Return the Operation class and fields to create for this Action.
 
-        The new Operations will all point to the related Inventory.
+        :return: the Operation class and the fields to pass to its
+                 ``create()`` method, except for inputs. These have been
+                 processed by :meth:`customize_operation_fields`.
         """
         Operation = self.registry.Wms.Operation
         op_fields = dict(state='done', inventory=self.node.inventory)
@@ -139,12 +268,79 @@ class Action:
             op_fields['new_location'] = self.destination
 
         self.customize_operation_fields(op_fields)
+        return Op, op_fields
+
+    def apply(self):
+        """Perform Inventory Operations for the current Action.
+
+        :return: tuple of the newly created Operations
+
+        The new Operations will all point to the related Inventory.
+        This also sets :attr:`applied` to ``True``.
+
+        To apply many Actions at once, :meth:`apply_batch` is more efficient.
+        """
+        start = time.time()
+        Op, op_fields = self.operation_fields()
+        self.applied = True
 
         if self.type == 'app':
-            return (Op.create(**op_fields), )
+            created = (Op.create(**op_fields), )
+        else:
+            created = tuple(Op.create(input=av, **op_fields)
+                            for av in self.choose_affected())
+        self.node.record_stats('apply', time.time() - start, 1)
+        return created
+
+    @classmethod
+    def apply_batch(cls, actions):
+        """Apply several Actions at once.
+
+        :return: list of the newly created Operations
+
+        This is equivalent to calling :meth:`apply` on each of the
+        given Actions, with one Operation per affected physical object
+        as well, but:
+
+        - the affected Avatars of all disparitions and teleportations are
+          chosen at once, by :meth:`choose_affected_batch`.
+        - the resulting Disparitions and Teleportations are created with
+          :meth:`Operation.create_batch
+          <anyblok_wms_base.core.operation.base.Operation.create_batch>`,
+          grouping them by Operation class and state.
+
+        The elapsed time is recorded for each Node of the given Actions
+        (see :meth:`Node.record_stats()
+        <anyblok_wms_base.inventory.node.Node.record_stats>`), in
+        proportion of its number of Actions.
+        """
+        start = time.time()
+        affected = cls.choose_affected_batch(
+            [action for action in actions if action.type != 'app'])
+        created = []
+        batches = {}
+        for action in actions:
+            Op, op_fields = action.operation_fields()
+            action.applied = True
+            if action.type == 'app':
+                created.append(Op.create(**op_fields))
+                continue
+            state = op_fields.pop('state')
+            batches.setdefault((Op, state), []).extend(
+                ((av, ), op_fields) for av in affected[action.id])
 
-        return tuple(Op.create(input=av, **op_fields)
-                     for av in self.choose_affected())
+        for (Op, state), items in batches.items():
+            created.extend(Op.create_batch(items, state=state))
+
+        elapsed = time.time() - start
+        nodes = {}
+        for action in actions:
+            nodes.setdefault(action.node, []).append(action)
+        for node, node_actions in nodes.items():
+            node.record_stats('apply',
+                              elapsed * len(node_actions) / len(actions),
+                              len(node_actions))
+        return created
 
     def choose_affected(self):
         """Choose Physical Objects to be taken for Disparition/Teleportation.
@@ -163,17 +359,15 @@ class Action:
         avatars_q = (Avatar.query()
                      .filter_by(location=self.location,
                                 state='present')
-                     .join(PhysObj, Avatar.obj_id == PhysObj.id)
-                     .filter(PhysObj.type == self.physobj_type,
-                             PhysObj.code == self.physobj_code)
+                     .filter(Avatar.type_id == self.physobj_type_id,
+                             Avatar.code == self.physobj_code)
                      )
         Reservation = getattr(self.registry.Wms, 'Reservation', None)
         if Reservation is not None:
             avatars_q = (avatars_q
                          .outerjoin(Reservation,
                                     Reservation.physobj_id == Avatar.obj_id)
-                         .outerjoin(Reservation.request_item)
-                         .order_by(Reservation.RequestItem.request_id.desc()))
+                         .order_by(Reservation.request_id.desc()))
 
         avatars = avatars_q.limit(self.quantity).all()
 
@@ -184,3 +378,81 @@ class Action:
                 "(only {nb_found} over {nb_expected}) "
                 "to choose from in application of {action}")
         return avatars
+
+    @classmethod
+    def choose_affected_batch(cls, actions):
+        """Choose Avatars for several Actions, in one query.
+
+        :param actions: disparition and teleportation Actions
+        :return: a :class:`dict` mapping Action ids to lists of Avatars
+        :raises: ActionInputsMissing for the first Action for which
+                 not enough Avatars have been found.
+
+        This follows the same rules as :meth:`choose_affected`, taking into
+        account that several of the Actions may compete for the same
+        Avatars. These are then shared in order of Action ids.
+
+        Internally, Avatars are ranked by a window function
+        among those having the same location, Type and code, and each Action
+        gets those whose rank fall within its cumulative quantity range.
+        """
+        if not actions:
+            return {}
+        PhysObj = cls.registry.Wms.PhysObj
+        Avatar = PhysObj.Avatar
+        group_cols = (cls.location_id, cls.physobj_type_id, cls.physobj_code)
+        acts = (cls.query(cls.id, cls.quantity, *group_cols)
+                .add_columns(func.sum(cls.quantity).over(
+                    partition_by=group_cols, order_by=cls.id).label('cumul'))
+                .filter(cls.id.in_(action.id for action in actions))
+                .cte('acts'))
+        groups = (cls.registry.query(acts.c.location_id,
+                                     acts.c.physobj_type_id,
+                                     acts.c.physobj_code)
+                  .distinct()
+                  .cte('groups'))
+
+        av_group_cols = (Avatar.location_id, Avatar.type_id, Avatar.code)
+        order_by = [Avatar.id]
+        ranked = (Avatar.query(Avatar.id, *av_group_cols)
+                  .join(groups,
+                        and_(groups.c.location_id == Avatar.location_id,
+                             groups.c.physobj_type_id == Avatar.type_id,
+                             groups.c.physobj_code.isnot_distinct_from(
+                                 Avatar.code)))
+                  .filter(Avatar.state == 'present'))
+        Reservation = getattr(cls.registry.Wms, 'Reservation', None)
+        if Reservation is not None:
+            ranked = ranked.outerjoin(
+                Reservation, Reservation.physobj_id == Avatar.obj_id)
+            order_by.insert(0, Reservation.request_id.desc())
+        ranked = (ranked
+                  .add_columns(func.row_number().over(
+                      partition_by=av_group_cols,
+                      order_by=order_by).label('rank'))
+                  .cte('ranked'))
+
+        query = (cls.registry.query(acts.c.id, Avatar)
+                 .select_from(acts)
+                 .join(ranked,
+                       and_(ranked.c.location_id == acts.c.location_id,
+                            ranked.c.type_id == acts.c.physobj_type_id,
+                            ranked.c.code.isnot_distinct_from(
+                                acts.c.physobj_code),
+                            ranked.c.rank > acts.c.cumul - acts.c.quantity,
+                            ranked.c.rank <= acts.c.cumul))
+                 .join(Avatar, Avatar.id == ranked.c.id)
+                 .order_by(acts.c.id, ranked.c.rank))
+        affected = {action.id: [] for action in actions}
+        for action_id, avatar in query.all():
+            affected[action_id].append(avatar)
+
+        for action in actions:
+            found = affected[action.id]
+            if len(found) != action.quantity:
+                raise ActionInputsMissing(
+                    action, len(found),
+                    "Couldn't find enough Avatars "
+                    "(only {nb_found} over {nb_expected}) "
+                    "to choose from in application of {action}")
+        return affected
@@ -6,14 +6,23 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+import csv
+import json
+import time
+
 from sqlalchemy import orm
 from sqlalchemy import or_
 from sqlalchemy import and_
 from sqlalchemy import not_
 from sqlalchemy import func
+from sqlalchemy import case
+from sqlalchemy import false
+from sqlalchemy import literal
+from sqlalchemy import select
 
 from anyblok import Declarations
 from anyblok.column import Integer
+from anyblok.column import DateTime
 from anyblok.column import Text
 from anyblok.column import Selection
 from anyblok.relationship import Many2One
@@ -26,6 +35,40 @@ register = Declarations.register
 Wms = Declarations.Model.Wms
 
 
+def json_mapping(value, what):
+    """Return ``value`` as a :class:`dict`, decoding it if it's JSON.
+
+    :param what: description of ``value`` for error messages
+    :raises: ValueError
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError("%s is invalid JSON: %r" % (what, value))
+    if not isinstance(value, dict):
+        raise ValueError("%s must be a mapping, got %r" % (what, value))
+    return value
+
+
+def csv_rows(source):
+    """Iterate over the rows of a CSV file object having a header line.
+
+    Rows that the :mod:`csv` module can't read are yielded as the
+    :class:`csv.Error` instances, so that the caller can report them
+    and go on with the next ones.
+    """
+    reader = csv.DictReader(source)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            row = exc
+        yield row
+
+
 @register(Wms.Inventory)
 class Node:
     """Representation of the inventory of a subtree of containment hierarchy.
@@ -103,6 +146,31 @@ class Node:
                       index=True)
     location = Many2One(model=Wms.PhysObj, nullable=False)
 
+    dt_assessment = DateTime(label="Pinned date and time of assessment")
+    """If set, the Lines are compared with the stock at that time.
+
+    This allows assessment work to go on while PhysObj keep being moved
+    around, as long as the related Operations are recorded: the
+    :meth:`comparison <compute_actions>` involves the Avatars that
+    were ``present`` at that time (possibly ``past`` by now) instead of the
+    currently ``present`` ones, and the resulting Actions are then
+    adjusted for the Operations executed since then (see
+    :meth:`adjust_pinned_actions`).
+
+    Typically, this would be the time at which counting of the
+    Node's :attr:`location` started.
+    """
+
+    stats = Jsonb()
+    """Cumulated instrumentation of the processing phases of the Node.
+
+    Maps phase names (``split``, ``compute``, ``simplify``, ``push``,
+    ``apply``) to dicts with the number of ``calls``, the elapsed
+    ``seconds`` and the number of affected ``rows``.
+    See :meth:`record_stats` and :meth:`Inventory.progress()
+    <anyblok_wms_base.inventory.order.Inventory.progress>`.
+    """
+
     def __repr__(self):
         return ("Wms.Inventory.Node(id={self.id}, "
                 "inventory_id={self.inventory_id}, "
@@ -122,14 +190,48 @@ class Node:
                                       "Node.split() to create subnodes")
         super().__init__(parent=parent, **fields)
 
+    @property
+    def depth(self):
+        """(:class:`int`): number of ancestors of the Node (0 for the root).
+        """
+        depth = 0
+        node = self.parent
+        while node is not None:
+            depth += 1
+            node = node.parent
+        return depth
+
     @property
     def is_leaf(self):
         """(:class:`bool`): ``True`` if and only if the Node has no children.
         """
         return self.query().filter_by(parent=self).count() == 0
 
+    def record_stats(self, phase, seconds, rows):
+        """Hook to record the cost of a processing phase of the Node.
+
+        This default implementation accumulates in :attr:`stats`.
+        Applications can override it to send these measurements elsewhere,
+        e.g., to a monitoring system.
+
+        :param str phase: one of ``split``, ``compute``, ``simplify``,
+                          ``push`` and ``apply``
+        :param float seconds: time spent
+        :param int rows: number of created or affected records: Nodes
+                         for ``split``, teleportations for ``simplify``,
+                         Actions for the other phases.
+        """
+        stats = dict(self.stats or ())
+        current = stats.get(phase, dict(calls=0, seconds=0, rows=0))
+        stats[phase] = dict(calls=current['calls'] + 1,
+                            seconds=current['seconds'] + seconds,
+                            rows=current['rows'] + rows)
+        # new dict, so that the change gets detected
+        self.stats = stats
+
     def split(self):
         """Create a child Node for each container in :attr:`location`."""
+        start = time.time()
         PhysObj = self.registry.Wms.PhysObj
         Avatar = PhysObj.Avatar
         ContainerType = orm.aliased(
@@ -141,11 +243,98 @@ class Node:
                               ContainerType.c.id == PhysObj.type_id)
                         .filter(Avatar.state == 'present',
                                 Avatar.location == self.location))
-        return [self.insert(inventory=self.inventory,
-                            from_split=True,
-                            parent=self,
-                            location=container)
-                for container in subloc_query.all()]
+        children = [self.insert(inventory=self.inventory,
+                                from_split=True,
+                                parent=self,
+                                location=container)
+                    for container in subloc_query.all()]
+        self.record_stats('split', time.time() - start, len(children))
+        return children
+
+    def split_tree(self, max_depth=None, stop_types=None):
+        """Create the whole hierarchy of Nodes below this one at once.
+
+        This is equivalent to recursive calls of :meth:`split`, but
+        issues a single ``INSERT INTO ... SELECT`` statement, built on a
+        recursive CTE climbing down the containers under :attr:`location`,
+        which is much faster for wide containing hierarchies.
+
+        :param int max_depth: if specified, the created Nodes are at most
+                              that many levels below this one (``1`` is
+                              the same as :meth:`split`)
+        :param stop_types: if specified, iterable of
+                           :class:`PhysObj.Type` codes. Containers of these
+                           Types get a Node, but the splitting doesn't go
+                           further inside them.
+        :return: the number of created leaf Nodes
+
+        Node ids are taken from the sequence within the query itself, so
+        that each created Node can refer to its parent. Therefore, if the
+        Node Model is overridden to add columns, these must be nullable or
+        have server-side defaults.
+        """
+        start = time.time()
+        cls = self.__class__
+        PhysObj = self.registry.Wms.PhysObj
+        POType = PhysObj.Type
+        Avatar = PhysObj.Avatar
+        query = self.registry.query
+        ContainerType = orm.aliased(
+            PhysObj.Type.query_behaviour('container', as_cte=True),
+            name='container_type')
+
+        tree = (query(PhysObj.id, PhysObj.type_id,
+                      Avatar.location_id,
+                      literal(1).label('depth'))
+                .join(Avatar, Avatar.obj_id == PhysObj.id)
+                .join(ContainerType, ContainerType.c.id == PhysObj.type_id)
+                .filter(Avatar.state == 'present',
+                        Avatar.location_id == self.location_id)
+                .cte(name='tree', recursive=True))
+        parent = orm.aliased(tree, name='parent')
+        child = orm.aliased(PhysObj, name='child')
+        child_av = orm.aliased(Avatar, name='child_av')
+        tail = (query(child.id, child.type_id,
+                      child_av.location_id,
+                      parent.c.depth + 1)
+                .join(child_av, child_av.obj_id == child.id)
+                .join(ContainerType, ContainerType.c.id == child.type_id)
+                .join(parent, parent.c.id == child_av.location_id)
+                .filter(child_av.state == 'present'))
+        if max_depth is not None:
+            tail = tail.filter(parent.c.depth < max_depth)
+        if stop_types is not None:
+            tail = tail.filter(not_(parent.c.type_id.in_(
+                POType.query(POType.id)
+                .filter(POType.code.in_(tuple(stop_types))))))
+        tree = tree.union_all(tail)
+
+        # nextval() being volatile, this CTE is evaluated only once
+        sequence = func.pg_get_serial_sequence(cls.__table__.name, 'id')
+        numbered = (query(tree.c.id.label('location_id'),
+                          tree.c.location_id.label('parent_location_id'),
+                          func.nextval(sequence).label('node_id'))
+                    .cte(name='numbered'))
+        parent_node = orm.aliased(numbered, name='parent_node')
+        insert_query = (
+            query(numbered.c.node_id,
+                  literal(self.inventory_id),
+                  func.coalesce(parent_node.c.node_id, self.id),
+                  numbered.c.location_id,
+                  literal('draft'))
+            .select_from(numbered)
+            .outerjoin(parent_node,
+                       parent_node.c.location_id == (numbered.c
+                                                     .parent_location_id)))
+
+        self.registry.flush()
+        table = cls.__table__
+        insert = table.insert().from_select(
+            ('id', 'inventory_id', 'parent_id', 'location_id', 'state'),
+            insert_query.statement).returning(table.c.id, table.c.parent_id)
+        created = self.registry.execute(insert).fetchall()
+        self.record_stats('split', time.time() - start, len(created))
+        return len({row[0] for row in created} - {row[1] for row in created})
 
     def phobj_filter(self, query):
         """Filter for :meth:`anyblok_wms_base.quantity_query()`
@@ -159,16 +348,17 @@ class Node:
         """
         PhysObj = self.registry.Wms.PhysObj
         POType = PhysObj.Type
+        Avatar = PhysObj.Avatar
         excluded_types = self.inventory.excluded_types
         considered_types = self.inventory.considered_types
         if excluded_types is not None:
             query = query.filter(
-                not_(PhysObj.type_id.in_(
+                not_(Avatar.type_id.in_(
                     POType.query(POType.id)
                     .filter(POType.code.in_(excluded_types)))))
         if considered_types is not None:
             query = query.filter(
-                PhysObj.type_id.in_(
+                Avatar.type_id.in_(
                     POType.query(POType.id)
                     .filter(POType.code.in_(considered_types))))
         return query
@@ -197,6 +387,8 @@ class Node:
         with ``type='telep'``: this is done in subsequent simplification steps,
         see for instance :meth:`compute_push_actions`.
 
+        :return: the number of created :class:`Actions <.action.Action>`
+
         *Implementation and performance details*:
 
         Internally, this uses an SQL query that's quite heavy:
@@ -216,6 +408,11 @@ class Node:
             don't match
         - minimizes round-trip to the database
         - minimizes Python side processing
+
+        The Actions are created directly from that query, with one
+        ``INSERT INTO ... SELECT`` statement. Therefore, if the
+        :class:`Action <.action.Action>` Model is overridden to add columns,
+        these must be nullable or have server-side defaults.
         """
         state = self.state
         if state in ('draft', 'assessment'):
@@ -242,6 +439,26 @@ class Node:
                 "who didn't push their Actions to it yet: "
                 "{children_states!r}")
 
+        start = time.time()
+        created = self.insert_comparison_actions()
+        self.record_stats('compute', time.time() - start, created)
+        self.state = 'computed'
+        return created
+
+    def insert_comparison_actions(self, location_ids=None, type_ids=None):
+        """Compare Lines with Avatars and insert the resulting Actions.
+
+        This is the heavy part of :meth:`compute_actions`, which explains
+        the query and its rules.
+
+        :param location_ids: if specified, the comparison is restricted to
+                             Lines and Avatars whose location ids are
+                             among these, (iterable or subquery).
+        :param type_ids: if specified, the comparison is restricted to
+                         Lines and PhysObj whose Type ids are among these
+                         (iterable or subquery).
+        :return: the number of created :class:`Actions <.action.Action>`
+        """
         PhysObj = self.registry.Wms.PhysObj
         POType = PhysObj.Type
         Avatar = PhysObj.Avatar
@@ -249,18 +466,27 @@ class Node:
         Line = Inventory.Line
         Action = Inventory.Action
 
-        cols = (Avatar.location_id, PhysObj.code, PhysObj.type_id)
+        cols = (Avatar.location_id, Avatar.code, Avatar.type_id)
         quantity_query = self.registry.Wms.quantity_query
-        existing_phobjs = (quantity_query(location=self.location,
-                                          location_recurse=self.is_leaf,
-                                          additional_filter=self.phobj_filter)
-                           .add_columns(*cols).group_by(*cols)
-                           .subquery())
-
+        existing_phobjs = quantity_query(location=self.location,
+                                         location_recurse=self.is_leaf,
+                                         additional_filter=self.phobj_filter,
+                                         **self.assessment_kwargs())
         node_lines = (Line.query(Line.quantity,
                                  Line.location_id,
                                  Line.type_id, Line.code, Line.properties)
                       .filter_by(node=self))
+        if location_ids is not None:
+            existing_phobjs = existing_phobjs.filter(
+                Avatar.location_id.in_(location_ids))
+            node_lines = node_lines.filter(Line.location_id.in_(location_ids))
+        if type_ids is not None:
+            existing_phobjs = existing_phobjs.filter(
+                Avatar.type_id.in_(type_ids))
+            node_lines = node_lines.filter(Line.type_id.in_(type_ids))
+        existing_phobjs = (existing_phobjs
+                           .add_columns(*cols).group_by(*cols)
+                           .subquery())
 
         considered_types = self.inventory.considered_types
         if considered_types is not None:
@@ -276,8 +502,23 @@ class Node:
                     .filter(POType.code.in_(excluded_types)))))
         node_lines = node_lines.subquery()
 
+        line_qty = func.coalesce(node_lines.c.quantity, 0)
+        phobj_qty = func.coalesce(existing_phobjs.c.qty, 0)
         comp_query = (
-            self.registry.query(node_lines)
+            self.registry.query(
+                literal(self.id),
+                case([(phobj_qty > line_qty, 'disp')], else_='app'),
+                func.abs(phobj_qty - line_qty),
+                # for each of these, the Line value is also the Avatars' one
+                # if both exist (even for code, see join condition)
+                func.coalesce(node_lines.c.location_id,
+                              existing_phobjs.c.location_id),
+                func.coalesce(node_lines.c.type_id,
+                              existing_phobjs.c.type_id),
+                func.coalesce(node_lines.c.code, existing_phobjs.c.code),
+                node_lines.c.properties,
+                false())
+            .select_from(node_lines)
             .join(existing_phobjs,
                   # multiple criteria to join on the subquery would fail,
                   # complaining of lack of foreign key (SQLA bug maybe)?
@@ -289,43 +530,97 @@ class Node:
                            and_(existing_phobjs.c.code.is_(None),
                                 node_lines.c.code.is_(None)))),
                   full=True)
-            .filter(func.coalesce(existing_phobjs.c.qty, 0) !=
-                    func.coalesce(node_lines.c.quantity, 0))
-            .add_columns(func.coalesce(existing_phobjs.c.qty, 0)
-                         .label('phobj_qty'),
-                         # these columns are useful only if lines is None:
-                         existing_phobjs.c.location_id.label('phobj_loc'),
-                         existing_phobjs.c.type_id.label('phobj_type'),
-                         existing_phobjs.c.code.label('phobj_code'),
-                         ))
-
-        for row in comp_query.all():
-            line_qty = row[0]
-            phobj_count = row[5]
-            if line_qty is None:
-                Action.insert(node=self,
-                              type='disp',
-                              quantity=phobj_count,
-                              location=PhysObj.query().get(row[6]),
-                              physobj_type=POType.query().get(row[7]),
-                              physobj_code=row[8],
-                              )
-                continue
+            # the query is tailored so that quantities of Actions are never 0
+            .filter(phobj_qty != line_qty))
 
-            diff_qty = phobj_count - line_qty
-            fields = dict(node=self,
-                          location_id=row[1],
-                          physobj_type_id=row[2],
-                          physobj_code=row[3],
-                          physobj_properties=row[4])
+        # Lines and Avatars have to be in the database for the comparison
+        self.registry.flush()
+        insert = Action.__table__.insert().from_select(
+            ('node_id', 'type', 'quantity',
+             'location_id', 'physobj_type_id', 'physobj_code',
+             'physobj_properties', 'applied'),
+            comp_query.statement)
+        if self.dt_assessment is None:
+            return self.registry.execute(insert).rowcount
 
-            # the query is tailored so that diff_qty is never 0
-            if diff_qty > 0:
-                Action.insert(type='disp', quantity=diff_qty, **fields)
-            else:
-                Action.insert(type='app', quantity=-diff_qty, **fields)
+        # only the Actions inserted right now are to be adjusted, not
+        # those pushed by the children, nor those left by recompute_actions()
+        action_ids = [row[0] for row in self.registry.execute(
+            insert.returning(Action.__table__.c.id)).fetchall()]
+        return len(action_ids) - self.adjust_pinned_actions(action_ids)
 
-        self.state = 'computed'
+    def assessment_kwargs(self):
+        """Keyword arguments for quantity queries at assessment time.
+
+        :rtype: dict
+        """
+        if self.dt_assessment is None:
+            return {}
+        return dict(at_datetime=self.dt_assessment,
+                    additional_states=['past'])
+
+    def adjust_pinned_actions(self, action_ids):
+        """Adjust Actions for Operations done since :attr:`dt_assessment`.
+
+        The Actions computed with :attr:`dt_assessment` compare the Lines
+        with the PhysObj that were present at that time, but counting
+        goes on while PhysObj keep coming and going. For each location,
+        Type and code of the given Actions, the net flow since then
+        is therefore computed:
+
+        - a net inflow lowers apparitions, as the incoming PhysObj may
+          well have been counted.
+        - a net outflow lowers disparitions, as the outgoing PhysObj may
+          have left before being counted. Such disparitions can't be
+          applied any more anyway, and recording the Operations proves
+          that the PhysObj were actually there.
+
+        Actions that end up at zero are deleted.
+        This is done with two statements, involving only the Avatars
+        at the locations of the Actions.
+
+        :param action_ids: ids of the Actions to adjust, i.e., those that
+                           have just been inserted by the comparison.
+        :return: the number of deleted Actions
+        """
+        PhysObj = self.registry.Wms.PhysObj
+        Avatar = PhysObj.Avatar
+        Action = self.registry.Wms.Inventory.Action
+        table = Action.__table__
+        quantity_query = self.registry.Wms.quantity_query
+
+        if not action_ids:
+            return 0
+        action_locations = (Action.query(Action.location_id)
+                            .filter(Action.id.in_(action_ids)))
+        cols = (Avatar.location_id, Avatar.type_id, Avatar.code)
+
+        def qty_for_actions(query, name):
+            grouped = (query.add_columns(*cols)
+                       .filter(Avatar.location_id.in_(action_locations))
+                       .group_by(*cols)
+                       .subquery(name))
+            return func.coalesce(
+                select([grouped.c.qty])
+                .where(and_(grouped.c.location_id == table.c.location_id,
+                            grouped.c.type_id == table.c.physobj_type_id,
+                            grouped.c.code.isnot_distinct_from(
+                                table.c.physobj_code)))
+                .as_scalar(), 0)
+
+        net = (qty_for_actions(quantity_query(), 'now') -
+               qty_for_actions(quantity_query(**self.assessment_kwargs()),
+                               'then'))
+        execute = self.registry.execute
+        adjusted = table.c.id.in_(action_ids)
+        execute(table.update()
+                .where(adjusted)
+                .values(quantity=table.c.quantity - func.greatest(
+                    case([(table.c.type == 'app', net)], else_=-net), 0)))
+        deleted = execute(table.delete().where(
+            and_(adjusted, table.c.quantity <= 0))).rowcount
+        self.registry.expire_all()
+        return deleted
 
     def clear_actions(self):
         (self.registry.Wms.Inventory.Action.query()
@@ -348,28 +643,323 @@ class Node:
 
         For big inventories, the caller of this method would typically
         commit for each Node.
-        For really big inventories, the work could be split up between
-        different processes.
+        For really big inventories, the work can be split up between
+        different processes, see :meth:`compute_push_ready`.
         """
         Action = self.registry.Wms.Inventory.Action
         self.compute_actions()
         Action.simplify(self)
         self.state = 'pushed'
+        self.push_actions()
 
+    def push_actions(self):
+        """Transfer the apparitions and disparitions to the parent Node.
+
+        Does nothing for the root Node.
+        """
         if self.parent is None:
             return
+        start = time.time()
         Action = self.registry.Wms.Inventory.Action
-        (Action.query()
-         .filter(Action.type.in_(('app', 'disp')),
-                 Action.node == self)
-         .update(dict(node_id=self.parent.id),
-                 synchronize_session='fetch'))
+        pushed = (Action.query()
+                  .filter(Action.type.in_(('app', 'disp')),
+                          Action.node == self)
+                  .update(dict(node_id=self.parent.id),
+                          synchronize_session='fetch'))
+        self.record_stats('push', time.time() - start, pushed)
+
+    def recompute_actions(self, locations=None, types=None):
+        """Recompute the Actions for some locations or PhysObj Types only.
+
+        This is meant for partial recounts: once the :class:`Lines <Line>`
+        of some locations have been corrected, only the Actions that can
+        be affected are deleted and recreated, instead of redoing the whole
+        comparison, as ``compute_actions(recompute=True)`` does.
+
+        :param locations: if specified, iterable of containers whose Lines
+                          have changed. They must be under :attr:`location`
+                          if the Node is a leaf, or :attr:`location` itself
+                          otherwise.
+        :param types: if specified, iterable of :class:`PhysObj.Type` codes
+                      to restrict to. Otherwise, all the Types of Lines,
+                      PhysObj and Actions at ``locations`` are affected.
+        :return: the number of Actions created by the comparison
+
+        The Node must be in the ``computed`` or ``pushed`` state.
+
+        In the ``computed`` state, the teleportations of the affected
+        Types that the Node may have are turned back into apparitions and
+        disparitions (see :meth:`Action.unwind_teleportations
+        <.action.Action.unwind_teleportations>`), then the outdated Actions
+        are replaced.
+
+        In the ``pushed`` state, the Actions may have been simplified
+        and pushed further up. The teleportations of the affected Types are
+        unwound in all the ``pushed`` ancestors as well. Then, level after
+        level from this Node upwards, the affected apparitions and
+        disparitions of the subtree are brought back to the Node,
+        :meth:`simplified <.action.Action.simplify>` again and pushed to
+        the parent. The first ancestor that is not ``pushed`` must not have
+        computed its own Actions yet. The other Types are left untouched.
+        """
+        if self.state not in ('computed', 'pushed'):
+            raise NodeStateError(self, "Can't recompute actions on {node} "
+                                 "in state {state!r}")
+        Action = self.registry.Wms.Inventory.Action
+        chain, top = self.recompute_chain()
+        node_ids = [node.id for node in chain]
+        if top is not None:
+            node_ids.append(top.id)
+        location_ids = self.recompute_location_ids(locations)
+        type_ids = self.recompute_type_ids(node_ids, location_ids, types)
+        if not type_ids:
+            return 0
+
+        self.registry.flush()
+        Action.unwind_teleportations(node_ids, type_ids)
+        affected = (Action.query()
+                    .filter(Action.type.in_(('app', 'disp')),
+                            Action.physobj_type_id.in_(type_ids)))
+        for i, node in enumerate(chain):
+            above = node_ids[i + 1:]
+            if above:
+                subtree = self.registry.Wms.PhysObj.flatten_containers_subquery(
+                    top=node.location)
+                (affected.filter(Action.node_id.in_(above),
+                                 Action.location_id.in_(
+                                     self.registry.query(subtree.c.id)))
+                 .update(dict(node_id=node.id), synchronize_session=False))
+            if node is self:
+                own = affected.filter(Action.node_id == self.id)
+                if location_ids is not None:
+                    own = own.filter(Action.location_id.in_(location_ids))
+                own.delete(synchronize_session=False)
+                created = self.insert_comparison_actions(
+                    location_ids=location_ids, type_ids=type_ids)
+            if self.state == 'pushed':
+                Action.simplify(node)
+                node.push_actions()
+        self.registry.expire_all()
+        return created
+
+    def recompute_chain(self):
+        """Nodes whose Actions :meth:`recompute_actions` may have to alter.
+
+        :return: the list of this Node and its consecutive ``pushed``
+                 ancestors, and the first ancestor that is not ``pushed``
+                 (``None`` if there's none).
+        """
+        chain = [self]
+        if self.state != 'pushed':
+            return chain, None
+        node = self.parent
+        while node is not None and node.state == 'pushed':
+            chain.append(node)
+            node = node.parent
+        if node is not None and node.state not in ('draft', 'full'):
+            raise NodeStateError(
+                node, "Can't recompute actions below {node}, whose "
+                "state {state!r} is past 'full'")
+        Action = self.registry.Wms.Inventory.Action
+        node_ids = [n.id for n in chain]
+        if (Action.query()
+                .filter(Action.node_id.in_(node_ids), Action.applied)
+                .count()):
+            raise NodeStateError(
+                self, "Can't recompute actions on {node}: some of the "
+                "Actions it pushed have already been applied")
+        return chain, node
+
+    def recompute_location_ids(self, locations=None):
+        """Check and return the location ids for :meth:`recompute_actions`.
+
+        :return: list of ids, or ``None`` if the Node is a leaf and
+                 ``locations`` is ``None``, meaning that all locations under
+                 :attr:`location` are affected.
+        """
+        if not self.is_leaf:
+            if locations is not None and any(
+                    loc != self.location for loc in locations):
+                raise ValueError("Lines of {node} can only be about "
+                                 "its own location".format(node=self))
+            return [self.location_id]
+        if locations is None:
+            return None
+
+        subtree = self.registry.Wms.PhysObj.flatten_containers_subquery(
+            top=self.location)
+        location_ids = list({loc.id for loc in locations})
+        found = (self.registry.query(subtree.c.id)
+                 .filter(subtree.c.id.in_(location_ids)).count())
+        if found != len(location_ids):
+            raise ValueError("Some of the locations %r are not "
+                             "under %s" % (locations, self))
+        return location_ids
+
+    def recompute_type_ids(self, node_ids, location_ids, types=None):
+        """Return the ids of the affected PhysObj Types.
+
+        See :meth:`recompute_actions` for the meaning of the parameters.
+        """
+        PhysObj = self.registry.Wms.PhysObj
+        POType = PhysObj.Type
+        if types is not None:
+            return [row[0] for row in (self.registry.query(POType.id)
+                                       .filter(POType.code.in_(tuple(types)))
+                                       .all())]
+        Avatar = PhysObj.Avatar
+        Inventory = self.registry.Wms.Inventory
+        Line = Inventory.Line
+        Action = Inventory.Action
+        query = self.registry.query
+        self.registry.flush()
+        lines = query(Line.type_id).filter(Line.node_id == self.id)
+        phobjs = query(Avatar.type_id)
+        dt_assessment = self.dt_assessment
+        if dt_assessment is None:
+            phobjs = phobjs.filter(Avatar.state == 'present')
+        else:
+            phobjs = phobjs.filter(Avatar.state.in_(('present', 'past')),
+                                   Avatar.dt_from <= dt_assessment,
+                                   or_(Avatar.dt_until.is_(None),
+                                       Avatar.dt_until > dt_assessment))
+        actions = (query(Action.physobj_type_id)
+                   .filter(Action.node_id.in_(node_ids)))
+        if location_ids is None:
+            subtree = PhysObj.flatten_containers_subquery(top=self.location)
+            phobjs = phobjs.join(subtree, subtree.c.id == Avatar.location_id)
+        else:
+            lines = lines.filter(Line.location_id.in_(location_ids))
+            phobjs = phobjs.filter(Avatar.location_id.in_(location_ids))
+            actions = actions.filter(
+                or_(Action.location_id.in_(location_ids),
+                    Action.destination_id.in_(location_ids)))
+        return [row[0] for row in lines.union(phobjs, actions).all()]
+
+    @classmethod
+    def claim_ready(cls, inventory=None):
+        """Lock and return a Node that is ready to compute and push Actions.
+
+        A Node is ready if it is in the ``full`` state and all of its
+        children (if any) are in the ``pushed`` state. Leaves come first,
+        and parents become ready as their children are done.
+
+        :param inventory: if specified, only Nodes of this Inventory are
+                          considered.
+        :return: the Node, or ``None`` if there's none ready right now.
+
+        The lock is taken with ``SKIP LOCKED``, so that several processes
+        can call this concurrently without ever getting the same Node.
+        It is a ``FOR NO KEY UPDATE`` lock, which doesn't conflict with
+        children pushing their Actions to the Node.
+        The lock is released at the end of the transaction.
+        """
+        Child = orm.aliased(cls, name='child')
+        non_ready_child = (cls.registry.query(Child.id)
+                           .filter(Child.parent_id == cls.id,
+                                   Child.state != 'pushed')
+                           .exists())
+        query = cls.query().filter(cls.state == 'full', not_(non_ready_child))
+        if inventory is not None:
+            query = query.filter(cls.inventory == inventory)
+        return (query.with_for_update(skip_locked=True, key_share=True,
+                                      of=cls)
+                .order_by(cls.id)
+                .first())
+
+    @classmethod
+    def compute_push_ready(cls, inventory=None, max_nodes=None,
+                           poll_delay=None):
+        """Call :meth:`compute_push_actions` on ready Nodes, bottom-up.
+
+        This is the scalable alternative to
+        :meth:`recurse_compute_push_actions`: Nodes are taken with
+        :meth:`claim_ready` and the transaction is committed for each of
+        them.
+
+        Several processes can run this concurrently on the same Inventory,
+        each of them processing different Nodes. Since all progress is
+        committed Node per Node, running it again after a crash simply
+        resumes the work.
+
+        :param inventory: if specified, only Nodes of this Inventory
+                          are processed.
+        :param int max_nodes: if specified, stop after processing that many
+                              Nodes.
+        :param poll_delay: if ``None``, stop as soon as there's no ready
+                           Node. Otherwise, as long as there are Nodes in the
+                           ``full`` state, wait for this many seconds
+                           and try again, expecting other processes to
+                           make them ready.
+        :return: timings, as a :class:`dict` whose keys are the
+                 :attr:`depths <depth>` of processed Nodes, and values are
+                 pairs (number of Nodes, total seconds).
+        """
+        timings = {}
+        processed = 0
+        while max_nodes is None or processed < max_nodes:
+            node = cls.claim_ready(inventory=inventory)
+            if node is None:
+                if poll_delay is None:
+                    break
+                pending = cls.query().filter_by(state='full')
+                if inventory is not None:
+                    pending = pending.filter_by(inventory=inventory)
+                if pending.count() == 0:
+                    break
+                # don't stay idle in transaction
+                cls.registry.commit()
+                time.sleep(poll_delay)
+                continue
+
+            depth = node.depth
+            start = time.time()
+            node.compute_push_actions()
+            cls.registry.commit()
+            nb, elapsed = timings.get(depth, (0, 0))
+            timings[depth] = (nb + 1, elapsed + time.time() - start)
+            processed += 1
+        return timings
+
+    def reconcile_actions(self, batch_size=None):
+        """Apply all Actions of this Node, and update :attr:`state`.
+
+        :param int batch_size: if specified, Actions are applied by
+                               batches of that size, and the transaction
+                               is committed after each batch but the last.
+        :raises: NodeStateError if not in the ``pushed`` state.
+
+        Actions that are already :attr:`applied
+        <anyblok_wms_base.inventory.action.Action.applied>` are skipped,
+        so that this method can be called again to resume an interrupted
+        reconciliation. Once all Actions are applied, the Node gets to the
+        ``reconciled`` state (it's up to the caller to commit that).
+        """
+        if self.state == 'reconciled':
+            return
+        if self.state != 'pushed':
+            raise NodeStateError(self, "Can't reconcile Actions of "
+                                 "Node id={id} (state={state!r}) "
+                                 "that's not in the 'pushed' state'")
+        Action = self.registry.Wms.Inventory.Action
+        query = (Action.query()
+                 .filter(Action.node == self, Action.applied.is_(False))
+                 .order_by(Action.id))
+        if batch_size is not None:
+            query = query.limit(batch_size)
+        while True:
+            actions = query.all()
+            Action.apply_batch(actions)
+            if batch_size is None or len(actions) < batch_size:
+                break
+            self.registry.commit()
+        self.state = 'reconciled'
 
     def recurse_compute_push_actions(self):
         """Recursion along the whole tree in one shot.
 
         This is not recommended for big inventories, as it will lead to
-        one huge transaction.
+        one huge transaction. Use :meth:`compute_push_ready` instead.
         """
         cls = self.__class__
         non_ready_children = (cls.query()
@@ -410,3 +1000,163 @@ class Line:
     code = Text()
     properties = Jsonb()
     quantity = Integer(nullable=False)
+
+    INGEST_FIELDS = ('location', 'type', 'code', 'properties', 'quantity')
+    """Expected keys of the rows fed to :meth:`ingest`."""
+
+    @classmethod
+    def ingest(cls, node, source, fmt=None, batch_size=1000):
+        """Create many Lines for ``node`` from a stream of raw rows.
+
+        This is meant for batches exported by scanning devices. Each row
+        is a mapping (or its JSON representation) whose keys are in
+        :attr:`INGEST_FIELDS`: ``location`` and ``type`` are codes,
+        ``properties`` can be a JSON string, and only ``location``,
+        ``type`` and ``quantity`` are mandatory.
+
+        :param node: the :class:`Node` to attach the Lines to. It must be
+                     in the ``draft`` state.
+        :param source: either an iterable of mappings, or a text file
+                       object, to be read according to ``fmt``
+        :param fmt: for file objects, ``'csv'`` (with a header line) or
+                    ``'json'`` (one JSON object per line, empty lines
+                    being ignored)
+        :param int batch_size: number of rows per multi-row ``INSERT``
+        :return: the number of created Lines, and the list of errors, as
+                 pairs ``(row number, message)``, the first row being 1.
+
+        Rows are validated one by one, the invalid ones being reported and
+        skipped. In particular, the location must be :attr:`Node.location
+        <Node.location>` or, if the Node is a leaf, a container below it.
+
+        Location and Type codes are resolved with a cache; the locations
+        under the Node are all read upfront with a single query.
+        """
+        if node.state != 'draft':
+            raise NodeStateError(node, "Can't add Lines to {node} "
+                                 "in state {state!r}")
+        POType = cls.registry.Wms.PhysObj.Type
+        locations = cls.ingest_locations(node)
+        types = {}
+
+        def type_id(code):
+            if code not in types:
+                types[code] = POType.query(POType.id).filter_by(
+                    code=code).scalar()
+            return types[code]
+
+        errors = []
+        created = 0
+        batch = []
+        cls.registry.flush()
+        for rownum, row in enumerate(cls.ingest_source(source, fmt),
+                                     start=1):
+            try:
+                batch.append(cls.ingest_row(node, row, locations, type_id))
+            except ValueError as exc:
+                errors.append((rownum, str(exc)))
+                continue
+            if len(batch) >= batch_size:
+                created += cls.ingest_insert(batch)
+                batch = []
+        if batch:
+            created += cls.ingest_insert(batch)
+        return created, errors
+
+    @classmethod
+    def ingest_source(cls, source, fmt):
+        """Iterate over the raw rows of ``source`` for :meth:`ingest`."""
+        if fmt is None:
+            return source
+        if fmt == 'csv':
+            return csv_rows(source)
+        if fmt == 'json':
+            return (line for line in source if line.strip())
+        raise ValueError("Unknown ingestion format: %r" % fmt)
+
+    @classmethod
+    def ingest_locations(cls, node):
+        """Acceptable locations for Lines of ``node``.
+
+        :return: a :class:`dict` mapping location codes to ids
+        """
+        if not node.is_leaf:
+            return {node.location.code: node.location_id}
+        PhysObj = cls.registry.Wms.PhysObj
+        sublocs = PhysObj.flatten_containers_subquery(top=node.location)
+        return {code: loc_id for code, loc_id in (
+            cls.registry.query(PhysObj.code, PhysObj.id)
+            .join(sublocs, sublocs.c.id == PhysObj.id)
+            .all())}
+
+    @classmethod
+    def ingest_row(cls, node, row, locations, type_id):
+        """Validate and convert a raw row for :meth:`ingest`.
+
+        :param locations: mapping of acceptable location codes to ids
+        :param type_id: callable resolving a Type code to its id or ``None``
+        :return: the column values for the new Line
+        :raises: ValueError with a human readable message
+        """
+        if isinstance(row, csv.Error):
+            raise ValueError("Unreadable CSV row: %s" % row)
+        row = json_mapping(row, "Row")
+        if None in row:
+            # csv.DictReader puts the extra values under the None key
+            raise ValueError("More values than fields: %r" % row[None])
+        unknown = set(row).difference(cls.INGEST_FIELDS)
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ', '.join(sorted(unknown)))
+        for field in ('location', 'type', 'code'):
+            value = row.get(field)
+            if value is not None and not isinstance(value, str):
+                raise ValueError("Field %r must be a string, got %r" % (
+                    field, value))
+
+        loc_code = row.get('location')
+        location_id = locations.get(loc_code)
+        if location_id is None:
+            raise ValueError("Location %r is not acceptable for %s" % (
+                loc_code, node))
+
+        type_code = row.get('type')
+        tid = type_id(type_code)
+        if tid is None:
+            raise ValueError("Unknown PhysObj Type %r" % type_code)
+
+        quantity = cls.ingest_quantity(row.get('quantity'))
+        properties = row.get('properties') or None
+        if properties is not None:
+            properties = json_mapping(properties, "Properties")
+
+        return dict(node_id=node.id,
+                    location_id=location_id,
+                    type_id=tid,
+                    code=row.get('code') or None,
+                    properties=properties,
+                    quantity=quantity)
+
+    @classmethod
+    def ingest_quantity(cls, value):
+        """Validate and convert a raw quantity for :meth:`ingest_row`.
+
+        :raises: ValueError if ``value`` isn't a non negative integer or
+                 its string representation. In particular, floats aren't
+                 truncated.
+        """
+        try:
+            quantity = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid quantity %r" % value)
+        if isinstance(value, bool) or (not isinstance(value, str) and
+                                       quantity != value):
+            raise ValueError("Invalid quantity %r" % value)
+        if quantity < 0:
+            raise ValueError("Negative quantity %d" % quantity)
+        return quantity
+
+    @classmethod
+    def ingest_insert(cls, values):
+        """Insert the given Lines with a single multi-row ``INSERT``."""
+        return cls.registry.execute(
+            cls.__table__.insert().values(values)).rowcount
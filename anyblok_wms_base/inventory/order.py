@@ -6,6 +6,11 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import func
+from sqlalchemy import literal_column
+from sqlalchemy import types
+from sqlalchemy.dialects.postgresql import JSONB
+
 from anyblok import Declarations
 from anyblok.column import Integer
 from anyblok_postgres.column import Jsonb
@@ -40,6 +45,9 @@ class Inventory:
 
         inventory.root.recurse_compute_push_actions()
         inventory.reconcile_all()
+
+    For big inventories, see :meth:`Node.compute_push_ready()
+    <anyblok_wms_base.inventory.node.Node.compute_push_ready>`
     """
 
     id = Integer(label="Identifier", primary_key=True)
@@ -81,41 +89,82 @@ class Inventory:
         Node.insert(inventory=inventory, location=location)
         return inventory
 
-    def reconcile_all(self):
-        """Convenience method to apply all Actions linked to this Inventory.
-
-        This is a straightforward yet non scalable implementation of
-        the final reconciliation (see below). Don't use it on large
-        installations.
+    def reconcile_all(self, batch_size=None):
+        """Apply all Actions linked to this Inventory.
 
         To run it, it is required that the :attr:`root` Node has reached
         the ``pushed`` state.
 
-        :raises: NodeStateError if :attr:`root` Node is not ready.
+        :param int batch_size:
+           if ``None``, everything is done in one shot, therefore leading to
+           huge database transactions on full inventories of large
+           installations. Otherwise, Nodes are taken one after the other,
+           their Actions applied by batches of that size
+           (see :meth:`Node.reconcile_actions()
+           <anyblok_wms_base.inventory.node.Node.reconcile_actions>`)
+           and the transaction is committed after each batch and each Node.
 
-        This method does everything in one shot, therefore leading to huge
-        database transactions on full inventories of large installations.
+        :raises: NodeStateError if :attr:`root` Node is not ready.
 
-        For large inventories, a more progressive way of doing is required,
-        perhaps Node per Node plus batching for each Node.
-        Nodes wouldn't have to be taken
-        in order, but care must be taken while updating their state
-        to 'reconciled' in out of order executions with several batches per
-        Node.
+        Already applied Actions and reconciled Nodes are skipped, hence
+        calling this method again resumes an interrupted reconciliation.
         """
         root = self.root
-        if root.state != 'pushed':
+        if root.state not in ('pushed', 'reconciled'):
             raise NodeStateError(root, "This root {node} has not "
                                  "reached the 'pushed' state "
                                  "(currently at {state!r})")
         Node = self.Node
-        Action = self.Action
-        for action in (Action.query()
-                       .join(Node, Node.id == Action.node_id)
-                       .filter(Node.inventory == self)
-                       .all()):
-            action.apply()
-
-        (Node.query()
-         .filter_by(inventory=self)
-         .update(dict(state='reconciled'), synchronize_session='fetch'))
+        for node in (Node.query()
+                     .filter_by(inventory=self, state='pushed')
+                     .order_by(Node.id)
+                     .all()):
+            node.reconcile_actions(batch_size=batch_size)
+            if batch_size is not None:
+                self.registry.commit()
+
+    def progress(self):
+        """Aggregate the progress and the instrumentation of all Nodes.
+
+        :return: a dict with two keys:
+
+                 - ``states``: number of Nodes in each state
+                 - ``phases``: for each processing phase, the total number of
+                   ``calls``, ``seconds`` and ``rows``, as recorded by
+                   :meth:`Node.record_stats()
+                   <anyblok_wms_base.inventory.node.Node.record_stats>`
+                   in :attr:`Node.stats
+                   <anyblok_wms_base.inventory.node.Node.stats>`, and the
+                   resulting throughput (``rows_per_second``).
+
+        This issues two aggregate queries, whatever the number of Nodes.
+        """
+        Node = self.registry.Wms.Inventory.Node
+        query = self.registry.query
+        states = {state: nb for state, nb in (
+            query(Node.state, func.count(Node.id))
+            .filter(Node.inventory_id == self.id)
+            .group_by(Node.state)
+            .all())}
+
+        phase = func.jsonb_each(Node.stats).alias('phase')
+        key = literal_column('phase.key')
+        value = literal_column('phase.value', type_=JSONB)
+
+        def total(field, type_):
+            return func.sum(value[field].astext.cast(type_))
+
+        phases = {}
+        for name, calls, seconds, rows in (
+                query(key,
+                      total('calls', types.Integer),
+                      total('seconds', types.Float),
+                      total('rows', types.Integer))
+                .select_from(Node, phase)
+                .filter(Node.inventory_id == self.id)
+                .group_by(key)
+                .all()):
+            phases[name] = dict(calls=calls, seconds=seconds, rows=rows,
+                                rows_per_second=rows / seconds if seconds
+                                else None)
+        return dict(states=states, phases=phases)
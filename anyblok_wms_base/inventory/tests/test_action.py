@@ -113,6 +113,52 @@ class InventoryActionTestCase(SharedDataTestCase, WmsTestCase):
         self.assert_singleton(self.node_actions(),
                               value=('telep', loc_b, loc_a, pot, None, 3))
 
+    def test_simplify_several(self):
+        node = self.node
+        pot = self.pot
+        loc_root, loc_a, loc_b = self.loc_root, self.loc_a, self.loc_b
+        Action = self.Action
+        Action.insert(node=node, type='app', location=loc_a,
+                      physobj_type=pot, quantity=2)
+        Action.insert(node=node, type='app', location=loc_b,
+                      physobj_type=pot, quantity=2)
+        Action.insert(node=node, type='disp', location=loc_root,
+                      physobj_type=pot, quantity=3)
+        Action.insert(node=node, type='disp', location=loc_b,
+                      physobj_type=pot, physobj_code='other', quantity=1)
+        Action.simplify(node)
+
+        # apparitions and disparitions are taken in order of locations
+        self.assertEqual(self.node_actions(),
+                         {('telep', loc_root, loc_a, pot, None, 2),
+                          ('telep', loc_root, loc_b, pot, None, 1),
+                          ('app', loc_b, None, pot, None, 1),
+                          ('disp', loc_b, None, pot, 'other', 1),
+                          })
+
+    def test_simplify_properties(self):
+        node = self.node
+        pot = self.pot
+        loc_a, loc_b = self.loc_a, self.loc_b
+        Action = self.Action
+        Action.insert(node=node, type='app', location=loc_a,
+                      physobj_type=pot, physobj_properties=dict(qa='ok'),
+                      quantity=2)
+        Action.insert(node=node, type='disp', location=loc_b,
+                      physobj_type=pot, quantity=2)
+        Action.insert(node=node, type='disp', location=loc_b,
+                      physobj_type=pot, physobj_properties=dict(qa='ok'),
+                      quantity=1)
+        Action.simplify(node)
+
+        self.assertEqual(
+            set((a.type, a.location, a.physobj_properties is None, a.quantity)
+                for a in Action.query().filter_by(node=node).all()),
+            {('telep', loc_b, False, 1),
+             ('app', loc_a, False, 1),
+             ('disp', loc_b, True, 2),
+             })
+
     def check_simplify_non_matching_codes(self, code1, code2):
         node = self.node
         pot = self.pot
@@ -181,6 +227,56 @@ class InventoryActionTestCase(SharedDataTestCase, WmsTestCase):
             self.assertEqual(op.state, 'done')
         # I don't see much value in checking that Teleportation does its job
 
+    def test_apply_batch(self):
+        pot = self.pot
+        loc_a, loc_b = self.loc_a, self.loc_b
+        Arrival = self.Operation.Arrival
+        po_fields = dict(physobj_type=pot, physobj_code='from_action')
+        avatars = set(Arrival.create(state='done', location=loc_a,
+                                     **po_fields).outcome
+                      for i in range(4))
+        Action = self.Action
+        # all these compete for the same Avatars
+        actions = [Action.insert(node=self.node, type='telep',
+                                 location=loc_a, destination=loc_b,
+                                 quantity=1, **po_fields),
+                   Action.insert(node=self.node, type='disp',
+                                 location=loc_a, quantity=2,
+                                 **po_fields),
+                   Action.insert(node=self.node, type='telep',
+                                 location=loc_a, destination=self.loc_root,
+                                 quantity=1, **po_fields),
+                   Action.insert(node=self.node, type='app',
+                                 location=loc_b, quantity=1,
+                                 **po_fields),
+                   ]
+
+        ops = Action.apply_batch(actions)
+        self.assertEqual(len(ops), 5)
+        self.assertTrue(all(action.applied for action in actions))
+        Operation = self.Operation
+        self.assertEqual(
+            set(op.input for op in ops
+                if not isinstance(op, Operation.Apparition)),
+            avatars)
+        self.assertEqual(
+            sorted(op.new_location.code for op in ops
+                   if isinstance(op, Operation.Teleportation)),
+            ['B', 'ROOT'])
+        self.assertEqual(sum(1 for op in ops
+                             if isinstance(op, Operation.Disparition)), 2)
+        for op in ops:
+            self.assertEqual(op.inventory, self.inventory)
+            self.assertEqual(op.state, 'done')
+
+    def test_apply_batch_missing(self):
+        action = self.Action.insert(node=self.node, type='disp',
+                                    location=self.loc_a, quantity=1,
+                                    physobj_type=self.pot)
+        with self.assertRaises(ActionInputsMissing) as arc:
+            self.Action.apply_batch([action])
+        self.assertEqual(arc.exception.nb_found, 0)
+
     def test_apply_disp(self):
         pot = self.pot
         loc_a = self.loc_a
@@ -16,6 +16,7 @@ class InventoryOrderTestCase(WmsTestCaseWithPhysObj):
     def setUp(self):
         super().setUp()
         self.Inventory = self.registry.Wms.Inventory
+        self.Line = self.Inventory.Line
 
     def test_create(self):
         inv = self.Inventory.create(location=self.stock)
@@ -23,7 +24,7 @@ class InventoryOrderTestCase(WmsTestCaseWithPhysObj):
         self.assertIsInstance(root, self.Inventory.Node)
         self.assertEqual(root.location, self.stock)
 
-    def test_reconcile_all(self):
+    def fixture_reconcile(self):
         pot = self.physobj_type
         loc_a = self.insert_location("A", parent=self.stock)
         loc_aa = self.insert_location("AA", parent=loc_a)
@@ -60,8 +61,10 @@ class InventoryOrderTestCase(WmsTestCaseWithPhysObj):
                       quantity=1)
         for node in (root, node_a, node_b):
             node.state = 'pushed'
+        return inv, (root, node_a, node_b)
 
-        inv.reconcile_all()
+    def assert_reconciled(self, nodes):
+        pot = self.physobj_type
         PhysObj, Avatar = self.PhysObj, self.Avatar
 
         present_avatars = (self.Avatar.query()
@@ -75,8 +78,42 @@ class InventoryOrderTestCase(WmsTestCaseWithPhysObj):
                           ('B', 'appeared_b'),
                           })
 
-        for node in (root, node_a, node_b):
+        for node in nodes:
             self.assertEqual(node.state, 'reconciled')
+        Action = self.Inventory.Action
+        self.assertEqual(Action.query().filter_by(applied=False).count(), 0)
+
+    def test_reconcile_all(self):
+        inv, nodes = self.fixture_reconcile()
+        inv.reconcile_all()
+        self.assert_reconciled(nodes)
+
+    def test_reconcile_all_batches(self):
+        inv, nodes = self.fixture_reconcile()
+        root = nodes[0]
+        Action = self.Inventory.Action
+        # simulating a previous interrupted run
+        app = self.single_result(Action.query().filter_by(type='app'))
+        app.apply()
+        self.assertTrue(app.applied)
+
+        registry = self.Inventory.registry
+        saved_commit = registry.commit
+        registry.commit = lambda: None
+        try:
+            inv.reconcile_all(batch_size=1)
+            # calling again is harmless, even on the root
+            inv.reconcile_all(batch_size=1)
+            root.reconcile_actions()
+        finally:
+            registry.commit = saved_commit
+        self.assert_reconciled(nodes)
+
+    def test_reconcile_actions_not_ready(self):
+        inv = self.Inventory.create(location=self.stock)
+        with self.assertRaises(NodeStateError) as arc:
+            inv.root.reconcile_actions()
+        self.assertEqual(arc.exception.node, inv.root)
 
     def test_reconcile_all_not_ready(self):
         inv = self.Inventory.create(location=self.stock)
@@ -87,5 +124,42 @@ class InventoryOrderTestCase(WmsTestCaseWithPhysObj):
         repr(exc)
         self.assertEqual(exc.node, inv.root)
 
+    def test_progress(self):
+        pot = self.physobj_type
+        inv = self.Inventory.create(location=self.stock,
+                                    excluded_types=[self.location_type.code])
+        root = inv.root
+        loc_a = self.insert_location("A", parent=self.stock)
+        self.insert_location("AA", parent=loc_a)
+        loc_ab = self.insert_location("AB", parent=loc_a)
+        self.assertEqual(root.split_tree(max_depth=1), 1)
+        node_a = self.single_result(root.query().filter_by(parent=root))
+
+        self.Line.insert(node=node_a, location=loc_ab, type=pot, quantity=1)
+        progress = inv.progress()
+        self.assertEqual(progress['states'], dict(draft=2))
+        split = progress['phases']['split']
+        self.assertEqual((split['calls'], split['rows']), (1, 1))
+        self.assertGreaterEqual(split['seconds'], 0)
+
+        for node in (root, node_a):
+            node.state = 'full'
+        root.recurse_compute_push_actions()
+        inv.reconcile_all()
+
+        progress = inv.progress()
+        self.assertEqual(progress['states'], dict(reconciled=2))
+        phases = progress['phases']
+        self.assertEqual({name: (phase['calls'], phase['rows'])
+                          for name, phase in phases.items()},
+                         dict(split=(1, 1),
+                              compute=(2, 1),
+                              simplify=(2, 0),
+                              push=(1, 1),
+                              apply=(1, 1)))
+        self.assertEqual(set(node_a.stats), {'compute', 'simplify', 'push'})
+        self.assertEqual(set(root.stats),
+                         {'split', 'compute', 'simplify', 'apply'})
+
 
 del WmsTestCaseWithPhysObj
@@ -6,7 +6,10 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+import io
+
 from anyblok_wms_base.testing import WmsTestCaseWithPhysObj
+from anyblok_wms_base.testing import ConcurrencyBlokTestCase
 from ..exceptions import (NodeStateError,
                           NodeChildrenStateError,
                           )
@@ -77,6 +80,237 @@ class InventoryNodeTestCase(WmsTestCaseWithPhysObj):
                          {loc_a, loc_b})
         self.assertTrue(all(c.inventory == inventory for c in children))
 
+    def test_split_tree(self):
+        stock = self.stock
+        inventory = self.Inventory.create(location=stock)
+        root = inventory.root
+        shelf_type = self.PhysObj.Type.insert(code='SHELF',
+                                              parent=stock.type)
+        loc_a = self.insert_location("A", parent=stock)
+        loc_b = self.insert_location("B", parent=stock,
+                                     location_type=shelf_type)
+        loc_aa = self.insert_location("AA", parent=loc_a)
+        loc_ab = self.insert_location("AB", parent=loc_a)
+        loc_aaa = self.insert_location("AAA", parent=loc_aa)
+        self.insert_location("BA", parent=loc_b)
+
+        def nodes_by_loc():
+            return {node.location: node
+                    for node in self.Node.query().filter_by(
+                        inventory=inventory).all()}
+
+        # whole tree
+        self.assertEqual(root.split_tree(), 3)
+        nodes = nodes_by_loc()
+        self.assertEqual(len(nodes), 7)
+        self.assertEqual(nodes[loc_a].parent, root)
+        self.assertEqual(nodes[loc_aaa].parent, nodes[loc_aa])
+        self.assertEqual(nodes[loc_ab].parent, nodes[loc_a])
+        self.assertTrue(all(node.state == 'draft' for node in nodes.values()))
+
+        # depth and stop types
+        inventory = self.Inventory.create(location=stock)
+        root = inventory.root
+        self.assertEqual(root.split_tree(max_depth=2, stop_types=['SHELF']),
+                         3)
+        nodes = nodes_by_loc()
+        self.assertEqual(set(nodes), {stock, loc_a, loc_b, loc_aa, loc_ab})
+        self.assertTrue(nodes[loc_b].is_leaf)
+        self.assertTrue(nodes[loc_aa].is_leaf)
+
+    def test_line_ingest(self):
+        stock = self.stock
+        loc_a = self.insert_location("A", parent=stock)
+        self.insert_location("ELSEWHERE")
+        inventory = self.Inventory.create(location=stock)
+        node = inventory.root
+        gt_code = self.physobj.type.code
+        source = io.StringIO(
+            "location,type,code,properties,quantity\n"
+            "A,{gt},,,3\n"
+            "STOCK,{gt},x1,\"{{\"\"foo\"\": 1}}\",1\n"
+            "ELSEWHERE,{gt},,,1\n"
+            "A,UNKNOWN,,,1\n"
+            "A,{gt},,,-2\n"
+            "A,{gt},,,two\n"
+            "A,{gt},,,2,extra\n"
+            "A,{gt},,,1.5\n"
+            "A,{gt},{huge},,1\n".format(gt=gt_code, huge='x' * 200000))
+        created, errors = self.Line.ingest(node, source, fmt='csv',
+                                           batch_size=1)
+        self.assertEqual(created, 2)
+        self.assertEqual([err[0] for err in errors], [3, 4, 5, 6, 7, 8, 9])
+        self.assertIn('extra', errors[4][1])
+        self.assertIn('ELSEWHERE', errors[0][1])
+        lines = {(ln.location, ln.code, ln.quantity): ln.properties
+                 for ln in self.Line.query().filter_by(node=node).all()}
+        self.assertEqual(lines, {(loc_a, None, 3): None,
+                                 (stock, 'x1', 1): dict(foo=1)})
+
+        # once split, only the Node's location itself is acceptable
+        node.split()
+        source = io.StringIO('{{"location": "A", "type": "{gt}", '
+                             '"quantity": 1}}\n'
+                             '\n'
+                             '{{not json\n'
+                             '{{"location": "STOCK", "type": "{gt}", '
+                             '"quantity": 2, "bogus": 1}}\n'.format(gt=gt_code))
+        created, errors = self.Line.ingest(node, source, fmt='json')
+        self.assertEqual(created, 0)
+        self.assertEqual([err[0] for err in errors], [1, 2, 3])
+
+        created, errors = self.Line.ingest(
+            node, [dict(location='STOCK', type=gt_code, quantity=2.5),
+                   dict(location='STOCK', type=gt_code, quantity=True),
+                   dict(location='STOCK', type=[gt_code], quantity=2),
+                   dict(location='STOCK', type=gt_code, code=dict(x=1),
+                        quantity=2)])
+        self.assertEqual(created, 0)
+        self.assertEqual([err[0] for err in errors], [1, 2, 3, 4])
+        self.assertIn('2.5', errors[0][1])
+
+        created, errors = self.Line.ingest(
+            node, [dict(location='STOCK', type=gt_code, quantity=2)])
+        self.assertEqual((created, errors), (1, []))
+
+        node.state = 'full'
+        with self.assertRaises(NodeStateError):
+            self.Line.ingest(node, [])
+
+    def test_compute_actions_pinned(self):
+        pot = self.PhysObj.Type.insert(code='PINNED')
+        loc = self.insert_location('L', parent=self.stock)
+        elsewhere = self.insert_location('ELSEWHERE')
+        arrivals = [self.Arrival.create(state='done', location=loc,
+                                        physobj_type=pot,
+                                        dt_execution=self.dt_test1)
+                    for _ in range(3)]
+        # after the assessment time, one leaves the Node
+        self.Operation.Move.create(state='done',
+                                   input=arrivals[0].outcome,
+                                   destination=elsewhere,
+                                   dt_execution=self.dt_test3)
+
+        def actions(node):
+            return {(act.type, act.quantity)
+                    for act in self.Action.query().filter_by(node=node)}
+
+        def node_with_line(quantity, dt_assessment=None):
+            inventory = self.Inventory.create(location=self.stock,
+                                              considered_types=['PINNED'])
+            node = inventory.root
+            node.update(dt_assessment=dt_assessment, state='full')
+            self.Line.insert(node=node, location=loc, type=pot,
+                             quantity=quantity)
+            return node
+
+        # live comparison sees the move as a missing PhysObj
+        node = node_with_line(3)
+        self.assertEqual(node.compute_actions(), 1)
+        self.assertEqual(actions(node), {('app', 1)})
+
+        # pinned comparison doesn't
+        node = node_with_line(3, dt_assessment=self.dt_test2)
+        self.assertEqual(node.compute_actions(), 0)
+
+        # disparitions of PhysObj that have been moved since then are
+        # irrelevant and dropped
+        node = node_with_line(0, dt_assessment=self.dt_test2)
+        self.assertEqual(node.compute_actions(), 1)
+        self.assertEqual(actions(node), {('disp', 2)})
+        self.assertEqual(node.recompute_actions(locations=[loc]), 1)
+        self.assertEqual(actions(node), {('disp', 2)})
+
+    def test_compute_actions_pinned_arrival(self):
+        pot = self.PhysObj.Type.insert(code='PINNED')
+        loc = self.insert_location('L', parent=self.stock)
+        for _ in range(2):
+            self.Arrival.create(state='done', location=loc,
+                                physobj_type=pot,
+                                dt_execution=self.dt_test1)
+        # after the assessment time, one more arrives in the Node
+        self.Arrival.create(state='done', location=loc,
+                            physobj_type=pot,
+                            dt_execution=self.dt_test3)
+
+        def node_with_line(quantity, dt_assessment=None):
+            inventory = self.Inventory.create(location=self.stock,
+                                              considered_types=['PINNED'])
+            node = inventory.root
+            node.update(dt_assessment=dt_assessment, state='full')
+            self.Line.insert(node=node, location=loc, type=pot,
+                             quantity=quantity)
+            return node
+
+        # the arrived one has been counted
+        node = node_with_line(3, dt_assessment=self.dt_test2)
+        self.assertEqual(node.compute_actions(), 0)
+
+        # it has not, which doesn't make a disparition either
+        node = node_with_line(2, dt_assessment=self.dt_test2)
+        self.assertEqual(node.compute_actions(), 0)
+
+        # genuine apparitions are only lowered
+        node = node_with_line(5, dt_assessment=self.dt_test2)
+        self.assertEqual(node.compute_actions(), 1)
+        action = self.single_result(self.Action.query().filter_by(node=node))
+        self.assertEqual((action.type, action.quantity), ('app', 2))
+
+    def test_compute_actions_pinned_pushed(self):
+        """Actions pushed by children aren't adjusted again."""
+        pot = self.PhysObj.Type.insert(code='PINNED')
+        loc_a = self.insert_location('A', parent=self.stock)
+        self.Arrival.create(state='done', location=loc_a, physobj_type=pot,
+                            dt_execution=self.dt_test1)
+        # after the assessment time, one more arrives in A
+        self.Arrival.create(state='done', location=loc_a, physobj_type=pot,
+                            dt_execution=self.dt_test3)
+
+        inventory = self.Inventory.create(location=self.stock,
+                                          considered_types=['PINNED'])
+        root = inventory.root
+        root.split()
+        child = self.Node.query().filter_by(location=loc_a).one()
+        child.update(dt_assessment=self.dt_test2, state='full')
+        self.Line.insert(node=child, location=loc_a, type=pot, quantity=3)
+        child.compute_push_actions()
+
+        root.update(dt_assessment=self.dt_test2, state='full')
+        self.assertEqual(root.compute_actions(), 0)
+        action = self.single_result(self.Action.query().filter_by(node=root))
+        self.assertEqual((action.type, action.location, action.quantity),
+                         ('app', loc_a, 1))
+
+    def test_recompute_actions_pinned(self):
+        """Partial recomputations adjust only the recomputed Actions."""
+        pot = self.PhysObj.Type.insert(code='PINNED')
+        loc_1 = self.insert_location('L1', parent=self.stock)
+        loc_2 = self.insert_location('L2', parent=self.stock)
+        self.Arrival.create(state='done', location=loc_1, physobj_type=pot,
+                            dt_execution=self.dt_test1)
+        # after the assessment time, one more arrives in L1
+        self.Arrival.create(state='done', location=loc_1, physobj_type=pot,
+                            dt_execution=self.dt_test3)
+
+        inventory = self.Inventory.create(location=self.stock,
+                                          considered_types=['PINNED'])
+        node = inventory.root
+        node.update(dt_assessment=self.dt_test2, state='full')
+        self.Line.insert(node=node, location=loc_1, type=pot, quantity=3)
+        line_2 = self.Line.insert(node=node, location=loc_2, type=pot,
+                                  quantity=1)
+
+        def actions():
+            return {(act.type, act.location, act.quantity)
+                    for act in self.Action.query().filter_by(node=node)}
+
+        self.assertEqual(node.compute_actions(), 2)
+        self.assertEqual(actions(), {('app', loc_1, 1), ('app', loc_2, 1)})
+
+        line_2.quantity = 2
+        self.assertEqual(node.recompute_actions(locations=[loc_2]), 1)
+        self.assertEqual(actions(), {('app', loc_1, 1), ('app', loc_2, 2)})
+
     def test_compute_actions_not_enough_phobjs(self):
         inventory = self.Inventory.create(location=self.stock)
         node = inventory.root
@@ -346,7 +580,7 @@ class InventoryNodeTestCase(WmsTestCaseWithPhysObj):
                        physobj_code='in_b')
         self.Line.insert(node=node, location=loc_b, type=pot, quantity=2)
 
-        node.compute_actions()
+        self.assertEqual(node.compute_actions(), 4)
         Action = self.Action
 
         def node_actions():
@@ -362,8 +596,8 @@ class InventoryNodeTestCase(WmsTestCaseWithPhysObj):
                           ('disp', loc_b, None, pot, 'in_b', 1),
                           })
         Action.simplify(node)
-        # TODO this is non deterministic: one can also take one of the
-        # two appearing at loc_b to match the disparition at loc_a
+        # the apparition at stock is taken first, because stock was
+        # created before loc_b (simplification orders by location)
         self.assertEqual(node_actions(),
                          {('telep', loc_a, stock, pot, None, 1),
                           ('app', loc_b, None, pot, None, 2),
@@ -502,6 +736,115 @@ class InventoryNodeTestCase(WmsTestCaseWithPhysObj):
         self.assertEqual(app.destination.code, 'AB')
         self.assertEqual(app.quantity, 1)
 
+    def test_recompute_actions(self):
+        pot = self.physobj_type
+        inventory, root, node = self.fixture_compute_push_actions()
+        loc_ab = self.PhysObj.query().filter_by(code='AB').one()
+        line = self.Line.query().filter_by(location=loc_ab).one()
+
+        def actions():
+            return {(act.node, act.type, act.location.code,
+                     act.destination and act.destination.code, act.quantity)
+                    for act in self.Action.query().all()}
+
+        node.state = 'full'
+        node.compute_actions()
+        self.assertEqual(actions(), {(node, 'disp', 'AA', None, 1),
+                                     (node, 'app', 'AB', None, 2)})
+
+        # recount while still in the 'computed' state
+        line.quantity = 3
+        self.assertEqual(node.recompute_actions(locations=[loc_ab]), 1)
+        self.assertEqual(actions(), {(node, 'disp', 'AA', None, 1),
+                                     (node, 'app', 'AB', None, 3)})
+
+        # now with teleportations and actions pushed up to the top, as in
+        # test_recurse_compute_push_actions()
+        line.quantity = 2
+        node.recompute_actions()
+        self.Action.simplify(node)
+        node.state = 'pushed'
+        node.push_actions()
+        root.state = 'full'
+        root.compute_push_actions()
+        self.assertEqual(actions(), {(node, 'telep', 'AA', 'AB', 1),
+                                     (root, 'telep', 'STOCK', 'AB', 1)})
+
+        # the recount of AB has to be propagated up to the root, where
+        # the apparition in AB was matched
+        line.quantity = 1
+        self.assertEqual(node.recompute_actions(locations=[loc_ab]), 1)
+        self.assertEqual(actions(), {(node, 'telep', 'AA', 'AB', 1),
+                                     (root, 'disp', 'STOCK', None, 1)})
+
+        # nothing is affected for other types
+        self.PhysObj.Type.insert(code='OTHER')
+        self.assertEqual(node.recompute_actions(types=['OTHER']), 0)
+        self.assertEqual(len(actions()), 2)
+
+        # recounting in the root Node, in particular the stray PhysObj
+        self.Line.insert(node=root, location=self.stock, type=pot, quantity=1)
+        self.assertEqual(root.recompute_actions(types=[pot.code]), 0)
+        self.assertEqual(actions(), {(node, 'telep', 'AA', 'AB', 1)})
+
+        with self.assertRaises(ValueError):
+            root.recompute_actions(locations=[loc_ab])
+        with self.assertRaises(ValueError):
+            node.recompute_actions(locations=[self.stock])
+
+        root.state = 'reconciled'
+        with self.assertRaises(NodeStateError):
+            node.recompute_actions()
+        with self.assertRaises(NodeStateError):
+            root.recompute_actions()
+
+    def test_claim_ready(self):
+        inventory, root, node = self.fixture_compute_push_actions()
+        self.assertIsNone(self.Node.claim_ready(inventory=inventory))
+
+        root.state = 'full'
+        # root has a non ready child
+        self.assertIsNone(self.Node.claim_ready(inventory=inventory))
+
+        node.state = 'full'
+        self.assertEqual(self.Node.claim_ready(inventory=inventory), node)
+        self.assertEqual(node.depth, 1)
+
+        node.state = 'pushed'
+        self.assertEqual(self.Node.claim_ready(inventory=inventory), root)
+        self.assertEqual(root.depth, 0)
+
+    def test_compute_push_ready(self):
+        inventory, root, node = self.fixture_compute_push_actions()
+        root.state = 'full'
+        node.state = 'full'
+
+        Node = self.Node
+        saved_commit = Node.registry.commit
+        Node.registry.commit = lambda: None
+        try:
+            timings = Node.compute_push_ready(inventory=inventory,
+                                              max_nodes=1)
+            self.assertEqual(node.state, 'pushed')
+            self.assertEqual(root.state, 'full')
+            self.assertEqual(set(timings), {1})
+            self.assertEqual(timings[1][0], 1)
+
+            # resuming
+            timings = Node.compute_push_ready(inventory=inventory,
+                                              poll_delay=0.1)
+        finally:
+            Node.registry.commit = saved_commit
+
+        self.assertEqual(set(timings), {0})
+        self.assertEqual(root.state, 'pushed')
+
+        # same end result as with the recursive method
+        app = self.single_result(self.Action.query().filter_by(node=root))
+        self.assertEqual(app.type, 'telep')
+        self.assertEqual(app.location, self.stock)
+        self.assertEqual(app.destination.code, 'AB')
+
     def test_recurse_compute_push_actions_non_ready_child(self):
         inventory, root, node = self.fixture_compute_push_actions()
         root.state = 'full'
@@ -528,4 +871,50 @@ class InventoryNodeTestCase(WmsTestCaseWithPhysObj):
         self.assert_singleton(exc.children, value=node)
 
 
+class NodeClaimConcurrencyTestCase(ConcurrencyBlokTestCase):
+
+    @classmethod
+    def setUpCommonData(cls):
+        Wms = cls.registry.Wms
+        loc_type = Wms.PhysObj.Type.insert(code='CLAIM-LOC')
+        locs = [Wms.PhysObj.insert(type=loc_type, code=code)
+                for code in ('CLAIM-STK', 'CLAIM-A', 'CLAIM-B')]
+        inventory = Wms.Inventory.create(location=locs[0])
+        root = inventory.root
+        for loc in locs[1:]:
+            Wms.Inventory.Node.insert(inventory=inventory, parent=root,
+                                      from_split=True, state='full',
+                                      location=loc)
+        root.state = 'full'
+        cls.inventory_id = inventory.id
+
+    @classmethod
+    def removeCommonData(cls):
+        Wms = cls.registry.Wms
+        Node = Wms.Inventory.Node
+        Node.query().filter(Node.parent_id.isnot(None)).delete()
+        Node.query().delete()
+        Wms.Inventory.query().delete()
+        Wms.PhysObj.query().filter(
+            Wms.PhysObj.code.like('CLAIM-%')).delete(
+                synchronize_session=False)
+        Wms.PhysObj.Type.query().filter_by(code='CLAIM-LOC').delete()
+
+    def test_claim_ready_concurrency(self):
+        Node = self.registry.Wms.Inventory.Node
+        Node2 = self.registry2.Wms.Inventory.Node
+        inventory = self.registry.Wms.Inventory.query().get(self.inventory_id)
+        inventory2 = self.registry2.Wms.Inventory.query().get(
+            self.inventory_id)
+
+        claimed = Node.claim_ready(inventory=inventory)
+        self.assertIsNotNone(claimed.parent)
+
+        # the other transaction gets the other leaf
+        claimed2 = Node2.claim_ready(inventory=inventory2)
+        self.assertIsNotNone(claimed2)
+        self.assertNotEqual(claimed2.id, claimed.id)
+        self.assertIsNotNone(claimed2.parent)
+
+
 del WmsTestCaseWithPhysObj
@@ -34,6 +34,28 @@ class WmsQuantity(Blok):
     author = "Georges Racinet"
     required = ['wms-core']
 
+    def update(self, latest_version):  # pragma: no cover
+        # our index on Avatars is always added to an existing table
+        self.registry.Wms.PhysObj.Avatar.ensure_partial_indexes()
+        if latest_version is None:
+            return
+        if latest_version < '0.9.0.dev2':
+            self.update_avatar_quantity()
+
+    def update_avatar_quantity(self):  # pragma: no cover
+        """Fill the denormalized ``quantity`` of existing Avatars.
+
+        Avatars inserted before the column existed get the quantity of
+        their PhysObj. The others are left untouched.
+        """
+        PhysObj = self.registry.Wms.PhysObj
+        Avatar = PhysObj.Avatar
+        (Avatar.query()
+         .filter(Avatar.quantity.is_(None),
+                 Avatar.obj_id == PhysObj.id)
+         .update(dict(quantity=PhysObj.quantity),
+                 synchronize_session=False))
+
     @classmethod
     def import_declaration_module(cls):
         import_declarations()
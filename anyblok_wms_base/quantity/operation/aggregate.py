@@ -6,6 +6,7 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import func
 
 from anyblok import Declarations
 from anyblok.column import Integer
@@ -98,6 +99,13 @@ class Aggregate(Mixin.WmsSingleOutcomeOperation,
         first_physobj = first.obj
         for avatar in inputs:
             physobj = avatar.obj
+            if physobj.properties is first_physobj.properties and all(
+                    getattr(physobj, field) == getattr(first_physobj, field)
+                    for field in cls.UNIFORM_PHYSOBJ_FIELDS
+                    if field != 'properties'):
+                # typical case of consolidation: no need to compare the
+                # contents of the properties
+                continue
             diff = {}  # field name -> (first value, second value)
             for field in cls.UNIFORM_PHYSOBJ_FIELDS:
                 if not cls.field_is_equal(field, first_physobj, physobj):
@@ -166,3 +174,77 @@ class Aggregate(Mixin.WmsSingleOutcomeOperation,
         """
         # that all Good Types are equal is part of pre-creation checks
         return self.inputs[0].obj.type.is_aggregate_reversible()
+
+    @classmethod
+    def consolidation_groups(cls, location, types=None):
+        """Find the groups of Avatars that :meth:`consolidate` would aggregate.
+
+        These are the ``present`` Avatars directly in ``location``, that
+        aren't the inputs of any Operation, grouped by
+        :attr:`UNIFORM_PHYSOBJ_FIELDS` of their PhysObj. This is done in one
+        single query.
+
+        The properties are compared by identity of their records, which
+        is what Operations such as :class:`Split <.split.Split>` produce:
+        PhysObj with distinct Properties records of equal contents are
+        not grouped.
+
+        If the ``wms-reservation`` Blok is installed, reserved PhysObj
+        are left aside, as aggregating them would void their Reservations.
+
+        :param types: if specified, restrict to PhysObj of these Types
+        :return: list of lists of Avatar ids. Groups of only one Avatar are
+                 omitted.
+        """
+        Wms = cls.registry.Wms
+        PhysObj = Wms.PhysObj
+        Avatar = PhysObj.Avatar
+        HI = Wms.Operation.HistoryInput
+
+        query = (cls.registry.query(func.array_agg(Avatar.id))
+                 .join(PhysObj, Avatar.obj_id == PhysObj.id)
+                 .outerjoin(HI, HI.avatar_id == Avatar.id)
+                 .filter(Avatar.location == location,
+                         Avatar.state == 'present',
+                         HI.avatar_id.is_(None)))
+        Reservation = getattr(Wms, 'Reservation', None)
+        if Reservation is not None:
+            query = (query
+                     .outerjoin(Reservation,
+                                Reservation.physobj_id == PhysObj.id)
+                     .filter(Reservation.physobj_id.is_(None)))
+        if types is not None:
+            query = query.filter(PhysObj.type_id.in_(
+                [gt.id for gt in types]))
+        query = (query
+                 .group_by(PhysObj.type_id, PhysObj.code,
+                           PhysObj.properties_id)
+                 .having(func.count(Avatar.id) > 1))
+        return [sorted(row[0]) for row in query.all()]
+
+    @classmethod
+    def consolidate(cls, location, types=None, dt_execution=None):
+        """Aggregate all that can be in the given location.
+
+        :param location: the location to consolidate. Its sublocations
+                         are not affected.
+        :param types: if specified, restrict to PhysObj of these Types
+        :param dt_execution: passed over to :meth:`create_batch`
+        :return: the created Aggregates, in the ``done`` state, one per group
+                 of indistinguishable Avatars (see
+                 :meth:`consolidation_groups`).
+
+        This is meant for locations that accumulate many PhysObj records
+        of identical Type and properties, for instance after many
+        partial picks.
+        """
+        groups = cls.consolidation_groups(location, types=types)
+        if not groups:
+            return []
+        Avatar = cls.registry.Wms.PhysObj.Avatar
+        avatars = {av.id: av for av in Avatar.query().filter(
+            Avatar.id.in_([av_id for group in groups for av_id in group]))}
+        return cls.create_batch(
+            (([avatars[av_id] for av_id in group], {}) for group in groups),
+            state='done',
+            dt_execution=dt_execution)
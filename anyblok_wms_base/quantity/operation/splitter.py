@@ -11,6 +11,7 @@ from sqlalchemy import CheckConstraint
 from anyblok import Declarations
 from anyblok.column import Boolean
 from anyblok.column import Decimal
+from anyblok.relationship import Many2One
 
 from anyblok_wms_base.exceptions import (
     OperationQuantityError,
@@ -40,6 +41,11 @@ class WmsSplitterOperation:
 
     Subclasses can use the :attr:`partial` field if they need to know
     if that happened, but this should be useful only in special cases.
+
+    For Operations created directly in the ``done`` state, the Split can
+    be recorded in a more compact way, according to the
+    :meth:`PhysObj Type <anyblok_wms_base.quantity.physobj.Type>`
+    (see :meth:`compact_split`).
     """
     quantity = Decimal(default=1)
     """The quantity this Operation will work on.
@@ -50,6 +56,9 @@ class WmsSplitterOperation:
     partial = Boolean(label="Operation induced a split")
     """Record if a Split will be or has been inserted in the history.
 
+    This is also ``True`` if the Split has been recorded in the compact way
+    (see :meth:`compact_split`).
+
     Such insertions should happen if the operation's original PhysObj
     have greater quantity than the operation needs.
 
@@ -128,12 +137,99 @@ class WmsSplitterOperation:
         partial = quantity < avatar.obj.quantity
         if not partial:
             return inputs, None
+        if state == 'done' and cls.is_split_compact(avatar):
+            # will be done by compact_split(), once we have an id
+            return inputs, dict(partial=partial)
 
         Split = cls.registry.Wms.Operation.Split
         split = Split.create(input=avatar, quantity=quantity, state=state,
                              dt_execution=dt_execution)
         return [split.wished_outcome], dict(partial=partial)
 
+    @classmethod
+    def is_split_compact(cls, avatar):
+        """Tell if the formal Split of the given Avatar can be compact.
+
+        This is the case if the :class:`Type
+        <anyblok_wms_base.quantity.physobj.Type>` of the underlying PhysObj
+        asks for it, provided that:
+
+        - ``avatar`` isn't already the input of another Operation
+        - ``avatar`` is the only Avatar of its PhysObj: otherwise, the
+          quantity change would alter the history of the other ones.
+        - the PhysObj isn't reserved, as the Reservation would silently
+          cover a smaller quantity afterwards.
+        """
+        if not avatar.obj.type.are_formal_splits_compact():
+            return False
+        Wms = cls.registry.Wms
+        HI = Wms.Operation.HistoryInput
+        if HI.query().filter(HI.avatar == avatar).count():
+            return False
+        Avatar = Wms.PhysObj.Avatar
+        if Avatar.query().filter(Avatar.obj == avatar.obj).count() > 1:
+            return False
+        Reservation = getattr(Wms, 'Reservation', None)
+        if Reservation is None:
+            return True
+        return Reservation.query().filter_by(physobj=avatar.obj).count() == 0
+
+    def after_insert(self):
+        """Perform the compact Split if needed, then call the base class.
+
+        In the compact case, :meth:`before_insert` kept the whole input, which
+        therefore still has a greater quantity than ours.
+        """
+        if self.state == 'done' and self.quantity < self.input.obj.quantity:
+            self.compact_split()
+        super(WmsSplitterOperation, self).after_insert()
+
+    def compact_split(self):
+        """Record a formal Split without a :class:`Split <.split.Split>`.
+
+        A new PhysObj record, with the quantity of ``self``, takes over
+        our input, which gets a new Avatar, identical to the original one
+        for all purposes of history. The original PhysObj and Avatar stay
+        in place, with the remaining quantity.
+
+        This saves an Operation, a PhysObj and two Avatars with respect to
+        the regular Split, but is possible only for Operations executed
+        right away: the link to our input is updated to record the
+        PhysObj the new one has been split from, and the quantity.
+
+        The quantity of the original PhysObj is lowered, which is why this is
+        restricted to the cases described in :meth:`is_split_compact`:
+        as the new Avatar has the same date/time range as the original one,
+        the sum of their quantities is unchanged at any time before ``self``.
+
+        Cancelling is not relevant for ``done`` Operations. The
+        reversal of ``self`` applies to the new Avatar, and oblivion restores
+        it, exactly as with the regular outcome of the Split.
+        """
+        HI = self.registry.Wms.Operation.HistoryInput
+        avatar = self.input
+        phobj = avatar.obj
+        qty = self.quantity
+        part = phobj.insert(type=phobj.type,
+                            code=phobj.code,
+                            properties=phobj.properties,
+                            quantity=qty)
+        phobj.quantity -= qty
+        avatar.quantity = phobj.quantity
+        part_avatar = avatar.insert(obj=part,
+                                    location=avatar.location,
+                                    outcome_of=avatar.outcome_of,
+                                    state=avatar.state,
+                                    dt_from=avatar.dt_from,
+                                    dt_until=avatar.dt_until)
+        HI.query().filter(HI.operation == self).delete(
+            synchronize_session='fetch')
+        HI.insert(operation=self,
+                  avatar=part_avatar,
+                  orig_dt_until=part_avatar.dt_until,
+                  split_from=phobj,
+                  split_quantity=qty)
+
     def execute_planned(self):
         """Execute the :class:`Split <.split.Split>` if any, then self."""
         if self.partial:
@@ -147,6 +243,24 @@ Operation = Declarations.Model.Wms.Operation
 Splitter = Declarations.Mixin.WmsSplitterOperation
 
 
+@register(Operation)
+class HistoryInput:
+    """Override to record compact Splits.
+
+    See :meth:`WmsSplitterOperation.compact_split`.
+    """
+
+    split_from = Many2One(model='Model.Wms.PhysObj')
+    """PhysObj that the input has been taken from, if any.
+
+    This is set in case of compact Splits. The input's PhysObj then got
+    its quantity from :attr:`split_from`.
+    """
+
+    split_quantity = Decimal(label="Quantity taken by compact Split")
+    """The quantity that was taken from :attr:`split_from`."""
+
+
 @register(Mixin)
 class WmsSplitterSingleInputOperation(Splitter):
     """Use this mixin to get both ``SingleInput`` and ``Splitter`` at once."""
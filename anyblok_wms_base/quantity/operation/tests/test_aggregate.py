@@ -309,3 +309,58 @@ class TestAggregate(WmsTestCase):
 
         gt.behaviours['aggregate'] = dict(reversible=True)
         self.assertTrue(agg.is_reversible())
+
+    def test_consolidate(self):
+        Arrival = self.Operation.Arrival
+        other_type = self.PhysObj.Type.insert(code='OTHER')
+
+        def arrive(physobj_type=self.physobj_type, quantity=1, **props):
+            return Arrival.create(physobj_type=physobj_type,
+                                  physobj_properties=props,
+                                  location=self.loc,
+                                  state='done',
+                                  dt_execution=self.dt_test1,
+                                  quantity=quantity).outcome
+
+        # default setUp Arrivals are planned, hence not consolidated
+        foo = [arrive(foo='bar'), arrive(foo='bar', quantity=3)]
+        foo.append(arrive(foo='bar'))
+        for avatar in foo[1:]:
+            avatar.obj.properties = foo[0].obj.properties
+        other = [arrive(physobj_type=other_type), arrive(other_type)]
+        single = arrive(foo='baz')
+        # equal contents, but distinct Properties record
+        lookalike = arrive(foo='bar')
+        planned_move = self.Operation.Move.create(input=foo[2],
+                                                  destination=self.loc,
+                                                  quantity=1,
+                                                  dt_execution=self.dt_test3,
+                                                  state='planned')
+
+        self.assertEqual(
+            self.Agg.consolidation_groups(self.loc, types=[other_type]),
+            [[av.id for av in other]])
+
+        aggs = self.Agg.consolidate(self.loc, dt_execution=self.dt_test2)
+        self.assertEqual(len(aggs), 2)
+        by_type = {agg.outcome.obj.type: agg for agg in aggs}
+        self.assertEqual(set(by_type), {self.physobj_type, other_type})
+
+        agg = by_type[self.physobj_type]
+        self.assertEqual(set(agg.inputs), set(foo[:2]))
+        outcome = agg.outcome
+        self.assertEqual(outcome.obj.quantity, 4)
+        self.assertEqual(outcome.quantity, 4)
+        self.assertEqual(outcome.obj.get_property('foo'), 'bar')
+        self.assertEqual(outcome.state, 'present')
+        self.assertEqual(outcome.dt_from, self.dt_test2)
+        self.assertEqual(by_type[other_type].outcome.obj.quantity, 2)
+
+        for avatar in foo[:2] + other:
+            self.assertEqual(avatar.state, 'past')
+        self.assertEqual(single.state, 'present')
+        self.assertEqual(lookalike.state, 'present')
+        self.assertEqual(planned_move.input, foo[2])
+        self.assertEqual(foo[2].state, 'present')
+
+        self.assertEqual(self.Agg.consolidate(self.loc), [])
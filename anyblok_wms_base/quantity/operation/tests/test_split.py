@@ -44,7 +44,9 @@ class TestSplit(WmsTestCaseWithPhysObj):
         self.assertEqual(self.avatar.dt_from, self.dt_test1)
         self.assertEqual(self.avatar.dt_until, self.dt_test2)
         self.assertEqual(sum(out.obj.quantity for out in outcomes), 3)
+        self.registry.flush()
         for outcome in outcomes:
+            self.assertEqual(outcome.quantity, outcome.obj.quantity)
             self.assertEqual(outcome.dt_from, self.dt_test2)
             self.assertEqual(outcome.location, self.incoming_loc)
             self.assertEqual(outcome.state, 'present')
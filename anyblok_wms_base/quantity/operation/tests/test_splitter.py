@@ -7,6 +7,7 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok_wms_base.testing import WmsTestCaseWithPhysObj
+from anyblok_wms_base.constants import COMPACT_FORMAL_SPLIT_BEHAVIOUR
 from anyblok_wms_base.exceptions import (
     OperationQuantityError,
     OperationMissingQuantityError,
@@ -124,5 +125,100 @@ class TestSplitterOperation(WmsTestCaseWithPhysObj):
         repr(move)
         str(move)
 
+    def test_compact_split(self):
+        self.physobj_type.behaviours = {COMPACT_FORMAL_SPLIT_BEHAVIOUR: True}
+        self.arrival.execute(dt_execution=self.dt_test1)
+        move = self.Move.create(destination=self.stock,
+                                quantity=2,
+                                dt_execution=self.dt_test2,
+                                state='done',
+                                input=self.avatar)
+        self.assertTrue(move.partial)
+        self.assert_singleton(move.follows, value=self.arrival)
+        self.assertEqual(self.Operation.Split.query().count(), 0)
+
+        part_avatar = move.input
+        part = part_avatar.obj
+        self.assertNotEqual(part, self.physobj)
+        self.assertEqual(part.quantity, 2)
+        self.assertEqual(self.physobj.quantity, 1)
+        self.assertEqual(part_avatar.quantity, 2)
+        self.assertEqual(self.avatar.quantity, 1)
+        self.assertEqual(
+            self.PhysObj.query().filter_by(type=self.physobj_type).count(), 2)
+        self.assertEqual(part_avatar.state, 'past')
+        self.assertEqual(part_avatar.outcome_of, self.arrival)
+        self.assertEqual(part_avatar.dt_from, self.avatar.dt_from)
+        self.assertEqual(part_avatar.dt_until, self.dt_test2)
+        self.assertEqual(self.avatar.state, 'present')
+        self.assertEqual(self.avatar.location, self.incoming_loc)
+        self.assertEqual(move.outcome.obj, part)
+        self.assertEqual(move.outcome.location, self.stock)
+
+        HI = self.Operation.HistoryInput
+        hi = self.single_result(HI.query().filter(HI.operation == move))
+        self.assertEqual(hi.split_from, self.physobj)
+        self.assertEqual(hi.split_quantity, 2)
+
+        # quantities before the Move are unchanged
+        for dt, qty in ((self.dt_test1, 3), (self.dt_test2, 1)):
+            self.assertEqual(
+                self.registry.Wms.quantity_query(
+                    location=self.incoming_loc,
+                    additional_states=['past'],
+                    at_datetime=dt).one()[0],
+                qty)
+
+        revert = move.plan_revert(dt_execution=self.dt_test3)[0]
+        self.assertEqual(revert.destination, self.incoming_loc)
+        self.assertEqual(revert.input.obj, part)
+
+        revert.cancel()
+        move.obliviate()
+        self.assertEqual(part_avatar.state, 'present')
+        self.assertIsNone(part_avatar.dt_until)
+        self.assertEqual(
+            self.Avatar.query().filter_by(state='present').count(), 2)
+
+    def test_compact_split_earlier_history(self):
+        """PhysObj with several Avatars still get a regular Split."""
+        self.physobj_type.behaviours = {COMPACT_FORMAL_SPLIT_BEHAVIOUR: True}
+        self.arrival.execute(dt_execution=self.dt_test1)
+        first = self.Move.create(destination=self.stock,
+                                 quantity=3,
+                                 dt_execution=self.dt_test2,
+                                 state='done',
+                                 input=self.avatar)
+        move = self.Move.create(destination=self.incoming_loc,
+                                quantity=2,
+                                dt_execution=self.dt_test3,
+                                state='done',
+                                input=first.outcome)
+        self.assertTrue(move.partial)
+        split = self.assert_singleton(move.follows)
+        self.assertEqual(split.type, 'wms_split')
+        self.assertEqual(self.physobj.quantity, 3)
+
+        Wms = self.registry.Wms
+        for loc, dt, qty in ((self.incoming_loc, self.dt_test1, 3),
+                             (self.stock, self.dt_test2, 3),
+                             (self.stock, self.dt_test3, 1),
+                             (self.incoming_loc, self.dt_test3, 2)):
+            self.assertEqual(
+                Wms.quantity_query(location=loc,
+                                   additional_states=['past'],
+                                   at_datetime=dt).one()[0],
+                qty)
+
+    def test_compact_split_planned(self):
+        """Planned Operations still get a regular Split."""
+        self.physobj_type.behaviours = {COMPACT_FORMAL_SPLIT_BEHAVIOUR: True}
+        move = self.Move.create(destination=self.stock,
+                                quantity=2,
+                                dt_execution=self.dt_test2,
+                                state='planned',
+                                input=self.avatar)
+        self.assertEqual(self.assert_singleton(move.follows).type, 'wms_split')
+
 
 del WmsTestCaseWithPhysObj
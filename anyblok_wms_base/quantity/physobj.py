@@ -7,12 +7,14 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from sqlalchemy import CheckConstraint
+from sqlalchemy import Index
 
 from anyblok import Declarations
 from anyblok.column import Decimal
 
 from anyblok_wms_base.constants import (
-    SPLIT_AGGREGATE_PHYSICAL_BEHAVIOUR
+    SPLIT_AGGREGATE_PHYSICAL_BEHAVIOUR,
+    COMPACT_FORMAL_SPLIT_BEHAVIOUR,
 )
 
 register = Declarations.register
@@ -129,6 +131,27 @@ class Type:
         """
         return self.get_behaviour(SPLIT_AGGREGATE_PHYSICAL_BEHAVIOUR, False)
 
+    def are_formal_splits_compact(self):
+        """Tell if formal Splits should be recorded in the compact way.
+
+        This is for :class:`Splitter Operations
+        <.operation.splitter.WmsSplitterOperation>` executed right away
+        on part of their input: instead of a full
+        :class:`Split <.operation.split.Split>` Operation, only the
+        taken part gets a new PhysObj record (see
+        :meth:`WmsSplitterOperation.compact_split()
+        <.operation.splitter.WmsSplitterOperation.compact_split>`).
+
+        This is never the case for physical Splits. Otherwise, it is
+        enabled by setting the behaviour named
+        :const:`COMPACT_FORMAL_SPLIT_BEHAVIOUR` to ``true``.
+
+        :returns bool: the answer.
+        """
+        if self.are_split_aggregate_physical():
+            return False
+        return self.get_behaviour(COMPACT_FORMAL_SPLIT_BEHAVIOUR, False)
+
     def _is_op_reversible(self, op_beh):
         """Common impl for question about reversibility of some operations.
 
@@ -164,3 +187,39 @@ class Type:
         :returns bool: the answer.
         """
         return self._is_op_reversible('aggregate')
+
+
+@register(Model.Wms.PhysObj)
+class Avatar:
+    """Override to add the denormalized :attr:`quantity` field."""
+
+    quantity = Decimal(label="Quantity")
+    """Copy of the :attr:`quantity <PhysObj.quantity>` of :attr:`obj`.
+
+    This is filled automatically at insertion time, and allows quantity
+    queries to sum Avatars directly (see
+    :meth:`Wms.quantity_measure()
+    <anyblok_wms_base.quantity.wms.Wms.quantity_measure>`)
+
+    PhysObj quantities aren't supposed to change once they have Avatars:
+    Split and Aggregate Operations create new PhysObj records instead. The
+    only exception is :meth:`compact_split()
+    <.operation.splitter.WmsSplitterOperation.compact_split>`, which
+    updates this field too, and is applied only to PhysObj having a
+    single Avatar.
+    """
+
+    @classmethod
+    def define_table_args(cls):
+        return super(Avatar, cls).define_table_args() + (
+            Index("idx_avatar_stock_quantity",
+                  cls.location_id, cls.type_id, cls.state, cls.quantity,
+                  postgresql_where=cls.state.in_(('present', 'future'))),
+        )
+
+    @classmethod
+    def before_insert_orm_event(cls, mapper, connection, target):
+        """Fill :attr:`quantity` from :attr:`obj`, if not passed."""
+        super(Avatar, cls).before_insert_orm_event(mapper, connection, target)
+        if target.quantity is None:
+            target.quantity = target.obj.quantity
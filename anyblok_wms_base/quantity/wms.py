@@ -15,9 +15,12 @@ class Wms:
     """Override to replace quantity counting by summation"""
 
     @classmethod
-    def base_quantity_query(cls):
-        """Return a base query fit for summing PhysObj.quantity."""
-        PhysObj = cls.registry.Wms.PhysObj
-        Avatar = PhysObj.Avatar
-        # TODO distinguish quantity on Avatars from those on PhysObj?
-        return Avatar.query(func.sum(PhysObj.quantity)).join(Avatar.obj)
+    def quantity_measure(cls):
+        """Sum quantities instead of counting.
+
+        This relies on the :attr:`quantity
+        <anyblok_wms_base.quantity.physobj.Avatar.quantity>` field of
+        Avatars, so that quantity queries don't need to join on PhysObj for
+        that.
+        """
+        return func.sum(cls.registry.Wms.PhysObj.Avatar.quantity)
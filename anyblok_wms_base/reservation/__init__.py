@@ -6,6 +6,9 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
 from anyblok.blok import Blok
 from anyblok_wms_base import version
 
@@ -18,20 +21,64 @@ class WmsReservation(Blok):
 
     required = ['wms-core']
 
+    def update(self, latest_version):  # pragma: no cover
+        if latest_version is None:
+            return
+        self.update_reservation_request()
+        if latest_version < '0.9.0.dev2':
+            self.update_request_item_reserved_quantity()
+
+    def update_request_item_reserved_quantity(self):  # pragma: no cover
+        """Initialize ``reserved_quantity`` and its partial index.
+
+        The column did not exist before, hence all RequestItems have
+        it at the default zero value, and the partial index has been
+        created by the migration without its predicate (or with a different
+        column order in development versions).
+        """
+        RequestItem = self.registry.Wms.Reservation.RequestItem
+        RequestItem.recompute_reserved_quantities()
+        execute = self.registry.execute
+        for index in RequestItem.__table__.indexes:
+            if index.dialect_options['postgresql']['where'] is None:
+                continue
+            execute(text("DROP INDEX IF EXISTS " + index.name))
+            execute(CreateIndex(index))
+
+    def update_reservation_request(self):  # pragma: no cover
+        """Fill the denormalized ``request_id`` of existing Reservations.
+
+        Only the Reservations that don't have it yet are updated.
+        """
+        Reservation = self.registry.Wms.Reservation
+        RequestItem = Reservation.RequestItem
+        (Reservation.query()
+         .filter(Reservation.request_id.is_(None),
+                 Reservation.request_item_id == RequestItem.id,
+                 RequestItem.request_id.isnot(None))
+         .update(dict(request_id=RequestItem.request_id),
+                 synchronize_session=False))
+
     @classmethod
     def import_declaration_module(cls):
         from . import ns  # noqa
+        from . import wms  # noqa
         from . import request  # noqa
         from . import reservation  # noqa
+        from . import stock_change  # noqa
         from . import operation  # noqa
 
     @classmethod
     def reload_declaration_module(cls, reload):
         from . import ns
         reload(ns)
+        from . import wms
+        reload(wms)
         from . import request
         reload(request)
         from . import reservation
         reload(reservation)
+        from . import stock_change
+        reload(stock_change)
         from . import operation
         reload(operation)
@@ -6,6 +6,8 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import orm
+
 from anyblok import Declarations
 from anyblok_wms_base.exceptions import OperationPhysObjReserved
 
@@ -16,6 +18,44 @@ Wms = Declarations.Model.Wms
 @register(Wms)
 class Operation:
 
+    @classmethod
+    def create(cls, *args, **kwargs):
+        """Record the new candidates to reservation after creation.
+
+        See :class:`Wms.Reservation.StockChange
+        <anyblok_wms_base.reservation.stock_change.StockChange>`
+        """
+        op = super(Operation, cls).create(*args, **kwargs)
+        cls.registry.Wms.Reservation.StockChange.record(
+            op.reservation_candidates())
+        return op
+
+    @classmethod
+    def create_batch(cls, *args, **kwargs):
+        """Same as :meth:`create`, for the batch variant."""
+        ops = super(Operation, cls).create_batch(*args, **kwargs)
+        cls.registry.Wms.Reservation.StockChange.record(
+            av for op in ops for av in op.reservation_candidates())
+        return ops
+
+    def reservation_candidates(self):
+        """Return the outcomes that may have become available to reservation.
+
+        This default implementation returns the outcomes whose PhysObj are
+        not among those of the inputs, i.e., those created by the Operation.
+
+        Downstream applications that restrict reservations to some
+        locations would typically override this, or
+        :meth:`RequestItem.lookup
+        <anyblok_wms_base.reservation.request.RequestItem.lookup>`
+        in the first place.
+        """
+        outcomes = self.outcomes
+        if not outcomes or not self.inputs_number:
+            return outcomes
+        input_obj_ids = set(av.obj_id for av in self.inputs)
+        return [av for av in outcomes if av.obj_id not in input_obj_ids]
+
     @classmethod
     def check_create_conditions(cls, state, dt_execution,
                                 inputs=None, **kwargs):
@@ -33,6 +73,7 @@ class Operation:
         for resa in (Reservation.query()
                      .join(Avatar, Avatar.obj_id == Reservation.physobj_id)
                      .filter(Avatar.id.in_(av.id for av in inputs))
+                     .options(orm.joinedload(Reservation.request))
                      .all()):
             if not resa.is_transaction_allowed(
                     cls, state, dt_execution,
@@ -43,3 +84,15 @@ class Operation:
                     "reserved {reservation!r}, which does not not agree.",
                     goods=resa.physobj,
                     reservation=resa)
+
+
+@register(Wms.Operation)
+class Teleportation:
+
+    def reservation_candidates(self):
+        """Teleported PhysObj may have come back to reservable locations.
+
+        Therefore, the outcome is always returned, although it's
+        the same PhysObj as the input.
+        """
+        return self.outcomes
@@ -6,11 +6,13 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+import json
 import time
 from contextlib import contextmanager
 
 import sqlalchemy
 from sqlalchemy import CheckConstraint
+from sqlalchemy import Index
 from sqlalchemy import func
 
 from anyblok import Declarations
@@ -53,6 +55,9 @@ class Request:
     reserved = Boolean(nullable=False, default=False)
     """Indicates that all reservations are taken.
 
+    Partial fulfillment can be read on the RequestItems, see
+    :attr:`RequestItem.reserved_quantity`.
+
     TODO: find a way to represent if the Request is partially done ?
     Some use-cases would require planning partial deliveries and the
     like in that case.
@@ -145,9 +150,11 @@ class Request:
         """
         return self.id in self.txn_owned_reservations
 
-    def reserve(self):
+    def reserve(self, pool=None):
         """Try and perform reservation for all RequestItems.
 
+        :param pool: optional :class:`LookupPool` to get candidates from,
+                     passed over to :meth:`RequestItem.reserve`.
         :return: ``True`` if all reservations are now taken
         :rtype: bool
 
@@ -157,8 +164,11 @@ class Request:
         # could use map() and all(), but it's not recommended style
         # if there are strong side effects.
         all_reserved = True
-        for item in Item.query().filter(Item.request == self).all():
-            all_reserved = all_reserved and item.reserve()
+        for item in (Item.query_unsatisfied()
+                     .filter(Item.request == self)
+                     .order_by(Item.id)
+                     .all()):
+            all_reserved = all_reserved and item.reserve(pool=pool)
         self.reserved = all_reserved
         return all_reserved
 
@@ -198,7 +208,7 @@ class Request:
 
     @classmethod
     def reserve_all(cls, batch_size=10, nb_attempts=5, retry_delay=1,
-                    query_filter=None):
+                    query_filter=None, lookup_window=100):
         """Try and perform all reservations for pending Requests.
 
         This walks all pending (:attr:`reserved` equal to ``False``)
@@ -222,6 +232,10 @@ class Request:
            concurrency in the reservation process: several processes can
            focus on different Requests, as long as they don't compete for
            PhysObj to reserve.
+        :param lookup_window:
+           if not ``None``, a :class:`LookupPool` with this window size
+           is used for each batch, so that RequestItems looking for the
+           same PhysObj don't issue one query each.
 
         The transaction is committed for each batch, and that's essential
         for proper operation under concurrency.
@@ -246,11 +260,58 @@ class Request:
             if not requests:
                 break
 
+            pool = None if lookup_window is None else LookupPool(lookup_window)
             for request in requests:
-                if not request.reserve():
+                if not request.reserve(pool=pool):
                     skip += 1
             cls.registry.commit()
 
+    @classmethod
+    def reserve_stock_changes(cls, query_filter=None, **kwargs):
+        """Retry reservations that can benefit from recorded stock changes.
+
+        This is meant for :ref:`Reservers <arch_reserver>` to avoid
+        rescanning all pending Requests with :meth:`reserve_all` each
+        time they wake up.
+
+        The pending :class:`StockChange
+        <anyblok_wms_base.reservation.stock_change.StockChange>` records
+        are read, then :meth:`reserve_all` is called,
+        restricted to the Requests having a non fully reserved RequestItem
+        that matches them. Finally, the stock changes that have been read are
+        deleted and the transaction is committed.
+
+        :param query_filter: same as in :meth:`reserve_all`, applied on top
+                             of the restriction to matching Requests.
+        :param kwargs: passed over to :meth:`reserve_all`
+        :return: the number of stock change records that have been processed
+        """
+        StockChange = cls.registry.Wms.Reservation.StockChange
+        Item = cls.registry.Wms.Reservation.RequestItem
+        change_ids, buckets = StockChange.read()
+        if not change_ids:
+            return 0
+
+        # materialized upfront: reserve_all() pages with an offset, which
+        # would be shifted if partially reserved Requests stopped matching
+        request_ids = [row[0] for row in (
+            Item.query_unsatisfied(Item.request_id)
+            .filter(StockChange.matching_items_filter(buckets))
+            .distinct()
+            .all())]
+
+        def restrict(query):
+            query = query.filter(cls.id.in_(request_ids))
+            if query_filter is not None:
+                query = query_filter(query)
+            return query
+
+        if request_ids:
+            cls.reserve_all(query_filter=restrict, **kwargs)
+        StockChange.discard(change_ids)
+        cls.registry.commit()
+        return len(change_ids)
+
 
 @register(Wms.Reservation)
 class RequestItem:
@@ -270,12 +331,62 @@ class RequestItem:
 
     properties = Jsonb()
 
+    reserved_quantity = Integer(nullable=False, default=0)
+    """Sum of the quantities of the Reservations taken for this RequestItem.
+
+    This is maintained by :meth:`reserve` and by the deletion of individual
+    Reservations, and spares to sum up existing Reservations each time
+    :meth:`reserve` is called. In case Reservations are created or
+    deleted by other means (e.g., at the query level),
+    :meth:`recompute_reserved_quantities` must be used to restore
+    consistency.
+
+    The RequestItem is fully reserved if this is greater or equal than
+    :attr:`quantity` (see :meth:`query_unsatisfied`).
+    """
+
     @classmethod
     def define_table_args(cls):
         return super(RequestItem, cls).define_table_args() + (
             CheckConstraint('quantity > 0', name='positive_qty'),
+            Index("idx_reservation_requestitem_unsatisfied",
+                  cls.request_id, cls.goods_type_id,
+                  postgresql_where=(cls.reserved_quantity < cls.quantity)),
         )
 
+    @classmethod
+    def query_unsatisfied(cls, *columns):
+        """Query RequestItems that aren't fully reserved.
+
+        :param columns: if specified, passed to :meth:`query`
+        :return: a Query object, backed by a partial index. It is therefore
+                 cheap to use for retries, even if the vast majority
+                 of RequestItems are already fully reserved.
+        """
+        return cls.query(*columns).filter(
+            cls.reserved_quantity < cls.quantity)
+
+    @classmethod
+    def recompute_reserved_quantities(cls, query_filter=None):
+        """Recompute :attr:`reserved_quantity` from existing Reservations.
+
+        :param query_filter: optional function to restrict the RequestItems
+                             to update. It takes a Query and must return
+                             a Query.
+
+        This is done in one single UPDATE statement.
+        """
+        Reservation = cls.registry.Wms.Reservation
+        reserved = (Reservation.query(
+            func.coalesce(func.sum(Reservation.quantity), 0))
+                    .filter(Reservation.request_item_id == cls.id)
+                    .as_scalar())
+        query = cls.query()
+        if query_filter is not None:
+            query = query_filter(query)
+        query.update(dict(reserved_quantity=reserved),
+                     synchronize_session='fetch')
+
     def lookup(self, quantity):
         """Try and find PhysObj matchin the specified conditions.
 
@@ -321,17 +432,31 @@ class RequestItem:
                 query = query.filter(Props.flexible.contains(props))
         return [(1, g) for g in query.limit(quantity).all()]
 
-    def reserve(self):
+    def lookup_pool_key(self):
+        """Return the key under which :class:`LookupPool` caches candidates.
+
+        RequestItems having the same key must be satisfiable by the same
+        results of :meth:`lookup`. In this default implementation, that's
+        the PhysObj Type and the properties.
+        Downstream overrides of :meth:`lookup` depending on other data must
+        override this method accordingly.
+        """
+        return (self.goods_type,
+                json.dumps(self.properties, sort_keys=True))
+
+    def reserve(self, pool=None):
         """Perform the wished reservations.
 
+        :param pool: optional :class:`LookupPool` to get candidates from,
+                     instead of calling :meth:`lookup` directly.
         :return bool: if the RequestItem is completely reserved.
-                      TODO: shall we store it directly in DB ?
+
+        This updates :attr:`reserved_quantity`.
         """
         Reservation = self.registry.Wms.Reservation
-        already = (Reservation.query(func.sum(Reservation.quantity))
-                   .filter(Reservation.request_item_id == self.id)
-                   .one())[0]
+        already = self.reserved_quantity
         if already is None:
+            # not flushed yet
             already = 0
         if already >= self.quantity:
             # its legit to be greater, think of reserving 2 packs of 10
@@ -339,9 +464,79 @@ class RequestItem:
             # the reservation to add just 7 of the Unpack outcomes.
             return True
         added = 0
-        for quantity, goods in self.lookup(self.quantity - already):
+        wished = self.quantity - already
+        if pool is None:
+            candidates = self.lookup(wished)
+        else:
+            candidates = pool.take(self, wished)
+        for quantity, goods in candidates:
             # TODO use a o2m ?
             Reservation.insert(physobj=goods, quantity=quantity,
                                request_item=self)
             added += quantity
-        return already + added >= self.quantity
+        self.reserved_quantity = already + added
+        return self.reserved_quantity >= self.quantity
+
+
+class LookupPool:
+    """Hand out candidates for reservation, prefetched by batches.
+
+    When many RequestItems ask for the same PhysObj (same
+    :meth:`RequestItem.lookup_pool_key`), calling :meth:`RequestItem.lookup`
+    for each of them would issue near identical queries, each of them reading
+    again the rows already reserved by the previous ones.
+
+    Instead, this pool calls :meth:`RequestItem.lookup` for a whole
+    ``window`` of candidates and hands them out in order, calling it
+    again only when they are exhausted.
+
+    It is meant to be used for the duration of a single transaction,
+    in which all Reservations are taken through it: the PhysObj
+    it hands out are never handed out again, even for different keys.
+    This is what :meth:`Request.reserve_all` does, with one pool per batch.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.candidates = {}
+        self.exhausted = set()
+        self.taken = set()
+
+    def take(self, item, quantity):
+        """Take candidates for the given RequestItem.
+
+        :param item: the RequestItem to look candidates for
+        :param int quantity: the wished quantity
+        :return: same as :meth:`RequestItem.lookup`
+        """
+        key = item.lookup_pool_key()
+        candidates = self.candidates.setdefault(key, [])
+        result = []
+        while quantity > 0:
+            if not candidates:
+                if key in self.exhausted:
+                    break
+                self.refill(item, key, quantity)
+                continue
+            qty, physobj = candidates.pop(0)
+            if physobj.id in self.taken:
+                continue
+            self.taken.add(physobj.id)
+            result.append((qty, physobj))
+            quantity -= qty
+        return result
+
+    def refill(self, item, key, quantity):
+        """Call :meth:`RequestItem.lookup` to refill the candidates for key.
+
+        The key is marked as exhausted if the lookup returns less
+        candidates than asked for, or nothing that hasn't been handed out
+        already.
+        """
+        size = max(self.window, quantity)
+        found = item.lookup(size)
+        fresh = [(qty, physobj) for qty, physobj in found
+                 if physobj.id not in self.taken]
+        if len(found) < size or not fresh:
+            self.exhausted.add(key)
+        self.candidates[key].extend(fresh)
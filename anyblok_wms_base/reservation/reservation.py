@@ -48,6 +48,18 @@ class Reservation:
     request_item = Many2One(model=Wms.Reservation.RequestItem,
                             index=True)
 
+    request = Many2One(model=Wms.Reservation.Request,
+                       index=True)
+    """Denormalization of the :attr:`request_item`'s Request.
+
+    This is filled automatically at insertion time from :attr:`request_item`,
+    and allows to check ownership or sort Reservations according to
+    their Requests without joining on the RequestItem Model.
+
+    As RequestItems aren't supposed to be moved from a Request to another,
+    there's no need to maintain it further.
+    """
+
     goods = Function(fget='_goods_get',
                      fset='_goods_set',
                      fexpr='_goods_expr')
@@ -73,6 +85,32 @@ class Reservation:
         deprecation_warn_goods()
         return cls.physobj
 
+    @classmethod
+    def before_insert_orm_event(cls, mapper, connection, target):
+        """Fill :attr:`request` from :attr:`request_item`, if not set."""
+        if target.request_id is not None:
+            return
+        item = target.request_item
+        if item is None and target.request_item_id is not None:
+            # not lazy loaded on pending objects
+            item = cls.registry.Wms.Reservation.RequestItem.query().get(
+                target.request_item_id)
+        if item is not None:
+            target.request_id = item.request_id
+
+    def delete(self, *args, **kwargs):
+        """Delete, and decrement the reserved quantity of :attr:`request_item`.
+
+        This keeps ``reserved_quantity`` of the RequestItem consistent.
+        Deletions performed at the query level bypass this, and must be
+        followed by a call to ``recompute_reserved_quantities()`` on the
+        RequestItem Model.
+        """
+        item = self.request_item
+        if item is not None and self.quantity is not None:
+            item.reserved_quantity -= self.quantity
+        return super(Reservation, self).delete(*args, **kwargs)
+
     @classmethod
     def define_table_args(cls):
         return super(Reservation, cls).define_table_args() + (
@@ -82,7 +120,7 @@ class Reservation:
     def is_transaction_owner(self):
         """Check that the current transaction is the owner of the reservation.
         """
-        return self.request_item.request.is_txn_reservations_owner()
+        return self.request.is_txn_reservations_owner()
 
     def is_transaction_allowed(self, opcls, state, dt_execution,
                                inputs=None, **kwargs):
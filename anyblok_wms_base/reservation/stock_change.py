@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# This file is a part of the AnyBlok / WMS Base project
+#
+#    Copyright (C) 2018 Georges Racinet <gracinet@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import json
+
+from sqlalchemy import or_
+from sqlalchemy import and_
+
+from anyblok import Declarations
+from anyblok.column import Integer
+from anyblok.relationship import Many2One
+from anyblok_postgres.column import Jsonb
+
+register = Declarations.register
+Wms = Declarations.Model.Wms
+
+
+@register(Wms.Reservation)
+class StockChange:
+    """Record that some PhysObj may have become available for reservation.
+
+    Records of this Model are issued by :meth:`Operation.create()
+    <anyblok_wms_base.reservation.operation.Operation.create>`
+    for each distinct (Type, Properties) bucket of PhysObj that
+    the Operation made candidates to reservation. They are
+    meant to be consumed by :ref:`Reservers <arch_reserver>`, see
+    :meth:`Request.reserve_stock_changes
+    <anyblok_wms_base.reservation.request.Request.reserve_stock_changes>`.
+
+    There is no uniqueness constraint: several Operations can record
+    the same bucket, and consumers delete only the records they've read.
+    This way, no stock change can be lost in case of concurrency.
+
+    Additionally, a PostgreSQL ``NOTIFY`` is issued on the
+    :attr:`NOTIFY_CHANNEL` channel, so that Reservers can ``LISTEN`` to
+    it rather than polling. As with any notification, it is delivered only
+    once the transaction is committed.
+    """
+    NOTIFY_CHANNEL = 'wms_reservation_stock_change'
+
+    id = Integer(label="Identifier", primary_key=True)
+    """Primary key."""
+
+    physobj_type = Many2One(model=Wms.PhysObj.Type, nullable=False)
+    """The Type of the PhysObj that became available."""
+
+    properties = Jsonb(nullable=False)
+    """The Properties of the PhysObj that became available.
+
+    This is the result of :meth:`Properties.as_dict()
+    <anyblok_wms_base.core.physobj.main.Properties.as_dict>` and hence
+    includes properties that are stored as direct fields.
+    """
+
+    @classmethod
+    def record(cls, avatars):
+        """Record the buckets of the PhysObj of the given Avatars.
+
+        :param avatars: iterable of Avatars whose PhysObj may have become
+                        candidates to reservation.
+        """
+        buckets = set()
+        for avatar in avatars:
+            phobj = avatar.obj
+            props = phobj.properties
+            props = {} if props is None else props.as_dict()
+            buckets.add((phobj.type_id, json.dumps(props, sort_keys=True)))
+        if not buckets:
+            return
+
+        cls.registry.execute(
+            cls.__table__.insert(),
+            [dict(physobj_type_id=type_id, properties=json.loads(props))
+             for type_id, props in buckets])
+        cls.registry.execute("NOTIFY " + cls.NOTIFY_CHANNEL)
+
+    @classmethod
+    def read(cls):
+        """Read all pending stock changes.
+
+        :return: the ids of the read records, and the distinct buckets as
+                 a list of pairs (Type id, properties)
+        """
+        ids = []
+        buckets = {}
+        for rec_id, type_id, props in cls.query(
+                cls.id, cls.physobj_type_id, cls.properties).all():
+            ids.append(rec_id)
+            buckets[type_id, json.dumps(props, sort_keys=True)] = props
+        return ids, [(type_id, props)
+                     for (type_id, _), props in buckets.items()]
+
+    @classmethod
+    def discard(cls, ids):
+        """Delete the given stock changes, once they have been processed."""
+        if not ids:
+            return
+        cls.query().filter(cls.id.in_(ids)).delete(synchronize_session=False)
+
+    @classmethod
+    def matching_items_filter(cls, buckets):
+        """Return a filter on RequestItems matching any of the buckets.
+
+        A RequestItem matches a bucket if it's of the same Type and
+        its properties (if any) are contained in the bucket's.
+
+        This follows the default implementation of
+        :meth:`RequestItem.lookup
+        <anyblok_wms_base.reservation.request.RequestItem.lookup>`,
+        in case it's overridden, this method should be, too.
+        """
+        Item = cls.registry.Wms.Reservation.RequestItem
+        return or_(*(and_(Item.goods_type_id == type_id,
+                          or_(Item.properties.is_(None),
+                              Item.properties.contained_by(props)))
+                     for type_id, props in buckets))
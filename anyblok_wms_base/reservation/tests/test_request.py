@@ -8,6 +8,7 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok_wms_base.testing import ConcurrencyBlokTestCase
 from anyblok_wms_base.testing import WmsTestCase
+from ..request import LookupPool
 
 
 class RequestItemTestCase(WmsTestCase):
@@ -101,6 +102,45 @@ class RequestItemTestCase(WmsTestCase):
         # subsequent executions don't reserve more
         self.assertEqual(item.reserve(), True)
         self.assertEqual(self.Reservation.query().count(), 3)
+        self.assertEqual(item.reserved_quantity, 3)
+
+    def test_item_reserved_quantity(self):
+        item = self.RequestItem.insert(goods_type=self.goods_type1,
+                                       properties=dict(foo=3),
+                                       quantity=3)
+        self.assertEqual(item.reserved_quantity, 0)
+        self.assertEqual(self.RequestItem.query_unsatisfied().all(), [item])
+
+        self.assertFalse(item.reserve())
+        self.assertEqual(item.reserved_quantity, 2)
+        self.assertEqual(self.RequestItem.query_unsatisfied().all(), [item])
+
+        self.RequestItem.insert(goods_type=self.goods_type1, quantity=1)
+        item.reserved_quantity = 0
+        self.RequestItem.recompute_reserved_quantities(
+            query_filter=lambda q: q.filter_by(id=item.id))
+        self.assertEqual(item.reserved_quantity, 2)
+
+        item.quantity = 2
+        self.assertEqual(
+            self.RequestItem.query_unsatisfied().filter_by(
+                goods_type=self.goods_type1,
+                properties=dict(foo=3)).count(),
+            0)
+
+    def test_item_reserved_quantity_delete(self):
+        item = self.RequestItem.insert(goods_type=self.goods_type1,
+                                       properties=dict(foo=3),
+                                       quantity=3)
+        item.reserve()
+        self.assertEqual(item.reserved_quantity, 2)
+
+        resa = self.Reservation.query().filter_by(request_item=item).first()
+        resa.delete()
+        self.assertEqual(item.reserved_quantity, 1)
+        self.RequestItem.recompute_reserved_quantities(
+            query_filter=lambda q: q.filter_by(id=item.id))
+        self.assertEqual(item.reserved_quantity, 1)
 
     def test_request_reserve(self):
         req = self.Reservation.Request(purpose="some delivery")
@@ -159,6 +199,31 @@ class RequestItemTestCase(WmsTestCase):
         expected.add(self.goods[self.props2][1])
         self.assertEqual(reserved_goods, expected)
 
+    def test_lookup_pool(self):
+        items = [self.RequestItem.insert(goods_type=self.goods_type1,
+                                         quantity=qty)
+                 for qty in (1, 1, 5)]
+        props_item = self.RequestItem.insert(goods_type=self.goods_type1,
+                                             properties=dict(foo=3),
+                                             quantity=2)
+        pool = LookupPool(2)
+        self.assertTrue(items[0].reserve(pool=pool))
+        key = items[0].lookup_pool_key()
+        self.assertEqual(key, items[1].lookup_pool_key())
+        # one candidate is left for the next RequestItem
+        self.assertEqual(len(pool.candidates[key]), 1)
+        self.assertNotIn(key, pool.exhausted)
+
+        self.assertTrue(items[1].reserve(pool=pool))
+        self.assertFalse(items[2].reserve(pool=pool))
+        self.assertIn(key, pool.exhausted)
+
+        # props_item gets only what hasn't been handed out yet
+        props_item.reserve(pool=pool)
+        self.assertEqual(self.Reservation.query().count(), 3)
+        self.assertEqual(sum(item.reserved_quantity
+                             for item in items + [props_item]), 3)
+
     def test_reserve_avatars_once(self):
         """We don't reserve several times PhysObj that have several Avatars."""
         goods = self.goods[self.props1][0]
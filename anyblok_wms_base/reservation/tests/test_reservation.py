@@ -63,6 +63,25 @@ class ReservationTestCase(WmsTestCase):
         self.avatar.state = 'present'
         dep.execute()
 
+    def test_request_denormalization(self):
+        request = self.Reservation.Request.insert(reserved=True)
+        req_item = self.Reservation.RequestItem.insert(
+            request=request,
+            goods_type=self.goods_type,
+            quantity=3)
+        resa = self.Reservation.insert(physobj=self.goods,
+                                       request_item=req_item)
+        self.assertEqual(resa.request, request)
+        self.assertEqual(
+            self.Reservation.query().filter_by(request=request).all(),
+            [resa])
+
+        # passing only the id of the RequestItem works as well
+        resa.delete()
+        resa = self.Reservation.insert(physobj=self.goods,
+                                       request_item_id=req_item.id)
+        self.assertEqual(resa.request, request)
+
     def test_compatibility_goods_field(self):
         """Test compatibility function field for the rename goods->obj.
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# This file is a part of the AnyBlok / WMS Base project
+#
+#    Copyright (C) 2018 Georges Racinet <gracinet@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_wms_base.testing import WmsTestCase
+
+
+class StockChangeTestCase(WmsTestCase):
+
+    def setUp(self):
+        super(StockChangeTestCase, self).setUp()
+        Wms = self.registry.Wms
+        self.Reservation = Wms.Reservation
+        self.StockChange = self.Reservation.StockChange
+        self.Request = self.Reservation.Request
+        self.RequestItem = self.Reservation.RequestItem
+        self.loc = self.insert_location('INC')
+        self.other_loc = self.insert_location('STOCK')
+        self.gt1 = self.PhysObj.Type.insert(code='MG')
+        self.gt2 = self.PhysObj.Type.insert(code='MH')
+
+    def buckets(self):
+        # properties that are fields (if any) have None values here
+        return set((type_id, tuple(sorted((k, v) for k, v in props.items()
+                                          if v is not None)))
+                   for type_id, props in self.StockChange.read()[1])
+
+    def arrive(self, physobj_type, **props):
+        return self.Operation.Arrival.create(physobj_type=physobj_type,
+                                             physobj_properties=props,
+                                             location=self.loc,
+                                             state='planned',
+                                             dt_execution=self.dt_test1)
+
+    def test_record_creative(self):
+        self.arrive(self.gt1, foo=3)
+        self.arrive(self.gt1, foo=3)
+        self.arrive(self.gt2)
+        self.assertEqual(self.buckets(), {(self.gt1.id, (('foo', 3), )),
+                                          (self.gt2.id, ())})
+
+    def test_record_move_teleportation(self):
+        arrival = self.arrive(self.gt1)
+        arrival.execute(dt_execution=self.dt_test1)
+        ids = self.StockChange.read()[0]
+        self.StockChange.discard(ids)
+
+        move = self.Operation.Move.create(input=arrival.outcome,
+                                          destination=self.other_loc,
+                                          dt_execution=self.dt_test2,
+                                          state='done')
+        self.assertEqual(self.buckets(), set())
+
+        self.Operation.Teleportation.create(input=move.outcome,
+                                            new_location=self.loc,
+                                            dt_execution=self.dt_test3,
+                                            state='done')
+        self.assertEqual(self.buckets(), {(self.gt1.id, ())})
+
+    def test_reserve_stock_changes(self):
+        Request = self.Request
+        req1 = Request.insert(purpose=dict(nb=1))
+        self.RequestItem.insert(goods_type=self.gt1,
+                                properties=dict(foo=3),
+                                quantity=1,
+                                request=req1)
+        req2 = Request.insert(purpose=dict(nb=2))
+        self.RequestItem.insert(goods_type=self.gt2,
+                                quantity=1,
+                                request=req2)
+        req3 = Request.insert(purpose=dict(nb=3))
+        self.RequestItem.insert(goods_type=self.gt1,
+                                properties=dict(foo=4),
+                                quantity=1,
+                                request=req3)
+
+        # no stock change yet
+        self.assertEqual(Request.reserve_stock_changes(), 0)
+
+        self.arrive(self.gt1, foo=3, bar=1)
+        self.arrive(self.gt2)
+        # this one matches nothing, and Request 3 won't be touched
+        self.arrive(self.gt1, foo=5)
+
+        saved_commit = Request.registry.commit
+        Request.registry.commit = lambda: None
+        try:
+            self.assertEqual(Request.reserve_stock_changes(batch_size=1), 3)
+        finally:
+            Request.registry.commit = saved_commit
+
+        self.assertTrue(req1.reserved)
+        self.assertTrue(req2.reserved)
+        self.assertFalse(req3.reserved)
+        self.assertEqual(self.StockChange.query().count(), 0)
+
+    def test_reserve_stock_changes_partial(self):
+        """A partially reserved Request doesn't make others be skipped."""
+        Request = self.Request
+        req1 = Request.insert(purpose=dict(nb=1))
+        self.RequestItem.insert(goods_type=self.gt1, quantity=1,
+                                request=req1)
+        # this one can't be satisfied
+        self.RequestItem.insert(goods_type=self.gt2, quantity=1,
+                                request=req1)
+        req2 = Request.insert(purpose=dict(nb=2))
+        self.RequestItem.insert(goods_type=self.gt1, quantity=1,
+                                request=req2)
+
+        self.arrive(self.gt1)
+        self.arrive(self.gt1)
+
+        saved_commit = Request.registry.commit
+        Request.registry.commit = lambda: None
+        try:
+            self.assertEqual(Request.reserve_stock_changes(batch_size=1), 2)
+        finally:
+            Request.registry.commit = saved_commit
+
+        self.assertFalse(req1.reserved)
+        self.assertTrue(req2.reserved)
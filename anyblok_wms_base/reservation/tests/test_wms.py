@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# This file is a part of the AnyBlok / WMS Base project
+#
+#    Copyright (C) 2018 Georges Racinet <gracinet@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_wms_base.testing import WmsTestCase
+
+
+class TestReservedQuantity(WmsTestCase):
+
+    def setUp(self):
+        super(TestReservedQuantity, self).setUp()
+        Wms = self.registry.Wms
+        self.Reservation = Wms.Reservation
+        self.gt1 = Wms.PhysObj.Type.insert(code='MG')
+        self.gt2 = Wms.PhysObj.Type.insert(code='MH')
+        self.stock = self.insert_location('STOCK')
+        self.other = self.insert_location('OTHER')
+        request = self.Reservation.Request.insert()
+        self.req_item = self.Reservation.RequestItem.insert(
+            request=request, goods_type=self.gt1, quantity=10)
+
+    def arrive(self, physobj_type, location, qty=1, reserve=0):
+        for i in range(qty):
+            arrival = self.Operation.Arrival.create(
+                physobj_type=physobj_type,
+                location=location,
+                state='done',
+                dt_execution=self.dt_test1)
+            if i < reserve:
+                self.Reservation.insert(physobj=arrival.outcome.obj,
+                                        request_item=self.req_item)
+
+    def test_quantity_query_reserved(self):
+        self.arrive(self.gt1, self.stock, qty=3, reserve=1)
+        self.arrive(self.gt2, self.stock, qty=2)
+        Wms = self.registry.Wms
+
+        def qty(**kw):
+            return Wms.quantity_query(location=self.stock, **kw).scalar()
+
+        self.assertEqual(qty(), 5)
+        self.assertEqual(qty(reserved=False), 4)
+        self.assertEqual(qty(reserved=True), 1)
+
+    def test_grouped_availability(self):
+        self.arrive(self.gt1, self.stock, qty=3, reserve=2)
+        self.arrive(self.gt2, self.stock, qty=2)
+        self.arrive(self.gt1, self.other, qty=1, reserve=1)
+        Wms = self.registry.Wms
+        query = Wms.grouped_availability_query(location=self.stock,
+                                               location_recurse=False,
+                                               by_location=False)
+        self.assertEqual(set(query.all()),
+                         {(3, self.gt1.id, 2, 1),
+                          (2, self.gt2.id, 0, 2)})
+
+        row = Wms.grouped_availability_query(by_location=False,
+                                             by_type=False).one()
+        self.assertEqual((row.qty, row.reserved, row.available), (6, 3, 3))
+
+        with self.assertRaises(ValueError):
+            Wms.grouped_availability_query(reserved=True)
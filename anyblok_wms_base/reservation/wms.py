@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# This file is a part of the AnyBlok / WMS Base project
+#
+#    Copyright (C) 2018 Georges Racinet <gracinet@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from sqlalchemy import func
+from sqlalchemy import not_
+from anyblok import Declarations
+
+
+@Declarations.register(Declarations.Model)
+class Wms:
+    """Override to take Reservations into account in quantity queries."""
+
+    @classmethod
+    def quantity_query(cls, reserved=None, **kwargs):
+        """Override adding filtering according to Reservations.
+
+        :param reserved:
+           if ``None``, Reservations are ignored. If ``False``, only
+           PhysObj that aren't reserved are taken into account, if ``True``,
+           only those that are reserved.
+
+           In combination with the ``future`` additional state, this
+           gives the *available to promise* quantities.
+
+        All other parameters are passed over to the :meth:`base method
+        <anyblok_wms_base.core.wms.Wms.quantity_query>`.
+
+        The filtering is done with a ``NOT EXISTS`` (or ``EXISTS``) clause,
+        which PostgreSQL can execute as an anti-join (or semi-join) using
+        the primary key of Reservations.
+        """
+        query = super(Wms, cls).quantity_query(**kwargs)
+        if reserved is None:
+            return query
+
+        Reservation = cls.registry.Wms.Reservation
+        Avatar = cls.registry.Wms.PhysObj.Avatar
+        exists = (Reservation.query()
+                  .filter(Reservation.physobj_id == Avatar.obj_id)
+                  .exists())
+        return query.filter(exists if reserved else not_(exists))
+
+    @classmethod
+    def grouped_availability_query(cls, **kwargs):
+        """Build a grouped query for on-hand, reserved and available quantities.
+
+        All keyword arguments are passed over to
+        :meth:`grouped_quantity_query
+        <anyblok_wms_base.core.wms.Wms.grouped_quantity_query>`
+        (hence to :meth:`quantity_query`, except ``reserved``, which would
+        make no sense here).
+
+        :return: a Query object, whose result columns are those of
+                 :meth:`grouped_quantity_query
+                 <anyblok_wms_base.core.wms.Wms.grouped_quantity_query>`,
+                 followed by the reserved and available (not reserved)
+                 quantities, also available by their labels ``reserved``
+                 and ``available``.
+
+        All these quantities are computed in one single pass, thanks to
+        an outer join on Reservations and aggregate ``FILTER`` clauses.
+        """
+        if kwargs.get('reserved') is not None:
+            raise ValueError("The 'reserved' keyword argument can't be used "
+                             "in availability queries")
+        Reservation = cls.registry.Wms.Reservation
+        Avatar = cls.registry.Wms.PhysObj.Avatar
+        measure = cls.quantity_measure()
+        is_reserved = Reservation.physobj_id.isnot(None)
+        return (cls.grouped_quantity_query(**kwargs)
+                .outerjoin(Reservation,
+                           Reservation.physobj_id == Avatar.obj_id)
+                .add_columns(
+                    func.coalesce(measure.filter(is_reserved), 0)
+                    .label('reserved'),
+                    func.coalesce(measure.filter(not_(is_reserved)), 0)
+                    .label('available')))